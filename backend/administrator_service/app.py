@@ -1,20 +1,26 @@
-from flask import Flask, request, jsonify, g
+from flask import Flask, request, jsonify, g, Response
 from flask_cors import CORS
 from keycloak import KeycloakOpenID
 from functools import wraps
 import sys
 import os
+import io
+import csv
 import jwt as pyjwt
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
 from bson.timestamp import Timestamp
+from pymongo.errors import BulkWriteError
 
 # Agregar el path del backend para importar db_config
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from database.db_config import (
+    DatabaseConfig,
+    estadisticas_auditoria,
+    en_lotes,
     get_usuarios_collection,
     get_cursos_collection,
     get_matriculas_collection,
-    get_auditoria_collection,
     get_reportes_collection,
     get_asignaciones_collection,
     get_groups_collection,
@@ -22,8 +28,22 @@ from database.db_config import (
     string_to_objectid,
     registrar_auditoria
 )
+from database.api_utils import (
+    paginar,
+    leer_proyeccion,
+    leer_formato_stream,
+    cursor_listado,
+    responder_stream
+)
+from database.json_provider import BSONJSONProvider
+from database.audit_store import consultar_auditoria, resumen_auditoria, leer_fecha
+from database.keycloak_auth import obtener_proveedor_claves, roles_del_token
+from database.identity_resolver import invalidar_usuario
+from database.importacion import TAMANO_LOTE_IMPORTACION, abrir_tabla, normalizar_encabezado
+from database.grupos import es_activa, reservar_cupos, liberar_cupos
 
 app = Flask(__name__)
+app.json = BSONJSONProvider(app)
 app.secret_key = "admin_secret_key"
 
 # 🔧 CORS CONFIGURACIÓN COMPLETA
@@ -59,36 +79,29 @@ if KeycloakOpenID is not None:
     except Exception:
         keycloak_openid = None
 
+# Claves de firma del realm en caché (verificación de tokens sin red)
+proveedor_claves = obtener_proveedor_claves(KEYCLOAK_SERVER, KEYCLOAK_REALM)
+
 
 def tiene_rol(token_info, cliente_id, rol_requerido):
     """Comprueba si los claims del token contienen el rol requerido.
 
-    Busca tanto en realm_access como en resource_access[cliente_id].
+    Usa el conjunto de roles (realm_access + todos los resource_access)
+    precalculado al verificar el token; `rol_requerido` puede ser str o lista.
     """
     try:
-        # 1. Buscar en realm_access (roles globales del realm)
-        realm_roles = token_info.get('realm_access', {}).get('roles', [])
-        if rol_requerido in realm_roles:
-            print(f"✓ Rol '{rol_requerido}' encontrado en realm_access")
-            return True
-        
-        # 2. Buscar en resource_access para el cliente específico
-        if cliente_id and cliente_id in token_info.get('resource_access', {}):
-            client_roles = token_info.get('resource_access', {}).get(cliente_id, {}).get('roles', [])
-            if rol_requerido in client_roles:
-                print(f"✓ Rol '{rol_requerido}' encontrado en resource_access[{cliente_id}]")
-                return True
-        
-        # 3. Buscar en TODOS los clientes (fallback)
-        resource_access = token_info.get('resource_access', {})
-        for client_id, client_data in resource_access.items():
-            client_roles = client_data.get('roles', [])
-            if rol_requerido in client_roles:
-                print(f"✓ Rol '{rol_requerido}' encontrado en resource_access[{client_id}]")
-                return True
-        
-        print(f"✗ Rol '{rol_requerido}' NO encontrado. Realm roles: {realm_roles}, Resource access: {list(resource_access.keys())}")
-        return False
+        roles = getattr(token_info, 'roles_set', None)
+        if roles is None:
+            roles = roles_del_token(token_info)
+
+        if isinstance(rol_requerido, str):
+            encontrado = rol_requerido in roles
+        else:
+            encontrado = not roles.isdisjoint(rol_requerido)
+
+        if not encontrado:
+            print(f"✗ Rol '{rol_requerido}' NO encontrado. Roles del token: {sorted(roles)}")
+        return encontrado
         
     except Exception as e:
         print(f"Error al verificar rol: {e}")
@@ -121,18 +134,9 @@ def token_required(rol_requerido):
                 
                 # Intentar decodificar con Keycloak (modo producción)
                 try:
-                    public_key_pem = f"-----BEGIN PUBLIC KEY-----\n{keycloak_openid.public_key()}\n-----END PUBLIC KEY-----"
-                    
-                    userinfo = keycloak_openid.decode_token(
-                        token,
-                        key=public_key_pem,
-                        options={
-                            "verify_signature": True,
-                            "verify_aud": False,
-                            "verify_exp": True
-                        }
-                    )
-                    print(f"✅ Token decodificado con Keycloak")
+                    # Verificación local con las claves JWKS en caché (sin ir a Keycloak)
+                    userinfo = proveedor_claves.verificar(token)
+                    print(f"✅ Token verificado con JWKS en caché")
                     print(f"   Usuario: {userinfo.get('preferred_username', 'N/A')}")
                     print(f"   Email: {userinfo.get('email', 'N/A')}")
                     
@@ -175,7 +179,7 @@ def home():
 
 @app.route('/health')
 def health():
-    return jsonify({'status': 'healthy', 'service': 'administrator', 'database': 'MongoDB'})
+    return jsonify({'status': 'healthy', 'service': 'administrator', 'database': 'MongoDB', 'auth_keys': proveedor_claves.stats(), 'db_pool': DatabaseConfig.estadisticas_pool(), 'audit': estadisticas_auditoria()})
 
 
 @app.route('/dashboard')
@@ -416,14 +420,23 @@ def get_all_users():
             query['activo'] = (status.lower() == 'active')
         
         # Buscar usuarios
-        users = list(usuarios.find(query))
+        proyeccion = leer_proyeccion(request.args)
+        formato = leer_formato_stream(request.args)
+        if formato:
+            cursor = cursor_listado(usuarios, query, projection=proyeccion)
+            return responder_stream(cursor, formato, clave='users')
+        
+        users, paginacion = paginar(usuarios, query, request.args, projection=proyeccion)
         
         return jsonify({
             'success': True,
-            'users': serialize_doc(users),
-            'count': len(users)
+            'users': users,
+            'count': len(users),
+            **paginacion
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -431,32 +444,59 @@ def get_all_users():
 @app.route('/admin/audit', methods=['GET'])
 @token_required('administrador')
 def get_audit_logs():
-    """Obtener logs de auditoría"""
+    """Obtener logs de auditoría (del más reciente al más antiguo, paginados por cursor)"""
     try:
-        auditoria = get_auditoria_collection()
-        
         # Filtros opcionales
-        accion = request.args.get('accion')
-        entidad = request.args.get('entidad')
-        limit = int(request.args.get('limit', 100))
-        
-        # Construir query
-        query = {}
-        
-        if accion:
-            query['accion'] = accion
-        if entidad:
-            query['entidad_afectada'] = entidad
-        
-        # Buscar logs ordenados por fecha descendente
-        logs = list(auditoria.find(query).sort('fecha', -1).limit(limit))
+        limit = min(int(request.args.get('limit', 100)), 500)
+        if limit < 1:
+            raise ValueError('Parámetro limit inválido')
+        
+        logs, next_cursor = consultar_auditoria(
+            desde=leer_fecha(request.args.get('desde')),
+            hasta=leer_fecha(request.args.get('hasta'), fin_de_dia=True),
+            id_usuario=request.args.get('usuario'),
+            entidad=request.args.get('entidad'),
+            accion=request.args.get('accion'),
+            limit=limit,
+            after=request.args.get('after')
+        )
         
         return jsonify({
             'success': True,
-            'logs': serialize_doc(logs),
-            'count': len(logs)
+            'logs': logs,
+            'count': len(logs),
+            'has_more': next_cursor is not None,
+            'next_cursor': next_cursor
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/admin/audit/summary', methods=['GET'])
+@token_required('administrador')
+def get_audit_summary():
+    """Conteo de registros de auditoría por día y acción en un rango de fechas"""
+    try:
+        desde = leer_fecha(request.args.get('desde'))
+        if desde is None:
+            # Por defecto los últimos 30 días
+            desde = datetime.now(timezone.utc) - timedelta(days=30)
+        
+        resumen = resumen_auditoria(
+            desde=desde,
+            hasta=leer_fecha(request.args.get('hasta'), fin_de_dia=True),
+            id_usuario=request.args.get('usuario'),
+            entidad=request.args.get('entidad'),
+            accion=request.args.get('accion')
+        )
+        
+        return jsonify({'success': True, **resumen}), 200
+        
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -518,6 +558,7 @@ def update_user_status(user_id):
             {'_id': obj_id},
             {'$set': {'activo': data['activo']}}
         )
+        invalidar_usuario(obj_id)
         
         # Registrar en auditoría
         registrar_auditoria(
@@ -725,15 +766,24 @@ def get_all_students_admin():
             ]
         
         # Obtener estudiantes
-        students = list(usuarios.find(query))
+        proyeccion = leer_proyeccion(request.args)
+        formato = leer_formato_stream(request.args)
+        if formato:
+            cursor = cursor_listado(usuarios, query, projection=proyeccion)
+            return responder_stream(cursor, formato, clave='students')
+        
+        students, paginacion = paginar(usuarios, query, request.args, projection=proyeccion)
         
         # ✅ DEVOLVER EN EL CAMPO 'students'
         return jsonify({
             'success': True,
-            'students': serialize_doc(students),  # ✅ Cambiar 'data' por 'students'
-            'count': len(students)
+            'students': students,  # ✅ Cambiar 'data' por 'students'
+            'count': len(students),
+            **paginacion
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         print(f"❌ Error en get_all_students_admin: {e}")
         import traceback
@@ -754,12 +804,18 @@ def get_student_detail_admin(student_id):
             return jsonify({'success': False, 'error': 'ID inválido'}), 400
         
         # Obtener estudiante
-        estudiante = usuarios.find_one({'_id': student_obj_id, 'rol': 'estudiante'})
+        estudiante = usuarios.find_one(
+            {'_id': student_obj_id, 'rol': 'estudiante'},
+            leer_proyeccion(request.args)
+        )
         if not estudiante:
             return jsonify({'success': False, 'error': 'Estudiante no encontrado'}), 404
         
-        # Obtener matrículas
-        student_matriculas = list(matriculas.find({'id_estudiante': student_obj_id}))
+        # Obtener matrículas (sin notas salvo que se pidan con enrollment_fields)
+        student_matriculas = list(matriculas.find(
+            {'id_estudiante': student_obj_id},
+            leer_proyeccion(request.args, por_defecto={'calificaciones': 0}, parametro='enrollment_fields')
+        ))
         
         return jsonify({
             'success': True,
@@ -768,6 +824,8 @@ def get_student_detail_admin(student_id):
             'total_enrollments': len(student_matriculas)
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -839,6 +897,281 @@ def create_student_admin():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+CAMPOS_ESTUDIANTE_REQUERIDOS = ('correo', 'nombres', 'apellidos', 'documento', 'codigo_est')
+CAMPOS_ESTUDIANTE_OPCIONALES = (
+    'tipo_doc', 'fecha_nacimiento', 'direccion', 'telefono',
+    'nombre_acudiente', 'telefono_acudiente', 'correo_acudiente'
+)
+COLUMNAS_REPORTE_IMPORTACION = ['fila', 'estado', 'student_id', 'correo', 'codigo_est', 'grupo', 'mensaje']
+
+
+def _estudiante_desde_fila(fila):
+    """Documento de usuario para una fila de la importación; lanza ValueError si es inválida"""
+    faltantes = [campo for campo in CAMPOS_ESTUDIANTE_REQUERIDOS if not fila.get(campo)]
+    if faltantes:
+        raise ValueError(f"Campos requeridos vacíos: {', '.join(faltantes)}")
+    if '@' not in fila['correo']:
+        raise ValueError(f"Correo inválido: {fila['correo']}")
+    try:
+        fecha_nacimiento = datetime.fromisoformat(fila['fecha_nacimiento']) if fila.get('fecha_nacimiento') else None
+    except ValueError:
+        raise ValueError(f"Fecha de nacimiento inválida: {fila['fecha_nacimiento']}")
+
+    return {
+        '_id': ObjectId(),
+        'correo': fila['correo'],
+        'rol': 'estudiante',
+        'nombres': fila['nombres'],
+        'apellidos': fila['apellidos'],
+        'documento': fila['documento'],
+        'tipo_doc': fila.get('tipo_doc') or 'TI',
+        'codigo_est': fila['codigo_est'],
+        'fecha_nacimiento': fecha_nacimiento,
+        'direccion': fila.get('direccion', ''),
+        'telefono': fila.get('telefono', ''),
+        'nombre_acudiente': fila.get('nombre_acudiente', ''),
+        'telefono_acudiente': fila.get('telefono_acudiente', ''),
+        'correo_acudiente': fila.get('correo_acudiente', ''),
+        'activo': True,
+        'creado_en': Timestamp(int(datetime.utcnow().timestamp()), 0)
+    }
+
+
+def _indices_fallidos(error):
+    """Índices de las operaciones fallidas de un BulkWriteError con su mensaje"""
+    return {e['index']: e.get('errmsg', 'Error de escritura') for e in error.details.get('writeErrors', [])}
+
+
+def _importar_lote_estudiantes(lote, anio_lectivo, vistos, reporte):
+    """
+    Procesa un lote de filas ya validadas: descarta duplicados con una sola
+    consulta, reserva cupos por grupo, inserta los estudiantes y sus matrículas
+    con insert_many y agrega el resultado de cada fila a `reporte`.
+    """
+    usuarios = get_usuarios_collection()
+    grupos = get_groups_collection()
+    matriculas = get_matriculas_collection()
+
+    # Duplicados contra la base de datos: una consulta para todo el lote
+    existentes = {'correo': set(), 'documento': set(), 'codigo_est': set()}
+    for usuario in usuarios.find({'$or': [
+        {campo: {'$in': [item['estudiante'][campo] for item in lote]}} for campo in existentes
+    ]}, {campo: 1 for campo in existentes}):
+        for campo in existentes:
+            if usuario.get(campo):
+                existentes[campo].add(usuario[campo])
+
+    candidatos = []
+    for item in lote:
+        estudiante = item['estudiante']
+        repetidos = [campo for campo in existentes if estudiante[campo] in existentes[campo]]
+        if repetidos:
+            item.update(estado='duplicado', mensaje=f"Ya existe un usuario con ese {', '.join(repetidos)}")
+            continue
+        repetidos = [campo for campo in existentes if estudiante[campo] in vistos[campo]]
+        if repetidos:
+            item.update(estado='duplicado', mensaje=f"Repetido en el archivo: {', '.join(repetidos)}")
+            continue
+        for campo in existentes:
+            vistos[campo].add(estudiante[campo])
+        candidatos.append(item)
+
+    # Reservar cupos por grupo antes de escribir. Los cupos reservados que no
+    # terminan en matrícula se liberan siempre, también si algo falla a mitad
+    reservados = []
+    try:
+        por_grupo = {}
+        for item in candidatos:
+            if item['grupo']:
+                por_grupo.setdefault(item['grupo']['_id'], []).append(item)
+        for id_grupo, items in por_grupo.items():
+            cantidad = reservar_cupos(grupos, id_grupo, len(items))
+            for item in items[cantidad:]:
+                item.update(estado='error', mensaje=f"El grupo {item['grupo']['nombre_grupo']} no tiene cupos disponibles")
+            for item in items[:cantidad]:
+                item['estudiante']['id_grupo'] = id_grupo
+                reservados.append(item)
+        candidatos = [item for item in candidatos if not item.get('estado')]
+
+        insertados = []
+        if candidatos:
+            fallidos = {}
+            try:
+                usuarios.insert_many([item['estudiante'] for item in candidatos], ordered=False)
+            except BulkWriteError as e:
+                fallidos = _indices_fallidos(e)
+            for indice, item in enumerate(candidatos):
+                if indice in fallidos:
+                    item.update(estado='error', mensaje=fallidos[indice])
+                else:
+                    item.update(estado='creado', mensaje='Estudiante creado')
+                    insertados.append(item)
+
+        # Matrículas de los estudiantes con grupo
+        con_grupo = [item for item in insertados if item['grupo']]
+        if con_grupo:
+            ahora = Timestamp(int(datetime.utcnow().timestamp()), 0)
+            fallidos = {}
+            try:
+                matriculas.insert_many([{
+                    'id_estudiante': item['estudiante']['_id'],
+                    'id_grupo': item['grupo']['_id'],
+                    'anio_lectivo': anio_lectivo,
+                    'fecha_matricula': ahora,
+                    'estado': 'activa',
+                    'calificaciones': [],
+                    'estudiante_info': {
+                        'nombres': item['estudiante']['nombres'],
+                        'apellidos': item['estudiante']['apellidos'],
+                        'codigo_est': item['estudiante']['codigo_est']
+                    },
+                    'grupo_info': {
+                        'nombre_grupo': item['grupo'].get('nombre_grupo'),
+                        'grado': item['grupo'].get('grado'),
+                        'jornada': item['grupo'].get('jornada')
+                    },
+                    'observaciones_admin': 'Importación masiva de estudiantes'
+                } for item in con_grupo], ordered=False)
+            except BulkWriteError as e:
+                fallidos = _indices_fallidos(e)
+
+            for indice, item in enumerate(con_grupo):
+                if indice in fallidos:
+                    item.update(mensaje=f"Estudiante creado sin matrícula: {fallidos[indice]}")
+                else:
+                    item['matriculado'] = True
+                    item.update(mensaje='Estudiante creado y matriculado')
+    finally:
+        sin_matricula = [item for item in reservados if not item.get('matriculado')]
+        liberar = {}
+        for item in sin_matricula:
+            liberar[item['grupo']['_id']] = liberar.get(item['grupo']['_id'], 0) + 1
+        for id_grupo, cantidad in liberar.items():
+            liberar_cupos(grupos, id_grupo, cantidad)
+        if sin_matricula:
+            # Sin matrícula el estudiante no queda en el grupo (si llegó a crearse)
+            usuarios.update_many(
+                {'_id': {'$in': [item['estudiante']['_id'] for item in sin_matricula]}},
+                {'$unset': {'id_grupo': ''}}
+            )
+
+    for item in lote:
+        reporte.append({
+            'fila': item['fila'],
+            'estado': item['estado'],
+            'student_id': str(item['estudiante']['_id']) if item['estado'] == 'creado' else '',
+            'correo': item['estudiante']['correo'],
+            'codigo_est': item['estudiante']['codigo_est'],
+            'grupo': item['grupo']['nombre_grupo'] if item['grupo'] else '',
+            'mensaje': item['mensaje']
+        })
+
+
+@app.route('/admin/students/import', methods=['POST'])
+@token_required('administrador')
+def import_students_admin():
+    """
+    Importar estudiantes desde un archivo CSV o XLSX (multipart: file, anio_lectivo).
+
+    Columnas: correo, nombres, apellidos, documento, codigo_est y opcionalmente
+    tipo_doc, fecha_nacimiento, direccion, telefono, datos del acudiente y
+    grupo (nombre del grupo, para matricular al estudiante). Con
+    `?format=csv` la respuesta es el reporte por fila como archivo descargable.
+    """
+    try:
+        archivo = request.files.get('file')
+        if not archivo or not archivo.filename:
+            return jsonify({'success': False, 'error': 'No se proporcionó el archivo'}), 400
+        
+        anio_lectivo = request.form.get('anio_lectivo', '2025')
+        formato = request.args.get('format', 'json').lower()
+        if formato not in ('json', 'csv'):
+            return jsonify({'success': False, 'error': 'Parámetro format inválido (use json o csv)'}), 400
+        
+        encabezados, filas = abrir_tabla(archivo)
+        columnas = [normalizar_encabezado(e) for e in encabezados]
+        faltantes = [c for c in CAMPOS_ESTUDIANTE_REQUERIDOS if c not in columnas]
+        if faltantes:
+            return jsonify({'success': False, 'error': f"Faltan columnas: {', '.join(faltantes)}"}), 400
+        columna_grupo = 'grupo' if 'grupo' in columnas else 'nombre_grupo'
+        
+        grupos_por_nombre = {
+            str(grupo.get('nombre_grupo', '')).strip().lower(): grupo
+            for grupo in get_groups_collection().find(
+                {'activo': True},
+                {'nombre_grupo': 1, 'grado': 1, 'jornada': 1}
+            )
+        }
+        
+        reporte = []
+        vistos = {'correo': set(), 'documento': set(), 'codigo_est': set()}
+        for lote_filas in en_lotes(filas, TAMANO_LOTE_IMPORTACION):
+            lote = []
+            for numero_fila, valores in lote_filas:
+                fila = dict(zip(columnas, valores))
+                try:
+                    estudiante = _estudiante_desde_fila(fila)
+                    grupo = None
+                    if fila.get(columna_grupo):
+                        grupo = grupos_por_nombre.get(fila[columna_grupo].lower())
+                        if not grupo:
+                            raise ValueError(f"Grupo no encontrado: {fila[columna_grupo]}")
+                    lote.append({'fila': numero_fila, 'estudiante': estudiante, 'grupo': grupo})
+                except ValueError as e:
+                    reporte.append({
+                        'fila': numero_fila,
+                        'estado': 'error',
+                        'student_id': '',
+                        'correo': fila.get('correo', ''),
+                        'codigo_est': fila.get('codigo_est', ''),
+                        'grupo': fila.get(columna_grupo, ''),
+                        'mensaje': str(e)
+                    })
+            if lote:
+                _importar_lote_estudiantes(lote, anio_lectivo, vistos, reporte)
+        
+        reporte.sort(key=lambda r: r['fila'])
+        resumen = {estado: 0 for estado in ('creado', 'duplicado', 'error')}
+        for registro in reporte:
+            resumen[registro['estado']] += 1
+        
+        registrar_auditoria(
+            id_usuario=g.userinfo.get('sub'),
+            accion='importar_estudiantes',
+            entidad_afectada='usuarios',
+            id_entidad=None,
+            detalles=(f"Importación {archivo.filename}: {resumen['creado']} creados, "
+                      f"{resumen['duplicado']} duplicados, {resumen['error']} con error")
+        )
+        
+        if formato == 'csv':
+            salida = io.StringIO()
+            escritor = csv.DictWriter(salida, fieldnames=COLUMNAS_REPORTE_IMPORTACION)
+            escritor.writeheader()
+            escritor.writerows(reporte)
+            return Response(
+                '\ufeff' + salida.getvalue(),
+                mimetype='text/csv',
+                headers={'Content-Disposition': 'attachment; filename=reporte_importacion_estudiantes.csv'}
+            )
+        
+        return jsonify({
+            'success': True,
+            'message': 'Importación completada',
+            'rows': len(reporte),
+            'created': resumen['creado'],
+            'duplicates': resumen['duplicado'],
+            'failed': resumen['error'],
+            'report': reporte
+        }), 200 if resumen['creado'] == len(reporte) else 207
+        
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ Error en import_students_admin: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @app.route('/admin/students/<student_id>', methods=['PUT'])
 @token_required('administrador')
 def update_student_admin(student_id):
@@ -868,6 +1201,7 @@ def update_student_admin(student_id):
             actualizacion['fecha_nacimiento'] = datetime.fromisoformat(actualizacion['fecha_nacimiento'])
         
         usuarios.update_one({'_id': student_obj_id}, {'$set': actualizacion})
+        invalidar_usuario(student_obj_id)
         
         registrar_auditoria(
             id_usuario=g.userinfo.get('sub'),
@@ -902,6 +1236,7 @@ def delete_student_admin(student_id):
             return jsonify({'success': False, 'error': 'Estudiante no encontrado'}), 404
         
         usuarios.update_one({'_id': student_obj_id}, {'$set': {'activo': False}})
+        invalidar_usuario(student_obj_id)
         
         registrar_auditoria(
             id_usuario=g.userinfo.get('sub'),
@@ -948,7 +1283,14 @@ def get_all_enrollments_admin():
             query['periodo'] = periodo
         
         # ✅ Buscar matrículas (estudiante → grupo)
-        matriculas_list = list(matriculas.find(query))
+        # Por defecto sin las notas: son la mayor parte del tamaño de cada matrícula
+        proyeccion = leer_proyeccion(request.args, por_defecto={'calificaciones': 0})
+        formato = leer_formato_stream(request.args)
+        if formato:
+            cursor = cursor_listado(matriculas, query, projection=proyeccion)
+            return responder_stream(cursor, formato, clave='enrollments')
+        
+        matriculas_list, paginacion = paginar(matriculas, query, request.args, projection=proyeccion)
         
         print(f"✅ Query: {query}")
         print(f"✅ Encontradas {len(matriculas_list)} matrículas")
@@ -960,10 +1302,13 @@ def get_all_enrollments_admin():
         
         return jsonify({
             'success': True,
-            'enrollments': serialize_doc(matriculas_list),
-            'count': len(matriculas_list)
+            'enrollments': matriculas_list,
+            'count': len(matriculas_list),
+            **paginacion
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         print(f"❌ Error en get_all_enrollments_admin: {e}")
         import traceback
@@ -1039,13 +1384,19 @@ def create_enrollment_admin():
         }):
             return jsonify({'success': False, 'error': 'El estudiante ya está matriculado en este grupo'}), 400
         
+        # Una matrícula activa ocupa cupo: se reserva antes de crearla
+        estado = data.get('estado', 'activa')
+        ocupa_cupo = es_activa(estado)
+        if ocupa_cupo and not reservar_cupos(grupos, group_obj_id, 1):
+            return jsonify({'success': False, 'error': 'El grupo ha alcanzado su capacidad máxima'}), 400
+        
         # Crear matrícula
         nueva_matricula = {
             'id_estudiante': student_obj_id,
             'id_grupo': group_obj_id,
             'anio_lectivo': anio_lectivo,
             'fecha_matricula': Timestamp(int(datetime.utcnow().timestamp()), 0),
-            'estado': data.get('estado', 'activa'),
+            'estado': estado,
             'calificaciones': [],
             'estudiante_info': {
                 'nombres': estudiante.get('nombres'),
@@ -1060,7 +1411,13 @@ def create_enrollment_admin():
             'observaciones_admin': data.get('observaciones', '')
         }
         
-        resultado = matriculas.insert_one(nueva_matricula)
+        creada = False
+        try:
+            resultado = matriculas.insert_one(nueva_matricula)
+            creada = True
+        finally:
+            if ocupa_cupo and not creada:
+                liberar_cupos(grupos, group_obj_id, 1)
         
         registrar_auditoria(
             id_usuario=g.userinfo.get('sub'),
@@ -1123,7 +1480,34 @@ def update_enrollment_status(enrollment_id):
         if 'observaciones_admin' in data:
             actualizacion['observaciones_admin'] = data['observaciones_admin']
         
-        matriculas.update_one({'_id': enrollment_obj_id}, {'$set': actualizacion})
+        # Pasar a activa ocupa un cupo del grupo y dejar de estarlo lo libera
+        activa_antes = es_activa(matricula.get('estado'))
+        activa_despues = es_activa(estado_nuevo)
+        id_grupo = matricula.get('id_grupo')
+        grupos = get_groups_collection()
+        reservado = False
+        if id_grupo and activa_despues and not activa_antes:
+            if not reservar_cupos(grupos, id_grupo, 1):
+                return jsonify({'success': False, 'error': 'El grupo ha alcanzado su capacidad máxima'}), 400
+            reservado = True
+        
+        # Solo si el estado no cambió desde la lectura, para no contar dos veces el cupo
+        actualizada = False
+        try:
+            actualizada = matriculas.update_one(
+                {'_id': enrollment_obj_id, 'estado': matricula.get('estado')},
+                {'$set': actualizacion}
+            ).matched_count > 0
+        finally:
+            if reservado and not actualizada:
+                liberar_cupos(grupos, id_grupo, 1)
+        if not actualizada:
+            return jsonify({
+                'success': False,
+                'error': 'La matrícula cambió de estado mientras se actualizaba, intente de nuevo'
+            }), 409
+        if id_grupo and activa_antes and not activa_despues:
+            liberar_cupos(grupos, id_grupo, 1)
         
         registrar_auditoria(
             id_usuario=g.userinfo.get('sub'),
@@ -1656,11 +2040,13 @@ def report_performance_by_course():
     try:
         matriculas = get_matriculas_collection()
         
-        # Estructura actual: calificaciones[].notas[] por id_asignacion
+        # Estructura actual: calificaciones[].notas[] por id_asignacion. Cada
+        # bloque trae sus sumas (sum_nota, n_notas), así que no se despliegan
+        # las notas; los bloques aún sin resumen se suman al vuelo
         pipeline = [
             {'$match': {'estado': {'$in': ['activa', 'activo']}, 'calificaciones': {'$exists': True, '$ne': []}}},
             {'$unwind': '$calificaciones'},
-            {'$unwind': '$calificaciones.notas'},
+            {'$match': {'calificaciones.notas.0': {'$exists': True}}},
             {'$lookup': {
                 'from': 'asignaciones_docentes',
                 'localField': 'calificaciones.id_asignacion',
@@ -1674,8 +2060,12 @@ def report_performance_by_course():
                     'nombre_curso': '$asig.curso_info.nombre_curso',
                     'codigo_curso': '$asig.curso_info.codigo_curso'
                 },
-                'promedio': {'$avg': '$calificaciones.notas.nota'},
-                'total_calificaciones': {'$sum': 1},
+                'suma_notas': {'$sum': {'$ifNull': [
+                    '$calificaciones.sum_nota', {'$sum': '$calificaciones.notas.nota'}
+                ]}},
+                'total_calificaciones': {'$sum': {'$ifNull': [
+                    '$calificaciones.n_notas', {'$size': '$calificaciones.notas'}
+                ]}},
                 'total_estudiantes': {'$addToSet': '$id_estudiante'}
             }},
             {'$project': {
@@ -1683,7 +2073,7 @@ def report_performance_by_course():
                 'curso_id': '$_id.curso_id',
                 'nombre_curso': '$_id.nombre_curso',
                 'codigo_curso': '$_id.codigo_curso',
-                'promedio': {'$round': ['$promedio', 2]},
+                'promedio': {'$round': [{'$divide': ['$suma_notas', '$total_calificaciones']}, 2]},
                 'total_calificaciones': 1,
                 'total_estudiantes': {'$size': '$total_estudiantes'}
             }},
@@ -1915,7 +2305,10 @@ def get_all_teachers_admin():
             query['activo'] = (estado == 'activo')
         
         # Obtener docentes
-        teachers = list(usuarios.find(query).sort('apellidos', 1))
+        teachers, paginacion = paginar(
+            usuarios, query, request.args, orden='apellidos',
+            projection=leer_proyeccion(request.args)
+        )
         
         # Para cada docente, contar cursos asignados
         for teacher in teachers:
@@ -1925,10 +2318,13 @@ def get_all_teachers_admin():
         
         return jsonify({
             'success': True,
-            'teachers': serialize_doc(teachers),
-            'count': len(teachers)
+            'teachers': teachers,
+            'count': len(teachers),
+            **paginacion
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
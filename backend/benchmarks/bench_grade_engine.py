@@ -0,0 +1,136 @@
+"""
+Microbenchmark: cálculo de una planilla de calificaciones con los ciclos por
+estudiante frente al motor de database/grade_engine.py
+
+Genera un curso con la forma real de las matrículas (un bloque de notas por
+periodo, con el resumen sum_nota_peso/sum_peso/n_notas/promedio que mantienen
+las escrituras) y mide el cálculo completo de la planilla: promedio ponderado,
+promedio por periodo, definitiva y aprobado de cada estudiante. También mide
+el motor con bloques sin resumen (datos anteriores al backfill).
+
+Uso:
+    python benchmarks/bench_grade_engine.py [estudiantes] [evaluaciones] [repeticiones]
+"""
+
+import sys
+import os
+import random
+import timeit
+import importlib.util
+
+# El motor no depende de MongoDB: se carga directamente desde su archivo
+RUTA_MOTOR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'database', 'grade_engine.py'))
+_spec = importlib.util.spec_from_file_location('grade_engine', RUTA_MOTOR)
+grade_engine = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(grade_engine)
+
+PERIODOS = ('1', '2', '3')
+
+
+def generar_filas(estudiantes, evaluaciones, rng):
+    """Una fila por estudiante con sus evaluaciones repartidas en los periodos"""
+    filas = []
+    for estudiante in range(estudiantes):
+        bloques = []
+        for indice, periodo in enumerate(PERIODOS):
+            cantidad = evaluaciones // len(PERIODOS) + (1 if indice < evaluaciones % len(PERIODOS) else 0)
+            notas = [
+                {
+                    'tipo': f'Evaluación {n + 1}',
+                    'nota': round(rng.uniform(1.0, 5.0), 1),
+                    'nota_maxima': 5.0,
+                    'peso': rng.choice((0.1, 0.2, 0.3)),
+                    'comentarios': ''
+                }
+                for n in range(cantidad)
+            ]
+            sum_nota_peso = sum(n['nota'] * n['peso'] for n in notas)
+            sum_peso = sum(n['peso'] for n in notas)
+            bloques.append({
+                'periodo': periodo,
+                'notas': notas,
+                'sum_nota_peso': sum_nota_peso,
+                'sum_peso': sum_peso,
+                'n_notas': len(notas),
+                'promedio': sum_nota_peso / sum_peso if sum_peso > 0 else 0
+            })
+        filas.append((estudiante, bloques))
+    return filas
+
+
+def ciclos(filas):
+    """Cálculo como lo hacían los servicios: ciclos anidados por estudiante"""
+    resultados = []
+    for _, bloques in filas:
+        total = 0
+        total_peso = 0
+        periodos = {}
+        for bloque in bloques:
+            notas = bloque.get('notas', [])
+            if not notas:
+                continue
+            suma = sum(n.get('nota', 0) * n.get('peso', 0) for n in notas)
+            peso = sum(n.get('peso', 0) for n in notas)
+            total += suma
+            total_peso += peso
+            periodos[bloque.get('periodo') or '1'] = suma / peso if peso > 0 else 0
+        promedio = grade_engine._redondear(total / total_peso) if total_peso > 0 else 0.0
+        final = sum(periodos.values()) / len(periodos) if periodos else 0.0
+        resultados.append({
+            'promedio': promedio,
+            'n_notas': sum(len(b.get('notas', [])) for b in bloques),
+            'periodos': {p: grade_engine._redondear(v) for p, v in periodos.items()},
+            'final': grade_engine._redondear(final),
+            'aprobado': promedio >= grade_engine.NOTA_APROBACION
+        })
+    return resultados
+
+
+def main():
+    estudiantes = int(sys.argv[1]) if len(sys.argv) > 1 else 45
+    evaluaciones = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    repeticiones = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    filas = generar_filas(estudiantes, evaluaciones, random.Random(42))
+    sin_resumen = [
+        (clave, [{'periodo': b['periodo'], 'notas': b['notas']} for b in bloques])
+        for clave, bloques in filas
+    ]
+    numpy = grade_engine.np
+
+    def motor_python(datos):
+        grade_engine.np = None
+        try:
+            return grade_engine.calcular_planilla(datos).resultados()
+        finally:
+            grade_engine.np = numpy
+
+    estrategias = [
+        ('ciclos por estudiante', lambda: ciclos(filas)),
+        ('motor (Python)', lambda: motor_python(filas)),
+        ('motor sin resumen (Py)', lambda: motor_python(sin_resumen))
+    ]
+    if numpy is not None:
+        estrategias += [
+            ('motor (NumPy)', lambda: grade_engine.calcular_planilla(filas).resultados()),
+            ('motor sin resumen (Np)', lambda: grade_engine.calcular_planilla(sin_resumen).resultados())
+        ]
+    else:
+        print("ℹ️  NumPy no está instalado; se omite esa variante")
+
+    # Todas las estrategias deben producir los mismos resultados
+    referencia = estrategias[0][1]()
+    for nombre, funcion in estrategias[1:]:
+        assert funcion() == referencia, f"Resultados distintos en {nombre}"
+
+    print(f"📊 {estudiantes} estudiantes × {evaluaciones} evaluaciones, "
+          f"{repeticiones} repeticiones (mejor tiempo por planilla)")
+    base = None
+    for nombre, funcion in estrategias:
+        mejor = min(timeit.repeat(funcion, number=1, repeat=repeticiones))
+        base = base or mejor
+        print(f"   {nombre:<24} {mejor * 1000:9.3f} ms   x{base / mejor:.2f}")
+
+
+if __name__ == '__main__':
+    main()
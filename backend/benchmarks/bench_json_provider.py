@@ -0,0 +1,104 @@
+"""
+Microbenchmark: serialize_doc + json.dumps frente al proveedor JSON con tipos BSON
+
+Genera matrículas con la forma real (estudiante_info, grupo_info y
+calificaciones por asignación y periodo) y mide el tiempo de codificar una
+respuesta de listado completa con cada estrategia.
+
+Uso:
+    python benchmarks/bench_json_provider.py [num_matriculas] [repeticiones]
+"""
+
+import sys
+import os
+import json
+import random
+import timeit
+from datetime import datetime, timedelta
+
+# Agregar el path del backend para importar database
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bson import ObjectId
+from bson.timestamp import Timestamp
+
+from database.db_config import serialize_doc
+from database import json_provider
+
+
+def generar_matricula(asignaciones, rng):
+    """Matrícula con 4 periodos de notas para cada asignación del grupo"""
+    base = datetime(2025, 2, 1)
+    calificaciones = []
+    for id_asignacion in asignaciones:
+        for periodo in ('1', '2', '3', '4'):
+            calificaciones.append({
+                'id_asignacion': id_asignacion,
+                'periodo': periodo,
+                'notas': [
+                    {
+                        'tipo': tipo,
+                        'nota': round(rng.uniform(1.0, 5.0), 1),
+                        'nota_maxima': 5.0,
+                        'peso': peso,
+                        'fecha_eval': base + timedelta(days=rng.randint(0, 300)),
+                        'comentarios': 'Evaluación del periodo'
+                    }
+                    for tipo, peso in (('Parcial', 0.3), ('Taller', 0.3), ('Final', 0.4))
+                ]
+            })
+    return {
+        '_id': ObjectId(),
+        'id_estudiante': ObjectId(),
+        'id_grupo': ObjectId(),
+        'estado': 'activa',
+        'anio_lectivo': '2025',
+        'fecha_matricula': Timestamp(int(base.timestamp()), 1),
+        'estudiante_info': {
+            'nombres': 'Ana María',
+            'apellidos': 'Gómez Pérez',
+            'codigo_est': f"EST{rng.randint(1000, 9999)}",
+            'correo': 'ana.gomez@colegio.edu.co'
+        },
+        'grupo_info': {'nombre_grupo': '10A', 'grado': '10', 'jornada': 'mañana'},
+        'calificaciones': calificaciones
+    }
+
+
+def main():
+    num_matriculas = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeticiones = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    rng = random.Random(42)
+    asignaciones = [ObjectId() for _ in range(8)]
+    matriculas = [generar_matricula(asignaciones, rng) for _ in range(num_matriculas)]
+    respuesta = {'success': True, 'count': num_matriculas}
+
+    def actual():
+        return json.dumps({**respuesta, 'enrollments': serialize_doc(matriculas)}, separators=(',', ':'))
+
+    def proveedor_stdlib():
+        return json.dumps({**respuesta, 'enrollments': matriculas},
+                          default=json_provider.bson_default, separators=(',', ':'))
+
+    estrategias = [('serialize_doc + json', actual), ('proveedor (json)', proveedor_stdlib)]
+    if json_provider.orjson is not None:
+        estrategias.append(('proveedor (orjson)', lambda: json_provider.dumps_bson({**respuesta, 'enrollments': matriculas})))
+    else:
+        print("ℹ️  orjson no está instalado; se omite esa variante")
+
+    # Las tres estrategias deben producir el mismo JSON
+    referencia = json.loads(actual())
+    for nombre, funcion in estrategias[1:]:
+        assert json.loads(funcion()) == referencia, f"Salida distinta en {nombre}"
+
+    print(f"📊 {num_matriculas} matrículas, {repeticiones} repeticiones (mejor tiempo)")
+    base = None
+    for nombre, funcion in estrategias:
+        mejor = min(timeit.repeat(funcion, number=1, repeat=repeticiones))
+        base = base or mejor
+        print(f"   {nombre:<24} {mejor * 1000:9.1f} ms   x{base / mejor:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,19 +4,32 @@ from datetime import datetime
 from bson.timestamp import Timestamp
 from keycloak import KeycloakOpenID
 from functools import wraps
+import jwt as pyjwt
 import sys
 import os
 
 # Agregar path del backend
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from database.db_config import (
+    DatabaseConfig,
+    estadisticas_auditoria,
     get_cursos_collection,
     serialize_doc,
     string_to_objectid,
     registrar_auditoria
 )
+from database.api_utils import (
+    paginar,
+    leer_proyeccion,
+    leer_formato_stream,
+    cursor_listado,
+    responder_stream
+)
+from database.json_provider import BSONJSONProvider
+from database.keycloak_auth import obtener_proveedor_claves, roles_del_token
 
 app = Flask(__name__)
+app.json = BSONJSONProvider(app)
 app.secret_key = "CoursesService"
 CORS(app)
 
@@ -38,36 +51,29 @@ if KeycloakOpenID is not None:
     except Exception:
         keycloak_openid = None
 
+# Claves de firma del realm en caché (verificación de tokens sin red)
+proveedor_claves = obtener_proveedor_claves(KEYCLOAK_SERVER, KEYCLOAK_REALM)
+
 
 def tiene_rol(token_info, cliente_id, rol_requerido):
     """Comprueba si los claims del token contienen el rol requerido.
 
-    Busca tanto en realm_access como en resource_access[cliente_id].
+    Usa el conjunto de roles (realm_access + todos los resource_access)
+    precalculado al verificar el token; `rol_requerido` puede ser str o lista.
     """
     try:
-        # 1. Buscar en realm_access (roles globales del realm)
-        realm_roles = token_info.get('realm_access', {}).get('roles', [])
-        if rol_requerido in realm_roles:
-            print(f"✓ Rol '{rol_requerido}' encontrado en realm_access")
-            return True
-        
-        # 2. Buscar en resource_access para el cliente específico
-        if cliente_id and cliente_id in token_info.get('resource_access', {}):
-            client_roles = token_info.get('resource_access', {}).get(cliente_id, {}).get('roles', [])
-            if rol_requerido in client_roles:
-                print(f"✓ Rol '{rol_requerido}' encontrado en resource_access[{cliente_id}]")
-                return True
-        
-        # 3. Buscar en TODOS los clientes (fallback)
-        resource_access = token_info.get('resource_access', {})
-        for client_id, client_data in resource_access.items():
-            client_roles = client_data.get('roles', [])
-            if rol_requerido in client_roles:
-                print(f"✓ Rol '{rol_requerido}' encontrado en resource_access[{client_id}]")
-                return True
-        
-        print(f"✗ Rol '{rol_requerido}' NO encontrado. Realm roles: {realm_roles}, Resource access: {list(resource_access.keys())}")
-        return False
+        roles = getattr(token_info, 'roles_set', None)
+        if roles is None:
+            roles = roles_del_token(token_info)
+
+        if isinstance(rol_requerido, str):
+            encontrado = rol_requerido in roles
+        else:
+            encontrado = not roles.isdisjoint(rol_requerido)
+
+        if not encontrado:
+            print(f"✗ Rol '{rol_requerido}' NO encontrado. Roles del token: {sorted(roles)}")
+        return encontrado
         
     except Exception as e:
         print(f"Error al verificar rol: {e}")
@@ -100,18 +106,9 @@ def token_required(rol_requerido):
                 
                 # Intentar decodificar con Keycloak (modo producción)
                 try:
-                    public_key_pem = f"-----BEGIN PUBLIC KEY-----\n{keycloak_openid.public_key()}\n-----END PUBLIC KEY-----"
-                    
-                    userinfo = keycloak_openid.decode_token(
-                        token,
-                        key=public_key_pem,
-                        options={
-                            "verify_signature": True,
-                            "verify_aud": False,
-                            "verify_exp": True
-                        }
-                    )
-                    print(f"✅ Token decodificado con Keycloak")
+                    # Verificación local con las claves JWKS en caché (sin ir a Keycloak)
+                    userinfo = proveedor_claves.verificar(token)
+                    print(f"✅ Token verificado con JWKS en caché")
                     print(f"   Usuario: {userinfo.get('preferred_username', 'N/A')}")
                     print(f"   Email: {userinfo.get('email', 'N/A')}")
                     
@@ -150,7 +147,7 @@ def token_required(rol_requerido):
 @app.route('/health', methods=['GET'])
 def health():
     """Health check"""
-    return jsonify({'status': 'healthy', 'service': 'courses'}), 200
+    return jsonify({'status': 'healthy', 'service': 'courses', 'auth_keys': proveedor_claves.stats(), 'db_pool': DatabaseConfig.estadisticas_pool(), 'audit': estadisticas_auditoria()}), 200
 
 
 @app.route('/courses', methods=['GET'])
@@ -173,14 +170,23 @@ def get_courses():
         if area:
             query['area'] = area
         
-        cursos_list = list(cursos.find(query))
+        proyeccion = leer_proyeccion(request.args)
+        formato = leer_formato_stream(request.args)
+        if formato:
+            cursor = cursor_listado(cursos, query, projection=proyeccion)
+            return responder_stream(cursor, formato, clave='data')
+        
+        cursos_list, paginacion = paginar(cursos, query, request.args, projection=proyeccion)
         
         return jsonify({
             'success': True,
-            'data': serialize_doc(cursos_list),
-            'count': len(cursos_list)
+            'data': cursos_list,
+            'count': len(cursos_list),
+            **paginacion
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         print(f"❌ Error en get_courses: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -0,0 +1,232 @@
+"""
+Utilidades compartidas por los endpoints de listado de los servicios.
+
+Paginación por cursor (keyset): en lugar de `skip`, cada página continúa
+después del último documento devuelto usando la clave de orden declarada y
+`_id` como desempate, de modo que el costo de una página no depende del
+tamaño de la colección. Se activa solo si la petición trae `limit` o `after`;
+sin ellos los endpoints conservan la respuesta completa de siempre.
+
+Proyección de campos: `fields=a,b.c` limita los campos que devuelve MongoDB;
+cada endpoint puede declarar una proyección por defecto (p. ej. excluir
+`calificaciones`) y `fields=*` pide el documento completo.
+
+Streaming: `stream=ndjson` (un documento por línea) o `stream=json` (el mismo
+sobre `{"success": true, "<clave>": [...], "count": n}` de siempre) recorren el
+cursor por lotes y serializan documento a documento, sin cargar el resultado
+completo en memoria. Está pensado para exportaciones: ignora `limit`/`after`.
+"""
+
+import base64
+import json
+import os
+import re
+
+from bson import json_util
+from flask import Response, stream_with_context
+
+from .json_provider import dumps_bson
+
+LIMITE_POR_DEFECTO = 50
+LIMITE_MAXIMO = 500
+
+TAMANO_LOTE_STREAM = int(os.getenv('STREAM_BATCH_SIZE', '500'))
+TAMANO_CHUNK_STREAM = 64 * 1024
+FORMATOS_STREAM = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json'
+}
+
+
+_CAMPO_VALIDO = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z0-9_]+)*$')
+
+
+def leer_proyeccion(args, por_defecto=None, parametro='fields'):
+    """
+    Construye la proyección de MongoDB a partir de `fields` (lista separada por
+    comas). Sin el parámetro devuelve `por_defecto`; con `*` devuelve None
+    (documento completo). Lanza ValueError si algún nombre de campo es inválido.
+    """
+    valor = args.get(parametro)
+    if valor is None or not valor.strip():
+        return por_defecto
+    if valor.strip() == '*':
+        return None
+
+    campos = [c.strip() for c in valor.split(',') if c.strip()]
+    invalidos = [c for c in campos if not _CAMPO_VALIDO.match(c)]
+    if invalidos:
+        raise ValueError(f"Campos inválidos en {parametro}: {', '.join(invalidos)}")
+    return {campo: 1 for campo in campos}
+
+
+def _es_inclusion(projection):
+    return bool(projection) and any(v for k, v in projection.items() if k != '_id')
+
+
+def _codificar_cursor(valor, _id):
+    datos = json_util.dumps({'v': valor, 'id': _id})
+    return base64.urlsafe_b64encode(datos.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decodificar_cursor(cursor):
+    try:
+        relleno = '=' * (-len(cursor) % 4)
+        datos = json_util.loads(base64.urlsafe_b64decode(cursor + relleno).decode('utf-8'))
+        return datos['v'], datos['id']
+    except Exception:
+        raise ValueError('Parámetro after inválido')
+
+
+def _valor_campo(doc, campo):
+    """Lee un campo con notación de punto (p. ej. 'grupo_info.grado')"""
+    valor = doc
+    for parte in campo.split('.'):
+        if not isinstance(valor, dict):
+            return None
+        valor = valor.get(parte)
+    return valor
+
+
+def _filtro_despues_de(campo, direccion, valor, _id):
+    """Condición keyset para continuar después de (valor, _id) en el orden dado"""
+    op = '$gt' if direccion == 1 else '$lt'
+    if campo == '_id':
+        return {'_id': {op: _id}}
+
+    if valor is None:
+        # Los nulos van primero en orden ascendente y al final en descendente
+        condiciones = [{campo: None, '_id': {op: _id}}]
+        if direccion == 1:
+            condiciones.append({campo: {'$ne': None}})
+        return {'$or': condiciones}
+
+    condiciones = [
+        {campo: {op: valor}},
+        {campo: valor, '_id': {op: _id}}
+    ]
+    if direccion == -1:
+        condiciones.append({campo: None})
+    return {'$or': condiciones}
+
+
+def leer_paginacion(args):
+    """
+    Lee `limit` y `after` de los parámetros de la petición. Devuelve None si la
+    petición no pide paginación, o (limit, cursor_decodificado_o_None).
+    Lanza ValueError si los parámetros son inválidos.
+    """
+    limit = args.get('limit')
+    after = args.get('after')
+    if limit is None and after is None:
+        return None
+
+    try:
+        limit = int(limit) if limit is not None else LIMITE_POR_DEFECTO
+    except ValueError:
+        raise ValueError('Parámetro limit inválido')
+    if limit < 1:
+        raise ValueError('Parámetro limit inválido')
+
+    return min(limit, LIMITE_MAXIMO), (_decodificar_cursor(after) if after else None)
+
+
+def _orden_listado(orden, direccion):
+    return [(orden, direccion)] if orden == '_id' else [(orden, direccion), ('_id', direccion)]
+
+
+def paginar(coleccion, query, args, orden='_id', direccion=1, projection=None):
+    """
+    Ejecuta la consulta de un listado y devuelve (documentos, meta).
+
+    - Sin `limit`/`after` devuelve todos los documentos (ordenados por `orden`).
+    - Con paginación devuelve como máximo `limit` documentos y en `meta`
+      `next_cursor` (None en la última página) y `has_more`.
+    - `count=true` agrega `total` con un conteo independiente de la página.
+    """
+    sort = _orden_listado(orden, direccion)
+    meta = {}
+
+    # El cursor necesita la clave de orden aunque el cliente no la haya pedido
+    if _es_inclusion(projection) and orden not in projection:
+        projection = {**projection, orden: 1}
+    paginacion = leer_paginacion(args)
+
+    if paginacion is None:
+        docs = list(coleccion.find(query, projection).sort(sort))
+    else:
+        limit, despues = paginacion
+        filtro = query
+        if despues is not None:
+            filtro = {'$and': [query, _filtro_despues_de(orden, direccion, *despues)]} if query \
+                else _filtro_despues_de(orden, direccion, *despues)
+
+        # Se pide un documento extra solo para saber si hay más páginas
+        docs = list(coleccion.find(filtro, projection).sort(sort).limit(limit + 1))
+        has_more = len(docs) > limit
+        docs = docs[:limit]
+
+        meta['has_more'] = has_more
+        meta['next_cursor'] = (
+            _codificar_cursor(_valor_campo(docs[-1], orden), docs[-1]['_id'])
+            if has_more else None
+        )
+
+    if args.get('count', '').lower() == 'true':
+        meta['total'] = coleccion.count_documents(query) if query else coleccion.estimated_document_count()
+
+    return docs, meta
+
+
+def leer_formato_stream(args):
+    """Devuelve 'ndjson', 'json' o None según el parámetro `stream`"""
+    formato = args.get('stream')
+    if not formato:
+        return None
+    formato = formato.lower()
+    if formato not in FORMATOS_STREAM:
+        raise ValueError(f"Parámetro stream inválido (use {' o '.join(FORMATOS_STREAM)})")
+    return formato
+
+
+def cursor_listado(coleccion, query, orden='_id', direccion=1, projection=None):
+    """Cursor completo del listado, ordenado y con el tamaño de lote del streaming"""
+    return coleccion.find(query, projection).sort(_orden_listado(orden, direccion)) \
+        .batch_size(TAMANO_LOTE_STREAM)
+
+
+def responder_stream(cursor, formato, clave='data', transformar=None):
+    """
+    Respuesta Flask que serializa y envía los documentos del cursor a medida que
+    llegan, agrupados en bloques de ~64 KB.
+    """
+    def generar():
+        bloque = []
+        tamano = 0
+        total = 0
+        try:
+            if formato == 'json':
+                yield '{"success": true, ' + json.dumps(clave) + ': ['
+
+            for doc in cursor:
+                texto = dumps_bson(transformar(doc) if transformar else doc)
+                if formato == 'json':
+                    texto = (',' if total else '') + texto
+                else:
+                    texto += '\n'
+                total += 1
+                bloque.append(texto)
+                tamano += len(texto)
+                if tamano >= TAMANO_CHUNK_STREAM:
+                    yield ''.join(bloque)
+                    bloque = []
+                    tamano = 0
+
+            if bloque:
+                yield ''.join(bloque)
+            if formato == 'json':
+                yield f'], "count": {total}}}'
+        finally:
+            cursor.close()
+
+    return Response(stream_with_context(generar()), mimetype=FORMATOS_STREAM[formato])
@@ -0,0 +1,180 @@
+"""
+Contadores de asistencia por (estudiante, curso, periodo).
+
+Cada grupo tiene su propio registro diario por curso (id_curso, id_grupo, fecha).
+Cada vez que se guarda la asistencia de un día, `actualizar_contadores` compara
+el registro anterior de ese grupo y día con el nuevo y aplica solo la diferencia
+con `$inc`, de modo que volver a guardar un día ya registrado no duplica conteos
+ni toca a los estudiantes de los otros grupos del curso.
+Las estadísticas se leen de los contadores (una fila por estudiante) en lugar
+de recorrer todos los registros diarios del curso.
+
+Si la diferencia no llega a aplicarse, el registro del día queda marcado con
+`contadores_pendientes` y los contadores de su curso se reconstruyen con
+`reconciliar_pendientes` (database/backfill_attendance_counters.py --pendientes).
+"""
+
+from pymongo import UpdateOne
+
+from .db_config import get_asistencia_collection, get_asistencia_contadores_collection
+
+# estado del registro -> campo del contador
+CAMPOS_ESTADO = {
+    'presente': 'presentes',
+    'ausente': 'ausentes',
+    'tarde': 'tardes',
+    'excusa': 'excusas'
+}
+CAMPOS_CONTADOR = ('total_clases',) + tuple(CAMPOS_ESTADO.values())
+
+# Campos del registro diario que necesita el cálculo de diferencias
+PROYECCION_REGISTRO = {
+    '_id': 1, 'id_grupo': 1, 'periodo': 1, 'registros.id_estudiante': 1, 'registros.estado': 1
+}
+
+
+def _conteos(documento):
+    """Conteos por (id_estudiante, periodo) de un registro diario de asistencia"""
+    conteos = {}
+    if not documento:
+        return conteos
+    periodo = documento.get('periodo')
+    for item in documento.get('registros', []):
+        conteo = conteos.setdefault((item['id_estudiante'], periodo), dict.fromkeys(CAMPOS_CONTADOR, 0))
+        conteo['total_clases'] += 1
+        campo = CAMPOS_ESTADO.get(item.get('estado', 'presente'))
+        if campo:
+            conteo[campo] += 1
+    return conteos
+
+
+def actualizar_contadores(id_curso, anterior, nuevo):
+    """
+    Aplica a los contadores la diferencia entre el registro diario `anterior`
+    (None si el día es nuevo) y `nuevo`, ambos del mismo grupo. Devuelve
+    cuántos contadores cambió.
+    """
+    if anterior and nuevo and anterior.get('id_grupo') != nuevo.get('id_grupo'):
+        # La diferencia entre grupos distintos descontaría a los estudiantes del otro grupo
+        raise ValueError('Los registros de asistencia comparados son de grupos distintos')
+
+    antes = _conteos(anterior)
+    despues = _conteos(nuevo)
+    info = {item['id_estudiante']: item.get('estudiante_info') for item in (nuevo or {}).get('registros', [])}
+
+    operaciones = []
+    for clave in set(antes) | set(despues):
+        id_estudiante, periodo = clave
+        previo = antes.get(clave, {})
+        actual = despues.get(clave, {})
+        delta = {
+            campo: actual.get(campo, 0) - previo.get(campo, 0)
+            for campo in CAMPOS_CONTADOR
+            if actual.get(campo, 0) != previo.get(campo, 0)
+        }
+        if not delta:
+            continue
+        actualizacion = {'$inc': delta}
+        if info.get(id_estudiante):
+            actualizacion['$set'] = {'estudiante_info': info[id_estudiante]}
+        operaciones.append(UpdateOne(
+            {'id_curso': id_curso, 'periodo': periodo, 'id_estudiante': id_estudiante},
+            actualizacion,
+            upsert=True
+        ))
+
+    if operaciones:
+        get_asistencia_contadores_collection().bulk_write(operaciones, ordered=False)
+    return len(operaciones)
+
+
+def marcar_contadores_pendientes(id_registro, error):
+    """Marca el registro diario cuyo cambio no se aplicó a los contadores"""
+    get_asistencia_collection().update_one(
+        {'_id': id_registro},
+        {'$set': {'contadores_pendientes': True, 'error_contadores': str(error)}}
+    )
+
+
+def hay_contadores_pendientes(id_curso):
+    """Si el curso tiene días cuyo cambio no está en los contadores"""
+    return get_asistencia_collection().find_one(
+        {'id_curso': id_curso, 'contadores_pendientes': True}, {'_id': 1}
+    ) is not None
+
+
+def estadisticas_por_estudiante(id_curso, periodo=None):
+    """
+    Totales por estudiante del curso (todos los periodos, o uno solo) leídos de
+    los contadores. Devuelve una lista de dicts con id_estudiante,
+    estudiante_info y los campos de CAMPOS_CONTADOR.
+    """
+    filtro = {'id_curso': id_curso}
+    if periodo:
+        filtro['periodo'] = periodo
+
+    grupo = {'_id': '$id_estudiante', 'estudiante_info': {'$last': '$estudiante_info'}}
+    grupo.update({campo: {'$sum': f'${campo}'} for campo in CAMPOS_CONTADOR})
+
+    return [
+        {'id_estudiante': fila.pop('_id'), **fila}
+        for fila in get_asistencia_contadores_collection().aggregate([
+            {'$match': filtro},
+            {'$group': grupo},
+            {'$match': {'total_clases': {'$gt': 0}}}
+        ])
+    ]
+
+
+def recalcular_contadores(id_curso=None):
+    """
+    Reconstruye los contadores desde los registros diarios (todos los cursos o
+    uno). Sirve para poblar la colección la primera vez o corregir desvíos.
+    """
+    filtro = {'id_curso': id_curso} if id_curso else {}
+    contadores = get_asistencia_contadores_collection()
+    contadores.delete_many(filtro)
+
+    conteo_estados = {
+        campo: {'$sum': {'$cond': [{'$eq': [{'$ifNull': ['$registros.estado', 'presente']}, estado]}, 1, 0]}}
+        for estado, campo in CAMPOS_ESTADO.items()
+    }
+    get_asistencia_collection().aggregate([
+        {'$match': filtro},
+        {'$unwind': '$registros'},
+        {'$group': {
+            '_id': {
+                'id_curso': '$id_curso',
+                'periodo': '$periodo',
+                'id_estudiante': '$registros.id_estudiante'
+            },
+            'estudiante_info': {'$last': '$registros.estudiante_info'},
+            'total_clases': {'$sum': 1},
+            **conteo_estados
+        }},
+        {'$replaceWith': {'$mergeObjects': ['$_id', {
+            'estudiante_info': '$estudiante_info',
+            'total_clases': '$total_clases',
+            **{campo: f'${campo}' for campo in CAMPOS_ESTADO.values()}
+        }]}},
+        {'$merge': {
+            'into': 'asistencia_contadores',
+            'on': ['id_curso', 'periodo', 'id_estudiante'],
+            'whenMatched': 'replace',
+            'whenNotMatched': 'insert'
+        }}
+    ])
+    # Los contadores reconstruidos ya incluyen los días marcados como pendientes
+    get_asistencia_collection().update_many(
+        {**filtro, 'contadores_pendientes': True},
+        {'$unset': {'contadores_pendientes': '', 'error_contadores': ''}}
+    )
+    return contadores.count_documents(filtro)
+
+
+def reconciliar_pendientes():
+    """Reconstruye los contadores de los cursos con días pendientes. Devuelve cuántos cursos"""
+    cursos = get_asistencia_collection().distinct('id_curso', {'contadores_pendientes': True})
+    for id_curso in cursos:
+        recalcular_contadores(id_curso)
+    return len(cursos)
@@ -0,0 +1,58 @@
+"""
+Script de mantenimiento de la auditoría particionada por mes
+
+Uso:
+    python database/audit_maintenance.py migrar   # mueve `auditoria` a auditoria_AAAA_MM
+    python database/audit_maintenance.py purgar [meses]   # elimina particiones vencidas
+"""
+
+import sys
+import os
+
+# Agregar el path del backend para importar db_config
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from database.audit_store import (
+    RETENCION_MESES,
+    listar_particiones,
+    migrar_historico,
+    purgar_particiones
+)
+
+def migrar():
+    """Mover los registros de la colección histórica a sus particiones"""
+    print("🔄 Migrando auditoría histórica a particiones mensuales...")
+    movidos = migrar_historico()
+    print(f"✅ Registros movidos: {movidos}")
+
+def purgar(meses):
+    """Eliminar las particiones más antiguas que la retención"""
+    print(f"🔄 Eliminando particiones con más de {meses} meses...")
+    eliminadas = purgar_particiones(meses)
+    if eliminadas:
+        for nombre in eliminadas:
+            print(f"   🗑️  {nombre}")
+        print(f"✅ Particiones eliminadas: {len(eliminadas)}")
+    else:
+        print("ℹ️  No hay particiones vencidas")
+
+if __name__ == '__main__':
+    try:
+        comando = sys.argv[1] if len(sys.argv) > 1 else ''
+        if comando == 'migrar':
+            migrar()
+        elif comando == 'purgar':
+            purgar(int(sys.argv[2]) if len(sys.argv) > 2 else RETENCION_MESES)
+        else:
+            print(__doc__)
+            sys.exit(1)
+
+        print("\n📋 Particiones actuales:")
+        for anio, mes, nombre in listar_particiones():
+            print(f"   {nombre}")
+
+    except Exception as e:
+        print(f"❌ Error en el mantenimiento de auditoría: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
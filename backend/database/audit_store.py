@@ -0,0 +1,207 @@
+"""
+Consultas sobre la auditoría particionada por mes (auditoria_AAAA_MM).
+
+Cada registro tiene un `_id` generado al registrarlo, así que un rango de
+fechas es un rango de `_id` y la paginación keyset usa el propio `_id` como
+cursor. Las consultas recorren solo las particiones del rango pedido, de la
+más reciente a la más antigua, y terminan al completar la página. La colección
+histórica `auditoria` se lee al final como la partición más antigua.
+"""
+
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+from .db_config import (
+    DatabaseConfig,
+    get_auditoria_particion,
+    nombre_particion_auditoria,
+    string_to_objectid
+)
+
+COLECCION_HISTORICA = 'auditoria'
+_PATRON_PARTICION = re.compile(r'^auditoria_(\d{4})_(\d{2})$')
+
+RETENCION_MESES = int(os.getenv('AUDIT_RETENTION_MONTHS', '24'))
+
+
+def _a_utc(fecha):
+    if fecha.tzinfo is None:
+        return fecha.replace(tzinfo=timezone.utc)
+    return fecha.astimezone(timezone.utc)
+
+
+def leer_fecha(valor, fin_de_dia=False):
+    """Convierte 'AAAA-MM-DD' o ISO 8601 a datetime UTC; lanza ValueError si es inválida"""
+    if not valor:
+        return None
+    try:
+        fecha = datetime.fromisoformat(valor.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f'Fecha inválida: {valor}')
+    if fin_de_dia and len(valor) == 10:
+        fecha += timedelta(days=1)
+    return _a_utc(fecha)
+
+
+def listar_particiones():
+    """Particiones existentes como lista de (año, mes, nombre), de la más reciente a la más antigua"""
+    nombres = DatabaseConfig.get_db().list_collection_names(
+        filter={'name': {'$regex': r'^auditoria_\d{4}_\d{2}$'}}
+    )
+    particiones = []
+    for nombre in nombres:
+        m = _PATRON_PARTICION.match(nombre)
+        if m:
+            particiones.append((int(m.group(1)), int(m.group(2)), nombre))
+    return sorted(particiones, reverse=True)
+
+
+def _colecciones_en_rango(desde, hasta):
+    """Nombres de las colecciones a consultar para [desde, hasta), más reciente primero"""
+    nombres = []
+    for anio, mes, nombre in listar_particiones():
+        if desde and (anio, mes) < (desde.year, desde.month):
+            continue
+        if hasta and (anio, mes) > (hasta.year, hasta.month):
+            continue
+        nombres.append(nombre)
+    nombres.append(COLECCION_HISTORICA)
+    return nombres
+
+
+def _filtro(desde, hasta, id_usuario=None, entidad=None, accion=None, antes_de=None):
+    filtro = {}
+    rango_id = {}
+    if desde:
+        rango_id['$gte'] = ObjectId.from_datetime(desde)
+    if hasta:
+        rango_id['$lt'] = ObjectId.from_datetime(hasta)
+    if antes_de:
+        # Cursor keyset: continuar con los registros anteriores al último devuelto
+        if '$lt' not in rango_id or antes_de < rango_id['$lt']:
+            rango_id['$lt'] = antes_de
+    if rango_id:
+        filtro['_id'] = rango_id
+    if id_usuario:
+        filtro['id_usuario'] = string_to_objectid(id_usuario) or id_usuario
+    if entidad:
+        filtro['entidad_afectada'] = entidad
+    if accion:
+        filtro['accion'] = accion
+    return filtro
+
+
+def consultar_auditoria(desde=None, hasta=None, id_usuario=None, entidad=None,
+                        accion=None, limit=100, after=None):
+    """
+    Registros de auditoría del más reciente al más antiguo.
+
+    Devuelve (logs, next_cursor); `next_cursor` es el `_id` (str) del último
+    registro devuelto, o None si no hay más.
+    """
+    antes_de = None
+    if after:
+        antes_de = string_to_objectid(after)
+        if antes_de is None:
+            raise ValueError('Parámetro after inválido')
+        # Las particiones posteriores al cursor ya se recorrieron
+        fin_cursor = antes_de.generation_time + timedelta(seconds=1)
+        hasta = min(hasta, fin_cursor) if hasta else fin_cursor
+
+    filtro = _filtro(desde, hasta, id_usuario, entidad, accion, antes_de)
+    db = DatabaseConfig.get_db()
+
+    logs = []
+    for nombre in _colecciones_en_rango(desde, hasta):
+        faltan = limit + 1 - len(logs)
+        if faltan <= 0:
+            break
+        logs.extend(db[nombre].find(filtro).sort('_id', -1).limit(faltan))
+
+    has_more = len(logs) > limit
+    logs = logs[:limit]
+    next_cursor = str(logs[-1]['_id']) if has_more and logs else None
+    return logs, next_cursor
+
+
+def resumen_auditoria(desde=None, hasta=None, id_usuario=None, entidad=None, accion=None):
+    """Cantidad de registros por día (UTC) y acción dentro del rango"""
+    filtro = _filtro(desde, hasta, id_usuario, entidad, accion)
+    pipeline = [
+        {'$match': filtro},
+        {'$group': {
+            '_id': {
+                'dia': {'$dateToString': {'format': '%Y-%m-%d', 'date': {'$toDate': '$_id'}}},
+                'accion': '$accion'
+            },
+            'total': {'$sum': 1}
+        }}
+    ]
+
+    db = DatabaseConfig.get_db()
+    conteos = {}
+    for nombre in _colecciones_en_rango(desde, hasta):
+        for fila in db[nombre].aggregate(pipeline):
+            clave = (fila['_id']['dia'], fila['_id']['accion'])
+            conteos[clave] = conteos.get(clave, 0) + fila['total']
+
+    por_accion = {}
+    for (_, accion_fila), total in conteos.items():
+        por_accion[accion_fila] = por_accion.get(accion_fila, 0) + total
+
+    return {
+        'por_dia': [
+            {'dia': dia, 'accion': accion_fila, 'total': total}
+            for (dia, accion_fila), total in sorted(conteos.items())
+        ],
+        'por_accion': dict(sorted(por_accion.items(), key=lambda item: -item[1])),
+        'total': sum(conteos.values())
+    }
+
+
+def purgar_particiones(meses_retencion=None, ahora=None):
+    """
+    Elimina las particiones completas más antiguas que la retención
+    (AUDIT_RETENTION_MONTHS). Devuelve los nombres eliminados.
+    """
+    meses_retencion = RETENCION_MESES if meses_retencion is None else meses_retencion
+    ahora = _a_utc(ahora or datetime.now(timezone.utc))
+    indice_actual = ahora.year * 12 + (ahora.month - 1)
+
+    db = DatabaseConfig.get_db()
+    eliminadas = []
+    for anio, mes, nombre in listar_particiones():
+        if indice_actual - (anio * 12 + (mes - 1)) >= meses_retencion:
+            db.drop_collection(nombre)
+            eliminadas.append(nombre)
+    return eliminadas
+
+
+def migrar_historico(tamano_lote=1000):
+    """
+    Mueve los registros de la colección `auditoria` a sus particiones mensuales
+    (según la fecha de su `_id`). Es reanudable: borra cada lote después de copiarlo.
+    """
+    db = DatabaseConfig.get_db()
+    historica = db[COLECCION_HISTORICA]
+    movidos = 0
+    while True:
+        lote = list(historica.find({}).sort('_id', 1).limit(tamano_lote))
+        if not lote:
+            break
+        por_particion = {}
+        for log in lote:
+            por_particion.setdefault(nombre_particion_auditoria(log['_id'].generation_time), []).append(log)
+        for logs in por_particion.values():
+            try:
+                get_auditoria_particion(logs[0]['_id'].generation_time).insert_many(logs, ordered=False)
+            except Exception as e:
+                # Duplicados de una ejecución interrumpida: ya estaban copiados
+                if 'E11000' not in str(e):
+                    raise
+        historica.delete_many({'_id': {'$in': [log['_id'] for log in lote]}})
+        movidos += len(lote)
+    return movidos
@@ -0,0 +1,47 @@
+"""
+Script para poblar (o reconstruir) la colección asistencia_contadores a partir
+de los registros diarios de asistencia
+
+Uso:
+    python database/backfill_attendance_counters.py [id_curso]
+    python database/backfill_attendance_counters.py --pendientes
+
+Con --pendientes solo reconstruye los cursos con días marcados como
+`contadores_pendientes` (guardados cuyo cambio no llegó a los contadores).
+"""
+
+import sys
+import os
+
+# Agregar el path del backend para importar db_config
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from database.db_config import DatabaseConfig, string_to_objectid
+from database.asistencia import recalcular_contadores, reconciliar_pendientes
+
+if __name__ == '__main__':
+    try:
+        pendientes = '--pendientes' in sys.argv[1:]
+        id_curso = None
+        if len(sys.argv) > 1 and not pendientes:
+            id_curso = string_to_objectid(sys.argv[1])
+            if not id_curso:
+                print(f"❌ ID de curso inválido: {sys.argv[1]}")
+                sys.exit(1)
+
+        # El $merge necesita el índice único de la colección de contadores
+        DatabaseConfig.asegurar_indices()
+
+        if pendientes:
+            print("🔄 Reconciliando contadores de asistencia pendientes...")
+            print(f"✅ Cursos reconciliados: {reconciliar_pendientes()}")
+        else:
+            print("🔄 Recalculando contadores de asistencia...")
+            total = recalcular_contadores(id_curso)
+            print(f"✅ Contadores generados: {total}")
+
+    except Exception as e:
+        print(f"❌ Error al recalcular contadores: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
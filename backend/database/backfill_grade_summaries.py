@@ -0,0 +1,41 @@
+"""
+Script para poblar (o recalcular) el resumen de cada bloque de calificaciones
+de las matrículas: sum_nota_peso, sum_peso, sum_nota, n_notas y promedio
+
+Uso:
+    python database/backfill_grade_summaries.py [--todas]
+
+Por defecto solo procesa las matrículas con bloques que aún no tienen resumen;
+con --todas recalcula todos los bloques.
+"""
+
+import sys
+import os
+
+# Agregar el path del backend para importar db_config
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from database.db_config import get_matriculas_collection
+from database.calificaciones import pipeline_recalcular_resumenes
+
+if __name__ == '__main__':
+    try:
+        if '--todas' in sys.argv[1:]:
+            filtro = {'calificaciones.notas': {'$exists': True}}
+        else:
+            filtro = {'calificaciones': {'$elemMatch': {
+                'notas': {'$exists': True},
+                'promedio': {'$exists': False}
+            }}}
+
+        print("🔄 Recalculando resúmenes de calificaciones...")
+        # Una sola actualización con pipeline: el cálculo se hace en el servidor
+        resultado = get_matriculas_collection().update_many(filtro, pipeline_recalcular_resumenes())
+        print(f"📊 Matrículas encontradas: {resultado.matched_count}")
+        print(f"✅ Matrículas actualizadas: {resultado.modified_count}")
+
+    except Exception as e:
+        print(f"❌ Error al recalcular resúmenes: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
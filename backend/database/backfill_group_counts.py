@@ -0,0 +1,38 @@
+"""
+Script para reconciliar el contador de cupos de los grupos
+(grupos.estudiantes_actuales) con sus matrículas activas
+
+Uso:
+    python database/backfill_group_counts.py [id_grupo]
+
+Debe ejecutarse una vez al desplegar la reserva atómica de cupos y cada vez
+que se carguen o modifiquen matrículas por fuera de los servicios.
+"""
+
+import sys
+import os
+
+# Agregar el path del backend para importar db_config
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from database.db_config import get_groups_collection, get_matriculas_collection, string_to_objectid
+from database.grupos import recalcular_estudiantes_actuales
+
+if __name__ == '__main__':
+    try:
+        id_grupo = None
+        if len(sys.argv) > 1:
+            id_grupo = string_to_objectid(sys.argv[1])
+            if not id_grupo:
+                print(f"❌ ID de grupo inválido: {sys.argv[1]}")
+                sys.exit(1)
+
+        print("🔄 Recalculando estudiantes por grupo...")
+        total = recalcular_estudiantes_actuales(get_groups_collection(), get_matriculas_collection(), id_grupo)
+        print(f"✅ Grupos actualizados: {total}")
+
+    except Exception as e:
+        print(f"❌ Error al recalcular estudiantes por grupo: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,399 @@
+"""
+Escritura de calificaciones en matriculas.calificaciones[].notas[].
+
+Cada bloque de calificaciones (una asignación y un periodo) guarda, junto a sus
+notas, un resumen: `sum_nota_peso`, `sum_peso`, `sum_nota`, `n_notas` y
+`promedio` (ponderado). Todas las escrituras se hacen con actualizaciones de pipeline que
+modifican las notas y recalculan el resumen del bloque en la misma operación
+atómica, así las lecturas y los reportes usan `promedio` sin recorrer las notas.
+
+Las cargas masivas resuelven primero todas las matrículas con una sola consulta
+`$in`, validan en memoria y acumulan las escrituras en un `LoteCalificaciones`,
+que las envía en un único `bulk_write(ordered=False)`; el resultado de cada
+operación se traduce de vuelta a las entradas de la petición que la originaron.
+
+Cada escritura se registra además como evento en el historial (notas_ledger):
+los arreglos embebidos son una proyección que `reconstruir_calificaciones`
+puede regenerar, y `notas_a_la_fecha` da las notas vigentes en una fecha.
+"""
+
+import os
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .notas_ledger import consultar_eventos, evento_nota, registrar_eventos, reproducir
+
+TAMANO_LOTE_CALIFICACIONES = int(os.getenv('GRADES_BULK_BATCH_SIZE', '500'))
+
+# Escala por defecto de una nota (0 - NOTA_MAXIMA) cuando la petición no la indica
+NOTA_MAXIMA = 5.0
+
+
+def nueva_nota(tipo, nota, peso, comentarios='', nota_maxima=NOTA_MAXIMA):
+    """Documento de una nota dentro de calificaciones[].notas[]"""
+    return {
+        'id_nota': ObjectId(),
+        'tipo': tipo,
+        'nota': nota,
+        'nota_maxima': nota_maxima,
+        'peso': peso,
+        'fecha_eval': datetime.utcnow(),
+        'comentarios': comentarios
+    }
+
+
+def proyeccion_bloque(id_asignacion, periodo, campos=None):
+    """
+    Proyección que trae de cada matrícula solo el bloque de la asignación y
+    periodo indicados (o ninguno si aún no existe).
+    """
+    proyeccion = {campo: 1 for campo in (campos or [])}
+    proyeccion['calificaciones'] = {
+        '$elemMatch': {'id_asignacion': id_asignacion, 'periodo': periodo}
+    }
+    return proyeccion
+
+
+def buscar_bloque(matricula, id_asignacion, periodo):
+    """Bloque de calificaciones de la matrícula para la asignación y periodo, o None"""
+    for bloque in matricula.get('calificaciones') or []:
+        if bloque.get('id_asignacion') == id_asignacion and bloque.get('periodo') == periodo:
+            return bloque
+    return None
+
+
+def resumen_notas(notas):
+    """Resumen de un bloque calculado en Python (mismos campos que mantiene el servidor)"""
+    sum_nota_peso = sum(n.get('nota', 0) * n.get('peso', 0) for n in notas)
+    sum_peso = sum(n.get('peso', 0) for n in notas)
+    return {
+        'sum_nota_peso': sum_nota_peso,
+        'sum_peso': sum_peso,
+        'sum_nota': sum(n.get('nota', 0) for n in notas),
+        'n_notas': len(notas),
+        'promedio': sum_nota_peso / sum_peso if sum_peso > 0 else 0
+    }
+
+
+def resumen_bloque(bloque):
+    """Resumen guardado en el bloque; si aún no lo tiene, se calcula de las notas"""
+    if bloque.get('promedio') is not None:
+        return bloque
+    return resumen_notas(bloque.get('notas', []))
+
+
+def promedio_bloque(bloque):
+    """Promedio ponderado del bloque (sin redondear)"""
+    return resumen_bloque(bloque)['promedio']
+
+
+# ---------------------------------------------------------------------------
+#   Actualizaciones con pipeline sobre un bloque
+# ---------------------------------------------------------------------------
+
+def _es_bloque(variable, id_asignacion, periodo):
+    return {'$and': [
+        {'$eq': [f'{variable}.id_asignacion', id_asignacion]},
+        {'$eq': [{'$ifNull': [f'{variable}.periodo', None]}, periodo]}
+    ]}
+
+
+def _con_resumen(bloque, notas):
+    """Expresión: `bloque` con sus notas reemplazadas por `notas` y el resumen recalculado"""
+    return {'$let': {
+        'vars': {'notas': notas},
+        'in': {'$let': {
+            'vars': {
+                'snp': {'$reduce': {
+                    'input': '$$notas',
+                    'initialValue': 0,
+                    'in': {'$add': ['$$value', {'$multiply': [
+                        {'$ifNull': ['$$this.nota', 0]},
+                        {'$ifNull': ['$$this.peso', 0]}
+                    ]}]}
+                }},
+                'sp': {'$sum': '$$notas.peso'}
+            },
+            'in': {'$mergeObjects': [bloque, {
+                'notas': '$$notas',
+                'sum_nota_peso': '$$snp',
+                'sum_peso': '$$sp',
+                'sum_nota': {'$sum': '$$notas.nota'},
+                'n_notas': {'$size': '$$notas'},
+                'promedio': {'$cond': [{'$gt': ['$$sp', 0]}, {'$divide': ['$$snp', '$$sp']}, 0]}
+            }]}
+        }}
+    }}
+
+
+def _pipeline_bloque(id_asignacion, periodo, notas, crear=False, quitar_vacio=False):
+    """
+    Pipeline que reemplaza las notas del bloque de la asignación y periodo por
+    la expresión `notas` (evaluada sobre `$$c`, el bloque actual) y recalcula su
+    resumen. Con `crear` agrega el bloque si no existe; con `quitar_vacio` lo
+    elimina si queda sin notas.
+    """
+    calificaciones = {'$ifNull': ['$calificaciones', []]}
+    actualizadas = {'$map': {
+        'input': calificaciones,
+        'as': 'c',
+        'in': {'$cond': [_es_bloque('$$c', id_asignacion, periodo), _con_resumen('$$c', notas), '$$c']}
+    }}
+
+    if crear:
+        nuevo = {'$let': {
+            'vars': {'c': {'id_asignacion': id_asignacion, 'periodo': periodo, 'notas': []}},
+            'in': _con_resumen('$$c', notas)
+        }}
+        actualizadas = {'$cond': [
+            {'$anyElementTrue': [{'$map': {
+                'input': calificaciones,
+                'as': 'c',
+                'in': _es_bloque('$$c', id_asignacion, periodo)
+            }}]},
+            actualizadas,
+            {'$concatArrays': [calificaciones, [nuevo]]}
+        ]}
+
+    if quitar_vacio:
+        actualizadas = {'$filter': {
+            'input': actualizadas,
+            'as': 'c',
+            'cond': {'$or': [
+                {'$not': [_es_bloque('$$c', id_asignacion, periodo)]},
+                {'$gt': [{'$size': {'$ifNull': ['$$c.notas', []]}}, 0]}
+            ]}
+        }}
+
+    return [{'$set': {'calificaciones': actualizadas}}]
+
+
+def _indices_notas():
+    return {'$range': [0, {'$size': {'$ifNull': ['$$c.notas', []]}}]}
+
+
+def pipeline_agregar_notas(id_asignacion, periodo, notas):
+    """Agrega `notas` al final del bloque (lo crea si no existe)"""
+    return _pipeline_bloque(
+        id_asignacion, periodo,
+        {'$concatArrays': [{'$ifNull': ['$$c.notas', []]}, {'$literal': list(notas)}]},
+        crear=True
+    )
+
+
+def pipeline_modificar_nota(id_asignacion, periodo, indice, cambios, reemplazar=False, id_nota=None):
+    """
+    Modifica una nota del bloque: mezcla `cambios` sobre ella, o la sustituye
+    completa con `reemplazar`. Con `id_nota` la nota se busca por su id; si no,
+    por su posición `indice` (notas antiguas sin id_nota, ver `filtro_nota`).
+    """
+    if id_nota is not None:
+        nueva = {'$literal': cambios} if reemplazar else {'$mergeObjects': ['$$n', {'$literal': cambios}]}
+        return _pipeline_bloque(id_asignacion, periodo, {'$map': {
+            'input': {'$ifNull': ['$$c.notas', []]},
+            'as': 'n',
+            'in': {'$cond': [{'$eq': ['$$n.id_nota', id_nota]}, nueva, '$$n']}
+        }})
+
+    actual = {'$arrayElemAt': ['$$c.notas', '$$i']}
+    nueva = {'$literal': cambios} if reemplazar else {'$mergeObjects': [actual, {'$literal': cambios}]}
+    return _pipeline_bloque(id_asignacion, periodo, {'$map': {
+        'input': _indices_notas(),
+        'as': 'i',
+        'in': {'$cond': [{'$eq': ['$$i', int(indice)]}, nueva, actual]}
+    }})
+
+
+def pipeline_eliminar_nota(id_asignacion, periodo, indice, quitar_vacio=True, id_nota=None):
+    """
+    Elimina una nota del bloque (y el bloque si queda vacío). Con `id_nota` la
+    nota se busca por su id; si no, por su posición `indice`.
+    """
+    if id_nota is not None:
+        return _pipeline_bloque(id_asignacion, periodo, {'$filter': {
+            'input': {'$ifNull': ['$$c.notas', []]},
+            'as': 'n',
+            'cond': {'$ne': ['$$n.id_nota', id_nota]}
+        }}, quitar_vacio=quitar_vacio)
+
+    return _pipeline_bloque(id_asignacion, periodo, {'$map': {
+        'input': {'$filter': {
+            'input': _indices_notas(),
+            'as': 'i',
+            'cond': {'$ne': ['$$i', int(indice)]}
+        }},
+        'as': 'i',
+        'in': {'$arrayElemAt': ['$$c.notas', '$$i']}
+    }}, quitar_vacio=quitar_vacio)
+
+
+def filtro_nota(id_matricula, id_asignacion, periodo, indice, nota):
+    """
+    Filtro de la matrícula que solo coincide mientras el bloque conserve la
+    nota leída: por su id_nota o, en notas antiguas sin id_nota, por la nota
+    completa en la misma posición. Si otra escritura la elimina o mueve las
+    notas entre la lectura y la actualización, esta no coincide
+    (matched_count == 0) en lugar de alcanzar otra nota.
+    """
+    if nota.get('id_nota') is not None:
+        return {'_id': id_matricula, 'calificaciones': {'$elemMatch': {
+            'id_asignacion': id_asignacion,
+            'periodo': periodo,
+            'notas.id_nota': nota['id_nota']
+        }}}
+
+    bloque = {'$first': {'$filter': {
+        'input': {'$ifNull': ['$calificaciones', []]},
+        'as': 'c',
+        'cond': _es_bloque('$$c', id_asignacion, periodo)
+    }}}
+    notas = {'$ifNull': [{'$let': {'vars': {'b': bloque}, 'in': '$$b.notas'}}, []]}
+    return {'_id': id_matricula, '$expr': {'$eq': [
+        {'$arrayElemAt': [notas, int(indice)]},
+        {'$literal': nota}
+    ]}}
+
+
+def pipeline_recalcular_resumenes():
+    """
+    Pipeline que recalcula el resumen de todos los bloques de la matrícula.
+    Las calificaciones que no tienen arreglo de notas se dejan como están.
+    """
+    return [{'$set': {'calificaciones': {'$map': {
+        'input': {'$ifNull': ['$calificaciones', []]},
+        'as': 'c',
+        'in': {'$cond': [
+            {'$isArray': '$$c.notas'},
+            _con_resumen('$$c', '$$c.notas'),
+            '$$c'
+        ]}
+    }}}}]
+
+
+# ---------------------------------------------------------------------------
+#   Historial: notas a una fecha y reconstrucción de la proyección
+# ---------------------------------------------------------------------------
+
+def _bloques_con_resumen(bloques):
+    return [
+        {'id_asignacion': id_asignacion, 'periodo': periodo, 'notas': notas, **resumen_notas(notas)}
+        for (id_asignacion, periodo), notas in bloques.items()
+    ]
+
+
+def notas_a_la_fecha(id_matricula, fecha, id_asignacion=None, periodo=None):
+    """
+    Bloques de calificaciones de la matrícula tal como estaban en `fecha`
+    (con su resumen), reproducidos desde el historial.
+    """
+    eventos = consultar_eventos(id_matricula, id_asignacion, periodo, hasta=fecha)
+    return _bloques_con_resumen(reproducir(eventos))
+
+
+def reconstruir_calificaciones(coleccion, id_matricula):
+    """
+    Regenera los bloques con notas de la matrícula a partir del historial. Las
+    calificaciones sin arreglo de notas (formato anterior) se conservan.
+    Devuelve cuántos bloques quedaron.
+    """
+    matricula = coleccion.find_one({'_id': id_matricula}, {'calificaciones': 1})
+    if not matricula:
+        return 0
+    bloques = _bloques_con_resumen(reproducir(consultar_eventos(id_matricula)))
+    otras = [
+        c for c in matricula.get('calificaciones') or []
+        if not isinstance(c.get('notas'), list)
+    ]
+    coleccion.update_one({'_id': id_matricula}, {'$set': {'calificaciones': otras + bloques}})
+    return len(bloques)
+
+
+class LoteCalificaciones:
+    """
+    Acumula las notas de una carga masiva y las escribe con un solo bulk_write.
+
+    Las notas nuevas de una misma matrícula/asignación/periodo se agrupan en una
+    operación (que crea el bloque si no existe); los reemplazos por índice van
+    en operaciones propias. Todas recalculan el resumen del bloque. `entrada`
+    es cualquier referencia del llamador (p. ej. la entrada de la petición) y
+    se devuelve en los fallos para reportarlos. Las operaciones que se escriben
+    quedan registradas en el historial a nombre de `id_usuario`.
+    """
+
+    def __init__(self, coleccion, id_usuario=None):
+        self.coleccion = coleccion
+        self.id_usuario = id_usuario
+        self._nuevas = {}
+        self._reemplazos = []
+        self.entradas = 0
+
+    def agregar(self, id_matricula, id_asignacion, periodo, nota, entrada):
+        """Agrega una nota nueva al final del bloque (lo crea si no existe)"""
+        clave = (id_matricula, id_asignacion, periodo)
+        pendiente = self._nuevas.setdefault(clave, {'notas': [], 'entradas': []})
+        pendiente['notas'].append(nota)
+        pendiente['entradas'].append(entrada)
+        self.entradas += 1
+
+    def reemplazar(self, id_matricula, id_asignacion, periodo, indice, nota, entrada):
+        """
+        Reemplaza la nota en la posición `indice` de un bloque existente. Para
+        conservar su historial, `nota` debe llevar el `id_nota` de la anterior.
+        """
+        operacion = UpdateOne(
+            {'_id': id_matricula},
+            pipeline_modificar_nota(id_asignacion, periodo, indice, nota, reemplazar=True)
+        )
+        evento = evento_nota(
+            'reemplazar', id_matricula, id_asignacion, periodo, self.id_usuario,
+            id_nota=nota.get('id_nota'), indice=int(indice), nota=nota
+        )
+        self._reemplazos.append((operacion, [entrada], [evento]))
+        self.entradas += 1
+
+    def _operaciones(self):
+        for (id_matricula, id_asignacion, periodo), pendiente in self._nuevas.items():
+            operacion = UpdateOne(
+                {'_id': id_matricula},
+                pipeline_agregar_notas(id_asignacion, periodo, pendiente['notas'])
+            )
+            eventos = [
+                evento_nota('agregar', id_matricula, id_asignacion, periodo, self.id_usuario, nota=nota)
+                for nota in pendiente['notas']
+            ]
+            yield operacion, pendiente['entradas'], eventos
+        yield from self._reemplazos
+
+    def ejecutar(self):
+        """
+        Envía las operaciones acumuladas. Devuelve la lista de fallos como
+        (entrada, mensaje); las demás entradas se escribieron correctamente.
+        """
+        operaciones = list(self._operaciones())
+        self._nuevas = {}
+        self._reemplazos = []
+        self.entradas = 0
+        if not operaciones:
+            return []
+
+        fallos = []
+        fallidas = set()
+        try:
+            self.coleccion.bulk_write([operacion for operacion, _, _ in operaciones], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                fallidas.add(error['index'])
+                for entrada in operaciones[error['index']][1]:
+                    fallos.append((entrada, error.get('errmsg', 'Error de escritura')))
+
+        # Solo las operaciones escritas pasan al historial
+        registrar_eventos(
+            evento
+            for posicion, (_, _, eventos) in enumerate(operaciones)
+            if posicion not in fallidas
+            for evento in eventos
+        )
+        return fallos
@@ -1,13 +1,96 @@
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure, OperationFailure
+from pymongo.monitoring import ConnectionPoolListener
+import atexit
 import os
+import queue
+import threading
+import time
 from contextlib import contextmanager
+from itertools import islice
 from bson import ObjectId
 from bson.timestamp import Timestamp
 from datetime import datetime
 import requests
 
 
+class PoolMetrics(ConnectionPoolListener):
+    """Métricas del pool de conexiones: espera en checkout, conexiones abiertas, fallos"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkouts_fallidos = 0
+            self.espera_total_ms = 0.0
+            self.espera_max_ms = 0.0
+            self.conexiones_creadas = 0
+            self.conexiones_cerradas = 0
+            self.en_uso = 0
+
+    def connection_check_out_started(self, event):
+        self._local.inicio = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        inicio = getattr(self._local, 'inicio', None)
+        espera_ms = (time.perf_counter() - inicio) * 1000 if inicio else 0.0
+        with self._lock:
+            self.checkouts += 1
+            self.en_uso += 1
+            self.espera_total_ms += espera_ms
+            self.espera_max_ms = max(self.espera_max_ms, espera_ms)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkouts_fallidos += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.en_uso = max(0, self.en_uso - 1)
+
+    def connection_created(self, event):
+        with self._lock:
+            self.conexiones_creadas += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.conexiones_cerradas += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'checkouts_fallidos': self.checkouts_fallidos,
+                'espera_promedio_ms': round(self.espera_total_ms / self.checkouts, 3) if self.checkouts else 0.0,
+                'espera_max_ms': round(self.espera_max_ms, 3),
+                'conexiones_abiertas': self.conexiones_creadas - self.conexiones_cerradas,
+                'conexiones_en_uso': self.en_uso
+            }
+
+
+class IndiceUnicoError(RuntimeError):
+    """Un índice único del catálogo no se pudo crear (normalmente por datos duplicados)"""
+
+
 class DatabaseConfig:
     """Configuración centralizada para la conexión a MongoDB"""
 
@@ -25,20 +108,118 @@ class DatabaseConfig:
         else:
             MONGO_URI = f"mongodb://{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-    # Cliente de MongoDB
+    # Parámetros del pool de conexiones (por proceso)
+    MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+    MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+    MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+    WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+
+    # Cliente de MongoDB (uno por proceso: se descarta en el hijo tras un fork)
     client = None
     db = None
+    _pid = None
+    _lock = threading.RLock()
+    pool_metrics = PoolMetrics()
+    # Último error al crear índices únicos del catálogo (None si todos existen)
+    error_indices = None
+
+    # Crear al conectar los índices del catálogo que falten (MONGO_ENSURE_INDEXES=0 lo desactiva).
+    # Recrear los que cambiaron de definición solo lo hace database/ensure_indexes.py
+    ENSURE_INDEXES = os.getenv("MONGO_ENSURE_INDEXES", "1") == "1"
+
+    # Catálogo de índices de las consultas frecuentes: colección -> lista de índices.
+    # Los nombres son fijos para poder comparar y recrear de forma idempotente.
+    INDEXES = {
+        "usuarios": [
+            {"name": "idx_usuarios_correo_rol_activos",
+             "keys": [("correo", 1), ("rol", 1)],
+             "partialFilterExpression": {"activo": True}},
+            {"name": "idx_usuarios_keycloak_id_activos",
+             "keys": [("keycloak_id", 1)],
+             "partialFilterExpression": {"activo": True}},
+            {"name": "idx_usuarios_rol_activo",
+             "keys": [("rol", 1), ("activo", 1)]},
+            {"name": "idx_usuarios_rol_apellidos",
+             "keys": [("rol", 1), ("apellidos", 1), ("_id", 1)]},
+        ],
+        "matriculas": [
+            {"name": "idx_matriculas_grupo_estado",
+             "keys": [("id_grupo", 1), ("estado", 1)]},
+            {"name": "idx_matriculas_estudiante_estado_anio",
+             "keys": [("id_estudiante", 1), ("estado", 1), ("anio_lectivo", 1)]},
+            {"name": "idx_matriculas_calificaciones_asignacion",
+             "keys": [("calificaciones.id_asignacion", 1)]},
+        ],
+        "asignaciones_docentes": [
+            {"name": "idx_asignaciones_docente_anio_activas",
+             "keys": [("id_docente", 1), ("anio_lectivo", 1)],
+             "partialFilterExpression": {"activo": True}},
+            {"name": "idx_asignaciones_grupo_activas",
+             "keys": [("id_grupo", 1), ("id_curso", 1)],
+             "partialFilterExpression": {"activo": True}},
+        ],
+        "asistencia": [
+            {"name": "idx_asistencia_curso_grupo_fecha",
+             "keys": [("id_curso", 1), ("id_grupo", 1), ("fecha", 1)],
+             "unique": True},
+            {"name": "idx_asistencia_contadores_pendientes",
+             "keys": [("id_curso", 1)],
+             "partialFilterExpression": {"contadores_pendientes": True}},
+        ],
+        "asistencia_contadores": [
+            {"name": "idx_contadores_curso_periodo_estudiante",
+             "keys": [("id_curso", 1), ("periodo", 1), ("id_estudiante", 1)],
+             "unique": True},
+        ],
+        "notas_ledger": [
+            {"name": "idx_ledger_matricula_asignacion_periodo_ts",
+             "keys": [("id_matricula", 1), ("id_asignacion", 1), ("periodo", 1), ("ts", 1)]},
+        ],
+        "observaciones": [
+            {"name": "idx_observaciones_docente_fecha",
+             "keys": [("id_docente", 1), ("fecha", -1)]},
+        ],
+        "auditoria": [
+            {"name": "idx_auditoria_fecha",
+             "keys": [("fecha", 1)]},
+        ],
+    }
 
     @classmethod
     def initialize_connection(cls):
-        """Inicializa la conexión a MongoDB"""
+        """Inicializa la conexión a MongoDB (una sola vez por proceso)"""
+        with cls._lock:
+            if cls.db is not None and cls._pid == os.getpid():
+                return cls.db
+            return cls._conectar()
+
+    @classmethod
+    def _conectar(cls):
         try:
-            cls.client = MongoClient(cls.MONGO_URI, serverSelectionTimeoutMS=5000)
+            client = MongoClient(
+                cls.MONGO_URI,
+                serverSelectionTimeoutMS=5000,
+                maxPoolSize=cls.MAX_POOL_SIZE,
+                minPoolSize=cls.MIN_POOL_SIZE,
+                maxIdleTimeMS=cls.MAX_IDLE_TIME_MS,
+                waitQueueTimeoutMS=cls.WAIT_QUEUE_TIMEOUT_MS,
+                event_listeners=[cls.pool_metrics]
+            )
             # Verificar conexión
-            cls.client.admin.command("ping")
-            cls.db = cls.client[cls.DB_NAME]
+            client.admin.command("ping")
+            cls.client = client
+            cls.db = client[cls.DB_NAME]
+            cls._pid = os.getpid()
             print(f"✓ Conexión a MongoDB establecida exitosamente")
             print(f"✓ Base de datos: {cls.DB_NAME}")
+            if cls.ENSURE_INDEXES:
+                try:
+                    cls.asegurar_indices()
+                except IndiceUnicoError as error:
+                    # Sin el índice único las escrituras que dependen de él duplican datos
+                    print(f"❌ {error}")
+                except Exception as error:
+                    print(f"⚠️ No se pudieron asegurar los índices: {error}")
             return cls.db
         except ConnectionFailure as error:
             print(f"✗ Error al conectar con MongoDB: {error}")
@@ -47,16 +228,44 @@ class DatabaseConfig:
     @classmethod
     def get_db(cls):
         """Obtiene la instancia de la base de datos"""
-        if cls.db is None:
-            cls.initialize_connection()
-        return cls.db
+        db = cls.db
+        if db is None or cls._pid != os.getpid():
+            db = cls.initialize_connection()
+        return db
 
     @classmethod
     def close_connection(cls):
         """Cierra la conexión a MongoDB"""
-        if cls.client:
-            cls.client.close()
-            print("✓ Conexión a MongoDB cerrada")
+        with cls._lock:
+            if cls.client and cls._pid == os.getpid():
+                cls.client.close()
+                print("✓ Conexión a MongoDB cerrada")
+            cls.client = None
+            cls.db = None
+            cls._pid = None
+
+    @classmethod
+    def _despues_de_fork(cls):
+        """En el proceso hijo: olvidar el cliente heredado y crear uno propio al usarlo"""
+        cls._lock = threading.RLock()
+        cls.client = None
+        cls.db = None
+        cls._pid = None
+        cls.pool_metrics = PoolMetrics()
+
+    @classmethod
+    def estadisticas_pool(cls):
+        """Configuración y métricas del pool de conexiones del proceso actual"""
+        return {
+            'pid': os.getpid(),
+            'conectado': cls.db is not None and cls._pid == os.getpid(),
+            'max_pool_size': cls.MAX_POOL_SIZE,
+            'min_pool_size': cls.MIN_POOL_SIZE,
+            'max_idle_time_ms': cls.MAX_IDLE_TIME_MS,
+            'wait_queue_timeout_ms': cls.WAIT_QUEUE_TIMEOUT_MS,
+            'error_indices': cls.error_indices,
+            **cls.pool_metrics.snapshot()
+        }
 
     @classmethod
     def get_collection(cls, collection_name):
@@ -64,6 +273,145 @@ class DatabaseConfig:
         db = cls.get_db()
         return db[collection_name]
 
+    @staticmethod
+    def _opciones_indice(spec):
+        """Opciones comparables de un índice (del catálogo o de index_information)"""
+        return (
+            bool(spec.get("unique", False)),
+            bool(spec.get("sparse", False)),
+            spec.get("partialFilterExpression") or None,
+        )
+
+    @staticmethod
+    def _hay_duplicados(col, claves):
+        """Si algún valor de `claves` se repite en la colección (impide un índice único)"""
+        return next(col.aggregate([
+            {'$group': {'_id': {campo: f'${campo}' for campo, _ in claves}, 'n': {'$sum': 1}}},
+            {'$match': {'n': {'$gt': 1}}},
+            {'$limit': 1}
+        ], allowDiskUse=True), None) is not None
+
+    @classmethod
+    def asegurar_indices(cls, recrear=False):
+        """
+        Crea los índices del catálogo que falten. Es idempotente: si ya existe un
+        índice con las mismas claves y opciones (aunque tenga otro nombre) no se
+        toca. Varios procesos pueden ejecutarlo a la vez al conectar.
+
+        Un índice del catálogo que cambió de definición (o, si es único, el
+        índice existente con las mismas claves y otras opciones, p. ej. el no
+        único de init_db.js) solo se elimina y se recrea con `recrear`, desde
+        database/ensure_indexes.py: al conectar se reporta y se deja como está,
+        para que los procesos no compitan eliminando índices que otros usan.
+
+        Los índices únicos que no se pueden construir porque hay valores
+        duplicados no se tocan y se lanza IndiceUnicoError al terminar: hay que
+        depurar los datos primero.
+        """
+        db = cls.get_db()
+        creados = 0
+        fallidos = []
+        for coleccion, indices in cls.INDEXES.items():
+            col = db[coleccion]
+            existentes = col.index_information()
+            for indice in indices:
+                claves = list(indice["keys"])
+                opciones = {k: v for k, v in indice.items() if k not in ("keys", "name")}
+
+                equivalente = next(
+                    (nombre for nombre, info in existentes.items()
+                     if list(info["key"]) == claves
+                     and cls._opciones_indice(info) == cls._opciones_indice(indice)),
+                    None
+                )
+                if equivalente:
+                    continue
+
+                # Índices que hay que eliminar antes de crear el del catálogo
+                reemplazar = []
+                if indice["name"] in existentes:
+                    reemplazar.append(indice["name"])
+                if indice.get("unique"):
+                    reemplazar += [
+                        nombre for nombre, info in existentes.items()
+                        if list(info["key"]) == claves and nombre not in reemplazar
+                    ]
+
+                if reemplazar and not recrear:
+                    print(f"⚠️ Índice {coleccion}.{indice['name']} difiere del catálogo "
+                          f"({', '.join(reemplazar)}); ejecute database/ensure_indexes.py para recrearlo")
+                    if indice.get("unique"):
+                        fallidos.append(f"{coleccion}.{indice['name']} (definición distinta)")
+                    continue
+
+                if indice.get("unique") and cls._hay_duplicados(col, claves):
+                    fallidos.append(f"{coleccion}.{indice['name']} (valores duplicados)")
+                    continue
+
+                for nombre in reemplazar:
+                    print(f"⚠️ Índice {coleccion}.{nombre} cambió de definición, recreando")
+                    col.drop_index(nombre)
+
+                try:
+                    col.create_index(claves, name=indice["name"], **opciones)
+                    creados += 1
+                    print(f"✓ Índice creado: {coleccion}.{indice['name']}")
+                except OperationFailure as error:
+                    # 85/86: ya existe un índice con las mismas claves y otras opciones
+                    # 11000: duplicados escritos entre la verificación y la creación
+                    if indice.get("unique") and error.code in (85, 86, 11000):
+                        fallidos.append(f"{coleccion}.{indice['name']} ({error})")
+                    elif error.code in (85, 86):
+                        print(f"⚠️ Conflicto con un índice existente en {coleccion}: {error}")
+                    else:
+                        raise
+        if creados:
+            print(f"✓ {creados} índices creados")
+        # Queda registrado para /health (db_pool.error_indices) hasta corregirlo
+        cls.error_indices = None
+        if fallidos:
+            cls.error_indices = (
+                "No se pudieron crear índices únicos: " + "; ".join(fallidos)
+                + ". Depure los duplicados (asistencia: database/migrate_attendance_unique.py)"
+                + " y ejecute database/ensure_indexes.py"
+            )
+            raise IndiceUnicoError(cls.error_indices)
+        return creados
+
+    @classmethod
+    def verificar_indices(cls):
+        """
+        Compara el catálogo con la base de datos. Devuelve, por colección, los
+        índices declarados que faltan y los existentes sin uso según $indexStats
+        (contadores desde el último reinicio de mongod).
+        """
+        db = cls.get_db()
+        reporte = {}
+        for coleccion, indices in cls.INDEXES.items():
+            col = db[coleccion]
+            existentes = col.index_information()
+            faltantes = [
+                indice["name"] for indice in indices
+                if not any(
+                    list(info["key"]) == list(indice["keys"])
+                    and cls._opciones_indice(info) == cls._opciones_indice(indice)
+                    for info in existentes.values()
+                )
+            ]
+            sin_uso = []
+            try:
+                for stat in col.aggregate([{"$indexStats": {}}]):
+                    if stat["name"] != "_id_" and stat.get("accesses", {}).get("ops", 0) == 0:
+                        sin_uso.append(stat["name"])
+            except OperationFailure as error:
+                print(f"⚠️ $indexStats no disponible en {coleccion}: {error}")
+            reporte[coleccion] = {"faltantes": faltantes, "sin_uso": sorted(sin_uso)}
+        return reporte
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=DatabaseConfig._despues_de_fork)
+
 
 # Funciones de ayuda para operaciones comunes
 
@@ -94,15 +442,53 @@ def get_certificados_collection():
 
 
 def get_auditoria_collection():
-    """Obtiene la colección de auditoría"""
+    """Obtiene la colección de auditoría (histórica, anterior a las particiones)"""
     return DatabaseConfig.get_collection("auditoria")
 
 
+# Índices de cada partición mensual de auditoría (el _id ya ordena por fecha)
+AUDIT_PARTITION_INDEXES = [
+    [("id_usuario", 1), ("_id", -1)],
+    [("entidad_afectada", 1), ("_id", -1)],
+    [("accion", 1), ("_id", -1)],
+]
+_particiones_aseguradas = set()
+_particiones_lock = threading.Lock()
+
+
+def nombre_particion_auditoria(fecha):
+    """Nombre de la partición mensual (auditoria_AAAA_MM) para una fecha UTC"""
+    return f"auditoria_{fecha.year:04d}_{fecha.month:02d}"
+
+
+def get_auditoria_particion(fecha):
+    """Obtiene la partición mensual de auditoría, creando sus índices la primera vez"""
+    nombre = nombre_particion_auditoria(fecha)
+    coleccion = DatabaseConfig.get_collection(nombre)
+    if nombre not in _particiones_aseguradas:
+        with _particiones_lock:
+            if nombre not in _particiones_aseguradas:
+                for claves in AUDIT_PARTITION_INDEXES:
+                    coleccion.create_index(claves)
+                _particiones_aseguradas.add(nombre)
+    return coleccion
+
+
 def get_asistencia_collection():
     """Obtener la colección de asistencia"""
     return DatabaseConfig.get_collection("asistencia")
 
 
+def get_asistencia_contadores_collection():
+    """Obtener la colección de contadores de asistencia por estudiante, curso y periodo"""
+    return DatabaseConfig.get_collection("asistencia_contadores")
+
+
+def get_notas_ledger_collection():
+    """Obtener la colección de eventos de calificaciones (solo inserción)"""
+    return DatabaseConfig.get_collection("notas_ledger")
+
+
 # Agregar después de get_asistencia_collection():
 
 
@@ -127,6 +513,81 @@ def get_asignaciones_collection():
 
 
 # Funciones de utilidad para conversión de datos
+class BatchLoader:
+    """
+    Cargador por lotes de documentos por `_id` (patrón DataLoader).
+
+    Los ids se encolan con `agregar` y se resuelven juntos, con una sola
+    consulta `$in`, la primera vez que se pide uno con `obtener`. Los resultados
+    quedan memorizados (incluidos los ids inexistentes) durante la vida del
+    cargador, que con `get_loader` es la petición actual.
+    """
+
+    def __init__(self, collection_name, projection=None):
+        self.collection_name = collection_name
+        self.projection = projection
+        self._docs = {}
+        self._pendientes = set()
+        self.consultas = 0
+
+    def agregar(self, ids):
+        """Encola ids para la próxima carga (se ignoran None y los ya cargados)"""
+        for _id in ids:
+            if _id is not None and _id not in self._docs:
+                self._pendientes.add(_id)
+        return self
+
+    def _cargar_pendientes(self):
+        if not self._pendientes:
+            return
+        ids = list(self._pendientes)
+        self._pendientes.clear()
+        coleccion = DatabaseConfig.get_collection(self.collection_name)
+        self.consultas += 1
+        encontrados = {doc['_id']: doc for doc in coleccion.find({'_id': {'$in': ids}}, self.projection)}
+        for _id in ids:
+            self._docs[_id] = encontrados.get(_id)
+
+    def obtener(self, _id):
+        """Devuelve el documento con ese `_id` (o None), cargando lo pendiente en lote"""
+        if _id is None:
+            return None
+        if _id not in self._docs:
+            self._pendientes.add(_id)
+            self._cargar_pendientes()
+        return self._docs.get(_id)
+
+    def obtener_varios(self, ids):
+        """Devuelve {id: documento} para los ids indicados usando una sola consulta"""
+        ids = [i for i in ids if i is not None]
+        self.agregar(ids)
+        self._cargar_pendientes()
+        return {i: self._docs.get(i) for i in ids}
+
+
+def get_loader(collection_name, projection=None):
+    """
+    Devuelve el BatchLoader de la colección para la petición Flask actual
+    (guardado en `flask.g`). Fuera de una petición devuelve uno nuevo.
+    """
+    try:
+        from flask import g, has_request_context
+    except Exception:
+        return BatchLoader(collection_name, projection)
+
+    if not has_request_context():
+        return BatchLoader(collection_name, projection)
+
+    loaders = g.setdefault('_batch_loaders', {})
+    if isinstance(projection, dict):
+        clave = (collection_name, tuple(sorted(projection.items())))
+    else:
+        clave = (collection_name, tuple(projection) if projection else None)
+    if clave not in loaders:
+        loaders[clave] = BatchLoader(collection_name, projection)
+    return loaders[clave]
+
+
 def serialize_doc(doc):
     """Convierte un documento MongoDB a formato JSON serializable"""
     if doc is None:
@@ -151,6 +612,16 @@ def serialize_doc(doc):
     return doc
 
 
+def en_lotes(iterable, tamano=500):
+    """Recorre `iterable` en listas de como máximo `tamano` elementos"""
+    iterador = iter(iterable)
+    while True:
+        lote = list(islice(iterador, tamano))
+        if not lote:
+            return
+        yield lote
+
+
 def string_to_objectid(id_string):
     """Convierte un string a ObjectId de MongoDB"""
     try:
@@ -161,6 +632,141 @@ def string_to_objectid(id_string):
         return None
 
 
+class AuditWriter:
+    """
+    Escritor de auditoría en segundo plano.
+
+    Los registros se encolan (cola acotada) y un hilo los inserta con
+    `insert_many(ordered=False)` cuando se juntan AUDIT_BATCH_SIZE registros o
+    pasan AUDIT_FLUSH_INTERVAL segundos. Si la cola está llena el registro se
+    descarta y se cuenta. Al terminar el proceso se drena lo pendiente.
+    """
+
+    def __init__(self):
+        self.tamano_lote = int(os.getenv("AUDIT_BATCH_SIZE", "200"))
+        self.intervalo = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1.0"))
+        self._cola = queue.Queue(maxsize=int(os.getenv("AUDIT_QUEUE_SIZE", "10000")))
+        self._lock = threading.Lock()
+        self._hilo = None
+        self._pid = None
+        self._detener = threading.Event()
+
+        self.encolados = 0
+        self.escritos = 0
+        self.descartados = 0
+        self.errores = 0
+
+    def _asegurar_hilo(self):
+        if self._hilo is not None and self._hilo.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._hilo is not None and self._hilo.is_alive() and self._pid == os.getpid():
+                return
+            self._detener.clear()
+            self._pid = os.getpid()
+            self._hilo = threading.Thread(target=self._bucle, name="audit-writer", daemon=True)
+            self._hilo.start()
+
+    def encolar(self, log):
+        """Agrega un registro sin bloquear; devuelve False si se descartó"""
+        self._asegurar_hilo()
+        try:
+            self._cola.put_nowait(log)
+        except queue.Full:
+            with self._lock:
+                self.descartados += 1
+            return False
+        with self._lock:
+            self.encolados += 1
+        return True
+
+    def _tomar_lote(self):
+        """Espera hasta completar un lote o agotar el intervalo"""
+        lote = []
+        limite = time.monotonic() + self.intervalo
+        while len(lote) < self.tamano_lote:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(self._cola.get(timeout=restante))
+            except queue.Empty:
+                break
+        return lote
+
+    def _escribir(self, lote):
+        if not lote:
+            return
+        # Agrupar por partición mensual según la fecha de creación del _id
+        por_particion = {}
+        for log in lote:
+            por_particion.setdefault(nombre_particion_auditoria(log["_id"].generation_time), []).append(log)
+
+        for logs in por_particion.values():
+            try:
+                get_auditoria_particion(logs[0]["_id"].generation_time).insert_many(logs, ordered=False)
+                escritos = len(logs)
+            except Exception as e:
+                # En un BulkWriteError parte del lote puede haberse insertado
+                detalles = getattr(e, "details", None) or {}
+                escritos = detalles.get("nInserted", 0)
+                with self._lock:
+                    self.errores += len(logs) - escritos
+                print(f"Error al registrar auditoría ({len(logs) - escritos} registros): {e}")
+            with self._lock:
+                self.escritos += escritos
+
+    def _bucle(self):
+        while not self._detener.is_set():
+            self._escribir(self._tomar_lote())
+        # Drenar lo que quede al detener
+        while True:
+            lote = []
+            try:
+                while len(lote) < self.tamano_lote:
+                    lote.append(self._cola.get_nowait())
+            except queue.Empty:
+                pass
+            if not lote:
+                break
+            self._escribir(lote)
+
+    def drenar(self, timeout=5.0):
+        """Detiene el hilo después de escribir los registros pendientes"""
+        hilo = self._hilo
+        if hilo is None or not hilo.is_alive() or self._pid != os.getpid():
+            return
+        self._detener.set()
+        hilo.join(timeout)
+
+    def _despues_de_fork(self):
+        """En el hijo: cola vacía y hilo nuevo al primer registro"""
+        self.__init__()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "encolados": self.encolados,
+                "escritos": self.escritos,
+                "descartados": self.descartados,
+                "errores": self.errores,
+                "pendientes": self._cola.qsize()
+            }
+
+
+# AUDIT_ASYNC=0 vuelve a la inserción síncrona (scripts, pruebas)
+AUDIT_ASYNC = os.getenv("AUDIT_ASYNC", "1") == "1"
+audit_writer = AuditWriter()
+atexit.register(audit_writer.drenar)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=audit_writer._despues_de_fork)
+
+
+def estadisticas_auditoria():
+    """Contadores del escritor de auditoría del proceso actual"""
+    return {"async": AUDIT_ASYNC, **audit_writer.stats()}
+
+
 def registrar_auditoria(
     id_usuario,
     accion,
@@ -180,12 +786,6 @@ def registrar_auditoria(
         ip_address: Dirección IP del usuario (opcional)
     """
     try:
-        from bson import ObjectId
-        from bson.timestamp import Timestamp
-        import time
-
-        auditoria = get_auditoria_collection()
-
         # Convertir id_usuario a ObjectId si es necesario
         if id_usuario is None:
             # Usar un ObjectId especial para acciones del sistema
@@ -212,7 +812,10 @@ def registrar_auditoria(
         # Convertir datetime a Timestamp de MongoDB
         timestamp_actual = Timestamp(int(time.time()), 1)
 
+        # El _id se genera aquí: su marca de tiempo decide la partición y
+        # permite consultar rangos de fechas como rangos de _id
         log = {
+            "_id": ObjectId(),
             "id_usuario": id_usuario_obj,
             "accion": accion,
             "entidad_afectada": entidad_afectada,
@@ -228,7 +831,10 @@ def registrar_auditoria(
         if ip_address is not None:
             log["ip"] = ip_address
 
-        auditoria.insert_one(log)
+        if AUDIT_ASYNC:
+            audit_writer.encolar(log)
+        else:
+            get_auditoria_particion(log["_id"].generation_time).insert_one(log)
 
     except Exception as e:
         print(f"Error al registrar auditoría: {e}")
@@ -0,0 +1,47 @@
+"""
+Script para crear los índices del catálogo de DatabaseConfig y reportar
+índices faltantes o sin uso
+
+Es el único que elimina y recrea los índices que cambiaron de definición; al
+conectar, los servicios solo crean los que faltan. Ejecútelo una vez por
+despliegue, no desde cada proceso.
+"""
+
+import sys
+import os
+
+# Agregar el path del backend para importar db_config
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from database.db_config import DatabaseConfig
+
+def asegurar_y_reportar():
+    """Asegura los índices declarados y muestra el estado por colección"""
+    try:
+        print("🔄 Asegurando índices del catálogo...")
+
+        # La conexión solo crea los que faltan; aquí también se recrean los que cambiaron
+        DatabaseConfig.ENSURE_INDEXES = False
+        creados = DatabaseConfig.asegurar_indices(recrear=True)
+        print(f"✅ Índices creados en esta ejecución: {creados}")
+
+        print("\n🔍 Verificando índices...")
+        reporte = DatabaseConfig.verificar_indices()
+
+        for coleccion, estado in reporte.items():
+            print(f"📋 {coleccion}")
+            if estado['faltantes']:
+                print(f"   ❌ Faltantes: {', '.join(estado['faltantes'])}")
+            if estado['sin_uso']:
+                print(f"   ⚠️  Sin uso desde el último reinicio: {', '.join(estado['sin_uso'])}")
+            if not estado['faltantes'] and not estado['sin_uso']:
+                print("   ✅ OK")
+
+    except Exception as e:
+        print(f"❌ Error al asegurar índices: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+if __name__ == '__main__':
+    asegurar_y_reportar()
@@ -0,0 +1,205 @@
+"""
+Motor de cálculo de planillas de calificaciones.
+
+Una planilla son varias filas (estudiantes de un curso o grupo, o las materias
+de un boletín) con sus bloques calificaciones[]. Al cargarla, cada bloque
+aporta sus sumas (sum_nota_peso, sum_peso, n_notas: el resumen que mantienen
+las escrituras, o calculado de las notas si el bloque aún no lo tiene) a
+matrices filas × periodos, y los cálculos se hacen sobre las matrices
+completas:
+
+    promedio ponderado de cada fila    sum(nota * peso) / sum(peso)
+    promedio de cada periodo           el mismo cálculo por columna
+    definitiva                         media de los periodos que tienen notas
+    aprobado                           promedio (redondeado a 2) >= NOTA_APROBACION
+
+Si NumPy no está instalado se usa una implementación en Python puro con los
+mismos resultados.
+
+Uso:
+    filas = [(matricula, bloques), ...]
+    for (matricula, bloques), resultado in zip(filas, calcular_planilla(filas).resultados()):
+        ...
+"""
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+NOTA_APROBACION = 3.0
+PERIODO_POR_DEFECTO = '1'
+
+
+def _redondear(valor):
+    # Mitades hacia arriba: evita que el orden de la suma (distinto con NumPy)
+    # cambie el redondeo de valores como 2.795
+    return round(valor + 1e-9, 2)
+
+
+def periodo_bloque(bloque):
+    """Periodo del bloque (los bloques antiguos sin periodo cuentan como el primero)"""
+    return bloque.get('periodo') or PERIODO_POR_DEFECTO
+
+
+def _sumas_bloque(bloque):
+    """(sum_nota_peso, sum_peso, n_notas) del bloque: las guardadas o calculadas de las notas"""
+    if bloque.get('promedio') is not None:
+        return bloque.get('sum_nota_peso', 0), bloque.get('sum_peso', 0), bloque.get('n_notas', 0)
+    notas = bloque.get('notas') or []
+    return (
+        sum((n.get('nota') or 0) * (n.get('peso') or 0) for n in notas),
+        sum(n.get('peso') or 0 for n in notas),
+        len(notas)
+    )
+
+
+class Planilla:
+    """
+    Sumas de una planilla en matrices filas × periodos. Se construye con
+    `calcular_planilla`; `resultados()` devuelve, en el orden de las filas,
+    un dict con promedio, n_notas, periodos, final y aprobado.
+    """
+
+    def __init__(self, claves, periodos, suma_nota_peso, suma_peso, n_notas):
+        self.claves = claves
+        self.periodos = periodos
+        self.suma_nota_peso = suma_nota_peso
+        self.suma_peso = suma_peso
+        self.n_notas = n_notas
+        # Periodos en los que cada fila tiene notas
+        self.mascara = n_notas > 0
+
+    @classmethod
+    def cargar(cls, filas, periodo=None):
+        claves = []
+        periodos = {}
+        # Un registro por bloque con notas: (fila, indice_periodo, snp, sp, n)
+        registros = []
+        for fila, (clave, bloques) in enumerate(filas):
+            claves.append(clave)
+            for bloque in bloques:
+                periodo_actual = periodo_bloque(bloque)
+                if periodo is not None and periodo_actual != periodo:
+                    continue
+                suma_nota_peso, suma_peso, n_notas = _sumas_bloque(bloque)
+                if n_notas:
+                    indice = periodos.setdefault(periodo_actual, len(periodos))
+                    registros.append((fila, indice, suma_nota_peso, suma_peso, n_notas))
+
+        if np is None:
+            return PlanillaPython(claves, list(periodos), registros)
+
+        forma = (len(claves), len(periodos))
+        if not registros:
+            return cls(claves, list(periodos), np.zeros(forma), np.zeros(forma), np.zeros(forma))
+
+        fila, indice, suma_nota_peso, suma_peso, n_notas = (np.array(c) for c in zip(*registros))
+        # Celda (fila, periodo) de cada bloque; varios bloques pueden caer en la misma
+        celda = fila * forma[1] + indice
+        total = forma[0] * forma[1]
+
+        def acumular(valores):
+            return np.bincount(celda, weights=valores, minlength=total).reshape(forma)
+
+        return cls(
+            claves, list(periodos),
+            acumular(suma_nota_peso), acumular(suma_peso), acumular(n_notas)
+        )
+
+    @staticmethod
+    def _dividir(numerador, denominador):
+        return np.divide(
+            numerador, denominador,
+            out=np.zeros_like(numerador, dtype=float), where=denominador > 0
+        )
+
+    def promedios(self):
+        """Promedio ponderado de cada fila (0 si no tiene notas con peso)"""
+        return self._dividir(self.suma_nota_peso.sum(axis=1), self.suma_peso.sum(axis=1))
+
+    def promedios_periodo(self):
+        """Matriz filas × periodos con el promedio de cada periodo (NaN sin notas)"""
+        return np.where(self.mascara, self._dividir(self.suma_nota_peso, self.suma_peso), np.nan)
+
+    def finales(self, promedios_periodo=None):
+        """Definitiva de cada fila: media de los periodos con notas (0 si ninguno)"""
+        if promedios_periodo is None:
+            promedios_periodo = self.promedios_periodo()
+        suma = np.where(self.mascara, promedios_periodo, 0.0).sum(axis=1)
+        return self._dividir(suma, self.mascara.sum(axis=1))
+
+    def resultados(self, umbral=NOTA_APROBACION):
+        promedios = [_redondear(valor) for valor in self.promedios().tolist()]
+        por_periodo = self.promedios_periodo()
+        finales = self.finales(por_periodo).tolist()
+        aprobados = (np.asarray(promedios) >= umbral).tolist()
+        n_notas = self.n_notas.sum(axis=1).astype(int).tolist()
+
+        return [
+            {
+                'promedio': promedio,
+                'n_notas': cantidad,
+                'periodos': {
+                    periodo: _redondear(valor)
+                    for periodo, valor in zip(self.periodos, fila_periodos)
+                    if valor == valor  # descarta NaN
+                },
+                'final': _redondear(final),
+                'aprobado': aprobado
+            }
+            for promedio, cantidad, fila_periodos, final, aprobado in zip(
+                promedios, n_notas, por_periodo.tolist(), finales, aprobados
+            )
+        ]
+
+
+class PlanillaPython:
+    """Misma interfaz de resultados que `Planilla`, sin NumPy"""
+
+    def __init__(self, claves, periodos, registros):
+        self.claves = claves
+        self.periodos = periodos
+        self._sumas = [{} for _ in claves]  # fila -> {indice_periodo: [snp, sp, n]}
+        for fila, indice, suma_nota_peso, suma_peso, n_notas in registros:
+            suma = self._sumas[fila].setdefault(indice, [0.0, 0.0, 0])
+            suma[0] += suma_nota_peso
+            suma[1] += suma_peso
+            suma[2] += n_notas
+
+    def resultados(self, umbral=NOTA_APROBACION):
+        resultados = []
+        for sumas in self._sumas:
+            suma_nota_peso = sum(s[0] for s in sumas.values())
+            suma_peso = sum(s[1] for s in sumas.values())
+            promedio = _redondear(suma_nota_peso / suma_peso) if suma_peso > 0 else 0.0
+            periodos = {
+                self.periodos[indice]: s[0] / s[1] if s[1] > 0 else 0.0
+                for indice, s in sorted(sumas.items())
+            }
+            final = sum(periodos.values()) / len(periodos) if periodos else 0.0
+            resultados.append({
+                'promedio': promedio,
+                'n_notas': sum(s[2] for s in sumas.values()),
+                'periodos': {periodo: _redondear(valor) for periodo, valor in periodos.items()},
+                'final': _redondear(final),
+                'aprobado': promedio >= umbral
+            })
+        return resultados
+
+
+def bloque_visible(bloques, periodo=None):
+    """Bloque cuyas notas muestra la planilla: el del periodo pedido o, sin periodo, el primero"""
+    for bloque in bloques:
+        if periodo is None or periodo_bloque(bloque) == periodo:
+            return bloque
+    return None
+
+
+def calcular_planilla(filas, periodo=None):
+    """
+    Carga la planilla. `filas` es una lista de (clave, bloques), donde bloques
+    son los elementos de calificaciones[] que cuentan para esa fila; con
+    `periodo` solo se consideran los bloques de ese periodo.
+    """
+    return Planilla.cargar(filas, periodo)
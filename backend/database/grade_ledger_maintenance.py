@@ -0,0 +1,80 @@
+"""
+Script de mantenimiento del historial de calificaciones (notas_ledger)
+
+Uso:
+    python database/grade_ledger_maintenance.py sembrar       # historial inicial desde las notas actuales
+    python database/grade_ledger_maintenance.py reconstruir [id_matricula]   # regenera las notas embebidas
+
+`sembrar` debe ejecutarse una vez al desplegar el historial, antes de que se
+editen o eliminen notas existentes: solo procesa las matrículas sin eventos.
+"""
+
+import sys
+import os
+
+# Agregar el path del backend para importar db_config
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from database.db_config import (
+    DatabaseConfig,
+    get_matriculas_collection,
+    get_notas_ledger_collection,
+    string_to_objectid
+)
+from database.calificaciones import reconstruir_calificaciones
+from database.notas_ledger import eventos_iniciales, registrar_eventos
+
+def sembrar():
+    """Registrar como eventos `agregar` las notas de las matrículas sin historial"""
+    print("🔄 Sembrando historial de calificaciones...")
+    matriculas = get_matriculas_collection()
+    con_historial = set(get_notas_ledger_collection().distinct('id_matricula'))
+
+    procesadas = 0
+    eventos = 0
+    for matricula in matriculas.find({'calificaciones.notas.0': {'$exists': True}}, {'calificaciones': 1}):
+        if matricula['_id'] in con_historial:
+            continue
+        eventos += registrar_eventos(eventos_iniciales(matricula))
+        # La proyección toma los id_nota asignados a las notas antiguas
+        reconstruir_calificaciones(matriculas, matricula['_id'])
+        procesadas += 1
+
+    print(f"📊 Matrículas sembradas: {procesadas}")
+    print(f"✅ Eventos registrados: {eventos}")
+
+def reconstruir(id_matricula=None):
+    """Regenerar calificaciones[] desde el historial (una matrícula o todas)"""
+    matriculas = get_matriculas_collection()
+    if id_matricula:
+        ids = [id_matricula]
+    else:
+        ids = get_notas_ledger_collection().distinct('id_matricula')
+
+    print(f"🔄 Reconstruyendo calificaciones de {len(ids)} matrículas...")
+    bloques = sum(reconstruir_calificaciones(matriculas, id_actual) for id_actual in ids)
+    print(f"✅ Bloques reconstruidos: {bloques}")
+
+if __name__ == '__main__':
+    try:
+        comando = sys.argv[1] if len(sys.argv) > 1 else ''
+        DatabaseConfig.asegurar_indices()
+        if comando == 'sembrar':
+            sembrar()
+        elif comando == 'reconstruir':
+            id_matricula = None
+            if len(sys.argv) > 2:
+                id_matricula = string_to_objectid(sys.argv[2])
+                if not id_matricula:
+                    print(f"❌ ID de matrícula inválido: {sys.argv[2]}")
+                    sys.exit(1)
+            reconstruir(id_matricula)
+        else:
+            print(__doc__)
+            sys.exit(1)
+
+    except Exception as e:
+        print(f"❌ Error en el mantenimiento del historial: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,100 @@
+"""
+Reserva atómica de cupos en los grupos.
+
+El cupo ocupado se lleva en `grupos.estudiantes_actuales` y se reserva con un
+`$inc` condicionado a que no se supere `capacidad_max` (40 si no está
+definida), de modo que dos administradores asignando al mismo tiempo no pueden
+sobrepasar la capacidad y no hace falta contar los estudiantes del grupo.
+
+El contador es la fuente de verdad de la capacidad y equivale al número de
+matrículas activas del grupo: toda ruta que crea una matrícula activa reserva
+su cupo y toda ruta que la pasa a otro estado lo libera. Desactivar a un
+estudiante no toca sus matrículas, así que tampoco su cupo. Si el contador se
+desajusta (datos cargados a mano, versiones anteriores) se reconstruye con
+`recalcular_estudiantes_actuales` (database/backfill_group_counts.py).
+"""
+
+from pymongo import UpdateOne
+
+CAPACIDAD_POR_DEFECTO = 40
+ESTADOS_ACTIVOS = ('activa', 'activo')
+
+
+def es_activa(estado):
+    """Si una matrícula con ese estado ocupa cupo en su grupo"""
+    return estado in ESTADOS_ACTIVOS
+
+
+def _condicion_cupo(cantidad):
+    return {'$expr': {'$lte': [
+        {'$add': [{'$ifNull': ['$estudiantes_actuales', 0]}, cantidad]},
+        {'$ifNull': ['$capacidad_max', CAPACIDAD_POR_DEFECTO]}
+    ]}}
+
+
+def cupos_disponibles(grupo):
+    """Cupos libres según el documento del grupo"""
+    capacidad = grupo.get('capacidad_max') or CAPACIDAD_POR_DEFECTO
+    return max(capacidad - (grupo.get('estudiantes_actuales') or 0), 0)
+
+
+def reservar_cupos(grupos, id_grupo, cantidad, intentos=3):
+    """
+    Reserva hasta `cantidad` cupos en el grupo y devuelve cuántos se reservaron.
+
+    Si no caben todos se reservan los que queden libres; si otro proceso ocupa
+    cupos entre la lectura y la reserva se reintenta con el nuevo disponible.
+    """
+    pedidos = cantidad
+    for _ in range(intentos):
+        if pedidos <= 0:
+            return 0
+        resultado = grupos.update_one(
+            {'_id': id_grupo, **_condicion_cupo(pedidos)},
+            {'$inc': {'estudiantes_actuales': pedidos}}
+        )
+        if resultado.modified_count:
+            return pedidos
+
+        grupo = grupos.find_one(
+            {'_id': id_grupo},
+            {'capacidad_max': 1, 'estudiantes_actuales': 1}
+        )
+        if not grupo:
+            return 0
+        pedidos = min(cantidad, cupos_disponibles(grupo))
+    return 0
+
+
+def liberar_cupos(grupos, id_grupo, cantidad):
+    """Devuelve cupos reservados que no llegaron a usarse"""
+    if cantidad > 0:
+        grupos.update_one(
+            {'_id': id_grupo},
+            {'$inc': {'estudiantes_actuales': -cantidad}}
+        )
+
+
+def recalcular_estudiantes_actuales(grupos, matriculas, id_grupo=None):
+    """
+    Reconstruye `estudiantes_actuales` contando las matrículas activas (de un
+    grupo o de todos). Devuelve cuántos grupos cambiaron.
+    """
+    filtro = {'estado': {'$in': list(ESTADOS_ACTIVOS)}}
+    if id_grupo is not None:
+        filtro['id_grupo'] = id_grupo
+    conteos = {
+        fila['_id']: fila['total'] for fila in matriculas.aggregate([
+            {'$match': filtro},
+            {'$group': {'_id': '$id_grupo', 'total': {'$sum': 1}}}
+        ])
+    }
+
+    ids = [id_grupo] if id_grupo is not None else grupos.distinct('_id')
+    operaciones = [
+        UpdateOne({'_id': id_actual}, {'$set': {'estudiantes_actuales': conteos.get(id_actual, 0)}})
+        for id_actual in ids
+    ]
+    if not operaciones:
+        return 0
+    return grupos.bulk_write(operaciones, ordered=False).modified_count
@@ -0,0 +1,148 @@
+"""
+Resolución de la identidad del usuario autenticado (token → documento de `usuarios`).
+
+Los endpoints de docentes y estudiantes buscaban al usuario con hasta tres
+`find_one` encadenados (correo, keycloak_id, _id). Aquí se resuelve con una
+sola consulta `$or` y el resultado se guarda en una caché del proceso con TTL
+corto (IDENTITY_CACHE_TTL, en segundos) y a lo sumo _MAX_ENTRADAS entradas:
+si está llena se descartan las vencidas y, si no hay, las más antiguas. Los
+endpoints CRUD que modifican usuarios llaman a `invalidar_usuario` para
+descartar la entrada.
+"""
+
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .db_config import get_usuarios_collection, string_to_objectid
+
+DOMINIO_CORREO = 'colegio.edu.co'
+
+_TTL = int(os.getenv('IDENTITY_CACHE_TTL', '60'))
+_MAX_ENTRADAS = 2048
+_cache = OrderedDict()
+_claves_por_usuario = {}
+_lock = threading.Lock()
+
+
+def _correos_candidatos(userinfo):
+    """Correos posibles del token: email, preferred_username y su variante con dominio"""
+    correos = []
+    for valor in (userinfo.get('email'), userinfo.get('preferred_username')):
+        if not valor:
+            continue
+        correos.append(valor)
+        if '@' not in valor:
+            correos.append(f"{valor}@{DOMINIO_CORREO}")
+    return list(dict.fromkeys(correos))
+
+
+def _elegir(candidatos, correos, sub, sub_obj_id):
+    """Aplica la prioridad de búsqueda original: correo, keycloak_id y por último _id"""
+    for correo in correos:
+        for usuario in candidatos:
+            if usuario.get('correo') == correo:
+                return usuario
+    for usuario in candidatos:
+        if sub and usuario.get('keycloak_id') == sub:
+            return usuario
+    for usuario in candidatos:
+        if sub_obj_id and usuario.get('_id') == sub_obj_id:
+            return usuario
+    return None
+
+
+def _olvidar_clave(clave, usuario):
+    """Quita `clave` del índice por usuario (se llama con el lock tomado)"""
+    claves = _claves_por_usuario.get(usuario['_id'])
+    if claves is not None:
+        claves.discard(clave)
+        if not claves:
+            del _claves_por_usuario[usuario['_id']]
+
+
+def _purgar_vencidos(ahora):
+    """Elimina las entradas vencidas (se llama con el lock tomado)"""
+    for clave, (usuario, expira) in list(_cache.items()):
+        if expira <= ahora:
+            del _cache[clave]
+            _olvidar_clave(clave, usuario)
+
+
+def _hacer_espacio(ahora):
+    """
+    Deja lugar para una entrada nueva: primero descarta las vencidas y, si
+    ninguna venció, las más antiguas (se llama con el lock tomado)
+    """
+    if len(_cache) < _MAX_ENTRADAS:
+        return
+    _purgar_vencidos(ahora)
+    while len(_cache) >= _MAX_ENTRADAS:
+        clave, (usuario, _) = _cache.popitem(last=False)
+        _olvidar_clave(clave, usuario)
+
+
+def resolver_usuario(userinfo, rol, solo_activos=True):
+    """
+    Devuelve el documento del usuario con el rol indicado que corresponde al token
+    (o None). Usa como máximo una consulta a MongoDB por TTL.
+    """
+    sub = userinfo.get('sub')
+    correos = _correos_candidatos(userinfo)
+    clave = (sub or '', tuple(correos), rol, solo_activos)
+
+    ahora = time.monotonic()
+    with _lock:
+        entrada = _cache.get(clave)
+        if entrada and entrada[1] > ahora:
+            return copy.deepcopy(entrada[0])
+
+    condiciones = []
+    if correos:
+        condiciones.append({'correo': {'$in': correos}})
+    if sub:
+        condiciones.append({'keycloak_id': sub})
+    sub_obj_id = string_to_objectid(sub) if sub else None
+    if sub_obj_id:
+        condiciones.append({'_id': sub_obj_id})
+    if not condiciones:
+        return None
+
+    query = {'rol': rol, '$or': condiciones}
+    if solo_activos:
+        query['activo'] = True
+
+    candidatos = list(get_usuarios_collection().find(query).limit(10))
+    usuario = _elegir(candidatos, correos, sub, sub_obj_id)
+
+    # Solo se cachean aciertos: un usuario recién creado debe verse de inmediato
+    if usuario is not None:
+        with _lock:
+            anterior = _cache.pop(clave, None)
+            if anterior is not None:
+                _olvidar_clave(clave, anterior[0])
+            _hacer_espacio(ahora)
+            _cache[clave] = (usuario, ahora + _TTL)
+            _claves_por_usuario.setdefault(usuario['_id'], set()).add(clave)
+        usuario = copy.deepcopy(usuario)
+
+    return usuario
+
+
+def invalidar_usuario(id_usuario):
+    """Descarta de la caché las entradas del usuario indicado (ObjectId o str)"""
+    id_usuario = string_to_objectid(id_usuario)
+    if id_usuario is None:
+        return
+    with _lock:
+        for clave in _claves_por_usuario.pop(id_usuario, set()):
+            _cache.pop(clave, None)
+
+
+def limpiar_cache_usuarios():
+    """Vacía por completo la caché de identidades"""
+    with _lock:
+        _cache.clear()
+        _claves_por_usuario.clear()
@@ -0,0 +1,96 @@
+"""
+Lectura en streaming de archivos CSV y XLSX para las importaciones masivas.
+
+`abrir_tabla` devuelve los encabezados normalizados y un generador de filas que
+recorre el archivo sin cargarlo completo en memoria: el CSV se decodifica
+sobre el stream de la petición y el XLSX se abre con openpyxl en modo
+`read_only`. Si openpyxl no está instalado solo se aceptan archivos CSV.
+"""
+
+import csv
+import io
+import os
+import unicodedata
+
+try:
+    from openpyxl import load_workbook
+except Exception:
+    load_workbook = None
+
+EXTENSIONES_SOPORTADAS = ('.csv', '.xlsx')
+TAMANO_LOTE_IMPORTACION = int(os.getenv('IMPORT_BATCH_SIZE', '500'))
+
+
+def normalizar_encabezado(valor):
+    """'Código Est.' -> 'codigo_est': minúsculas, sin tildes y con guiones bajos"""
+    texto = unicodedata.normalize('NFKD', str(valor or '').strip().lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    partes = ''.join(c if c.isalnum() else ' ' for c in texto).split()
+    return '_'.join(partes)
+
+
+def valor_celda(valor):
+    """Texto de una celda sin espacios sobrantes ('' si está vacía)"""
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        # Excel guarda los códigos numéricos como float
+        return str(int(valor))
+    return str(valor).strip()
+
+
+def _filas_csv(stream):
+    texto = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    primera = texto.readline()
+    # Excel en español exporta con ';' como separador
+    delimitador = ';' if primera.count(';') > primera.count(',') else ','
+    encabezados = next(csv.reader([primera], delimiter=delimitador), [])
+    return encabezados, csv.reader(texto, delimiter=delimitador)
+
+
+def _filas_xlsx(stream):
+    libro = load_workbook(stream, read_only=True, data_only=True)
+    filas = libro.active.iter_rows(values_only=True)
+    encabezados = next(filas, ())
+
+    def generar():
+        try:
+            yield from filas
+        finally:
+            libro.close()
+
+    return list(encabezados), generar()
+
+
+def abrir_tabla(archivo):
+    """
+    Abre un archivo subido (FileStorage) como tabla.
+
+    Devuelve (encabezados, filas): `encabezados` son los nombres originales de
+    las columnas y `filas` un generador de (numero_fila, [valores]) con la
+    numeración de la hoja (el encabezado es la fila 1). Las filas vacías se
+    omiten. Lanza ValueError si el formato no es soportado.
+    """
+    nombre = (archivo.filename or '').lower()
+    if nombre.endswith('.xlsx'):
+        if load_workbook is None:
+            raise ValueError('La importación de archivos XLSX requiere openpyxl')
+        encabezados, filas = _filas_xlsx(archivo.stream)
+    elif nombre.endswith('.csv'):
+        encabezados, filas = _filas_csv(archivo.stream)
+    else:
+        raise ValueError(f"Formato no soportado (use {' o '.join(EXTENSIONES_SOPORTADAS)})")
+
+    encabezados = [valor_celda(e) for e in encabezados]
+    if not any(encabezados):
+        raise ValueError('El archivo no tiene encabezados')
+
+    def numeradas():
+        for numero, fila in enumerate(filas, start=2):
+            valores = [valor_celda(v) for v in fila]
+            if any(valores):
+                # Completar filas cortas para alinearlas con los encabezados
+                valores += [''] * (len(encabezados) - len(valores))
+                yield numero, valores
+
+    return encabezados, numeradas()
@@ -352,6 +352,7 @@ db.createCollection("asistencia", {
       required: ["id_curso", "id_docente", "fecha", "registros"],
       properties: {
         id_curso: { bsonType: "objectId", description: "Referencia al curso" },
+        id_grupo: { bsonType: "objectId", description: "Referencia al grupo" },
         id_docente: { bsonType: "objectId", description: "Referencia al docente que registra" },
         fecha: { bsonType: "date", description: "Fecha de la asistencia" },
         periodo: { bsonType: "string", description: "Periodo académico" },
@@ -394,7 +395,8 @@ db.createCollection("asistencia", {
   }
 });
 // Índices
-db.asistencia.createIndex({ id_curso: 1, fecha: 1 });
+// Único: un registro por curso, grupo y día (el guardado de asistencia hace upsert sobre estas claves)
+db.asistencia.createIndex({ id_curso: 1, id_grupo: 1, fecha: 1 }, { unique: true, name: "idx_asistencia_curso_grupo_fecha" });
 db.asistencia.createIndex({ id_docente: 1 });
 db.asistencia.createIndex({ fecha: -1 });
 
@@ -262,7 +262,7 @@ print("✔ Colección 'observaciones' creada");
 // ==========================================
 //   COLECCIÓN: ASISTENCIA
 //   CAMBIO: id_asignacion → id_curso
-//   teachers_service registra asistencia por curso, no por asignación.
+//   teachers_service registra asistencia por curso y grupo, no por asignación.
 // ==========================================
 db.createCollection("asistencia", {
   validator: {
@@ -271,6 +271,7 @@ db.createCollection("asistencia", {
       required: ["id_curso", "id_docente", "fecha", "registros"],
       properties: {
         id_curso: { bsonType: "objectId" },
+        id_grupo: { bsonType: "objectId" },
         id_docente: { bsonType: "objectId" },
         fecha: { bsonType: "date" },
         periodo: { enum: ["1", "2", "3", "4"] },
@@ -302,7 +303,8 @@ db.createCollection("asistencia", {
   }
 });
 
-db.asistencia.createIndex({ id_curso: 1, fecha: 1 });
+// Único: un registro por curso, grupo y día (el guardado de asistencia hace upsert sobre estas claves)
+db.asistencia.createIndex({ id_curso: 1, id_grupo: 1, fecha: 1 }, { unique: true, name: "idx_asistencia_curso_grupo_fecha" });
 db.asistencia.createIndex({ id_docente: 1, fecha: -1 });
 
 print("✔ Colección 'asistencia' creada");
@@ -729,16 +731,17 @@ for (let d = 0; d < 5; d++) {
       observaciones: ""
     }));
     
-    db.asistencia.insertOne({
-      id_curso: asig.id_curso,
-      id_docente: asig.id_docente,
-      fecha,
-      periodo: "1",
-      registros,
-      grupo_info: asig.grupo_info,
-      curso_info: asig.curso_info,
-      creado_en: Timestamp()
-    });
+    // Un registro por curso, grupo y día (índice único), como al guardar desde la API
+    db.asistencia.updateOne({ id_curso: asig.id_curso, id_grupo: asig.id_grupo, fecha }, {
+      $set: {
+        id_docente: asig.id_docente,
+        periodo: "1",
+        registros,
+        grupo_info: asig.grupo_info,
+        curso_info: asig.curso_info
+      },
+      $setOnInsert: { creado_en: Timestamp() }
+    }, { upsert: true });
   });
 }
 
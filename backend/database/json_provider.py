@@ -0,0 +1,65 @@
+"""
+Proveedor JSON de Flask que serializa directamente los tipos BSON.
+
+Con `app.json = BSONJSONProvider(app)` los handlers pueden devolver documentos
+de MongoDB sin pasarlos antes por `serialize_doc`: ObjectId, datetime y
+Timestamp se convierten durante la codificación, con la misma salida que
+`serialize_doc`. Si `orjson` está instalado se usa para codificar.
+"""
+
+import json
+from datetime import datetime
+
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+from bson.timestamp import Timestamp
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+
+def bson_default(obj):
+    """Convierte los tipos BSON igual que serialize_doc (None si no aplica)"""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, Timestamp):
+        return datetime.fromtimestamp(obj.time).isoformat()
+    if isinstance(obj, Decimal128):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_bson(obj, sort_keys=False):
+    """Codifica un documento (o lista) con tipos BSON a texto JSON compacto"""
+    if orjson is not None:
+        opciones = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            opciones |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=bson_default, option=opciones).decode('utf-8')
+    return json.dumps(obj, default=bson_default, ensure_ascii=False,
+                      separators=(',', ':'), sort_keys=sort_keys)
+
+
+class BSONJSONProvider(DefaultJSONProvider):
+    """DefaultJSONProvider que entiende ObjectId, datetime, Timestamp y Decimal128"""
+
+    @staticmethod
+    def default(obj):
+        try:
+            return bson_default(obj)
+        except TypeError:
+            return DefaultJSONProvider.default(obj)
+
+    def dumps(self, obj, **kwargs):
+        # Ruta rápida con orjson para las respuestas compactas (sin indentación)
+        if orjson is not None and set(kwargs) <= {'separators'}:
+            opciones = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            if self.sort_keys:
+                opciones |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(obj, default=self.default, option=opciones).decode('utf-8')
+        return super().dumps(obj, **kwargs)
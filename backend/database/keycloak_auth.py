@@ -0,0 +1,255 @@
+"""
+Verificación de tokens de Keycloak sin consultar al servidor en cada petición.
+
+Las claves públicas del realm (JWKS) se descargan una vez, se guardan por `kid`
+y se refrescan en segundo plano cuando caducan o de inmediato cuando llega un
+token firmado con un `kid` desconocido (rotación de claves).
+
+Los tokens ya verificados se guardan en una caché LRU indexada por el hash del
+token, junto con su conjunto de roles precalculado, hasta su `exp`.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt as pyjwt
+import requests
+
+# Algoritmo de las claves del JWKS que no declaran `alg`
+ALGORITMO_POR_DEFECTO = 'RS256'
+
+
+def roles_del_token(claims, cliente_id=None):
+    """
+    Roles del realm y de resource_access en un frozenset: de todos los
+    clientes o, con `cliente_id`, solo de ese cliente
+    """
+    roles = set(claims.get('realm_access', {}).get('roles', []))
+    resource_access = claims.get('resource_access', {})
+    if cliente_id is None:
+        clientes = resource_access.values()
+    else:
+        clientes = [resource_access.get(cliente_id, {})]
+    for datos_cliente in clientes:
+        roles.update(datos_cliente.get('roles', []))
+    return frozenset(roles)
+
+
+class ClaimsVerificados(dict):
+    """Claims de un token verificado con sus roles precalculados en `roles_set`"""
+
+    def __init__(self, claims):
+        super().__init__(claims)
+        self.roles_set = roles_del_token(claims)
+        self._roles_cliente = {}
+
+    def roles_cliente(self, cliente_id):
+        """Roles del realm y del cliente indicado (calculados una vez por cliente)"""
+        roles = self._roles_cliente.get(cliente_id)
+        if roles is None:
+            roles = self._roles_cliente[cliente_id] = roles_del_token(self, cliente_id)
+        return roles
+
+
+class TokenCache:
+    """LRU acotada de tokens verificados; cada entrada caduca en el `exp` del token"""
+
+    def __init__(self, max_entradas=None):
+        self.max_entradas = (
+            max_entradas if max_entradas is not None
+            else int(os.getenv('KEYCLOAK_TOKEN_CACHE_SIZE', '1024'))
+        )
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expirados = 0
+
+    @staticmethod
+    def _clave(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def obtener(self, token):
+        """Devuelve los ClaimsVerificados del token o None si no está o ya expiró"""
+        clave = self._clave(token)
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                self.misses += 1
+                return None
+            claims, exp = entrada
+            if exp <= time.time():
+                del self._entradas[clave]
+                self.expirados += 1
+                self.misses += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.hits += 1
+            return claims
+
+    def guardar(self, token, claims):
+        """Guarda claims ya verificados; los tokens sin `exp` no se cachean"""
+        exp = claims.get('exp')
+        if not isinstance(exp, (int, float)) or exp <= time.time() or self.max_entradas <= 0:
+            return
+        with self._lock:
+            clave = self._clave(token)
+            self._entradas[clave] = (claims, exp)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'expirados': self.expirados,
+                'entradas': len(self._entradas)
+            }
+
+
+class KeycloakKeyProvider:
+    """Caché de claves de firma del realm indexadas por `kid`"""
+
+    def __init__(self, server_url, realm, ttl=None, intervalo_minimo=None, timeout=5):
+        self.jwks_url = f"{server_url.rstrip('/')}/realms/{realm}/protocol/openid-connect/certs"
+        self.ttl = ttl if ttl is not None else int(os.getenv('KEYCLOAK_JWKS_TTL', '300'))
+        # Tiempo mínimo entre refrescos forzados por `kid` desconocido
+        self.intervalo_minimo = (
+            intervalo_minimo if intervalo_minimo is not None
+            else int(os.getenv('KEYCLOAK_JWKS_MIN_REFRESH', '10'))
+        )
+        self.timeout = timeout
+        self.tokens = TokenCache()
+
+        self._claves = {}
+        self._cargado_en = 0.0
+        self._ultimo_intento = 0.0
+        self._refrescando = False
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def _descargar(self):
+        """Descarga el JWKS y reemplaza las claves en caché"""
+        with self._lock:
+            self._ultimo_intento = time.monotonic()
+        try:
+            respuesta = requests.get(self.jwks_url, timeout=self.timeout)
+            respuesta.raise_for_status()
+            claves = {}
+            for jwk in respuesta.json().get('keys', []):
+                if jwk.get('use', 'sig') != 'sig' or not jwk.get('kid'):
+                    continue
+                try:
+                    claves[jwk['kid']] = pyjwt.PyJWK(jwk)
+                except Exception as e:
+                    print(f"⚠️ Clave JWKS ignorada ({jwk.get('kid')}): {e}")
+            with self._lock:
+                self._claves = claves
+                self._cargado_en = time.monotonic()
+                self.refreshes += 1
+            print(f"✓ JWKS actualizado: {len(claves)} claves de firma")
+        except Exception as e:
+            with self._lock:
+                self.refresh_errors += 1
+            print(f"✗ Error al descargar JWKS: {e}")
+        finally:
+            with self._lock:
+                self._refrescando = False
+
+    def _refrescar_en_segundo_plano(self):
+        with self._lock:
+            if self._refrescando:
+                return
+            self._refrescando = True
+        threading.Thread(target=self._descargar, daemon=True).start()
+
+    def obtener_clave(self, kid):
+        """Devuelve la clave (PyJWK) para el `kid` indicado o None"""
+        with self._lock:
+            clave = self._claves.get(kid)
+            vencido = time.monotonic() - self._cargado_en > self.ttl
+            puede_forzar = time.monotonic() - self._ultimo_intento >= self.intervalo_minimo
+            if clave is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if clave is not None:
+            if vencido:
+                self._refrescar_en_segundo_plano()
+            return clave
+
+        # `kid` desconocido: posible rotación, refrescar de inmediato (con límite)
+        if puede_forzar:
+            with self._lock:
+                self._refrescando = True
+            self._descargar()
+            with self._lock:
+                return self._claves.get(kid)
+        return None
+
+    def decodificar(self, token):
+        """Verifica firma y expiración del token localmente y devuelve sus claims"""
+        encabezado = pyjwt.get_unverified_header(token)
+        clave = self.obtener_clave(encabezado.get('kid'))
+        if clave is None:
+            raise pyjwt.InvalidTokenError(f"Clave de firma desconocida: {encabezado.get('kid')}")
+
+        return pyjwt.decode(
+            token,
+            key=clave.key,
+            # El algoritmo lo fija la clave publicada (JWKS), nunca el encabezado del token
+            algorithms=[getattr(clave, 'algorithm_name', None) or ALGORITMO_POR_DEFECTO],
+            options={
+                "verify_signature": True,
+                "verify_aud": False,
+                "verify_exp": True
+            }
+        )
+
+    def verificar(self, token):
+        """Como `decodificar`, pero reutiliza los tokens ya verificados hasta su `exp`"""
+        claims = self.tokens.obtener(token)
+        if claims is None:
+            claims = ClaimsVerificados(self.decodificar(token))
+            self.tokens.guardar(token, claims)
+        return claims
+
+    def stats(self):
+        """Contadores de uso de la caché de claves y de tokens"""
+        with self._lock:
+            datos = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'refresh_errors': self.refresh_errors,
+                'claves': len(self._claves)
+            }
+        datos['tokens'] = self.tokens.stats()
+        return datos
+
+
+_proveedores = {}
+_proveedores_lock = threading.Lock()
+
+
+def obtener_proveedor_claves(server_url=None, realm=None):
+    """Devuelve el proveedor de claves compartido del proceso para el realm"""
+    server_url = server_url or os.getenv('KEYCLOAK_SERVER_URL', 'http://localhost:8082')
+    realm = realm or os.getenv('KEYCLOAK_REALM', 'plataformaInstitucional')
+    with _proveedores_lock:
+        proveedor = _proveedores.get((server_url, realm))
+        if proveedor is None:
+            proveedor = KeycloakKeyProvider(server_url, realm)
+            _proveedores[(server_url, realm)] = proveedor
+        return proveedor
@@ -0,0 +1,177 @@
+"""
+Script para llevar los registros de asistencia a un documento por
+(id_curso, id_grupo, fecha) y crear el índice único del catálogo
+(idx_asistencia_curso_grupo_fecha) en el que se apoya el guardado de asistencia
+
+Uso:
+    python database/migrate_attendance_unique.py            # simulación
+    python database/migrate_attendance_unique.py --aplicar
+
+Sin --aplicar solo informa lo que haría, sin modificar nada.
+
+1. A los registros sin id_grupo (anteriores a este cambio) se les asigna el
+   grupo de sus estudiantes, entre los grupos donde se dicta el curso.
+2. Los registros repetidos del mismo curso, grupo y día se combinan en el más
+   reciente: se conservan sus registros y se agregan los de estudiantes que
+   solo aparecen en los demás; luego se eliminan los demás.
+3. Se elimina el índice único anterior por (id_curso, fecha), se crea el del
+   catálogo y se recalculan los contadores de los cursos afectados.
+"""
+
+import sys
+import os
+from collections import Counter
+
+# Agregar el path del backend para importar db_config
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from pymongo import UpdateOne
+
+from database.db_config import (
+    DatabaseConfig,
+    get_asistencia_collection,
+    get_asignaciones_collection,
+    get_matriculas_collection
+)
+from database.asistencia import recalcular_contadores
+
+# Índice único anterior: no deja que dos grupos del mismo curso registren el mismo día
+INDICE_ANTERIOR = 'idx_asistencia_curso_fecha'
+
+
+def grupo_de_registro(documento, grupos_del_curso):
+    """Grupo más frecuente entre las matrículas de los estudiantes del registro (None si no hay)"""
+    ids = [item['id_estudiante'] for item in documento.get('registros', [])]
+    if not ids or not grupos_del_curso:
+        return None
+    conteo = Counter(
+        m['id_grupo'] for m in get_matriculas_collection().find(
+            {'id_estudiante': {'$in': ids}, 'id_grupo': {'$in': grupos_del_curso}},
+            {'id_grupo': 1}
+        )
+    )
+    return conteo.most_common(1)[0][0] if conteo else None
+
+
+def planear():
+    """
+    Recorre la asistencia y devuelve el plan de la migración: grupos a asignar,
+    registros sin grupo identificable y conjuntos repetidos (el más reciente primero)
+    """
+    asistencia = get_asistencia_collection()
+    asignaciones = get_asignaciones_collection()
+    grupos_por_curso = {}
+
+    asignar = {}
+    sin_grupo = []
+    por_clave = {}
+    cursor = asistencia.find(
+        {},
+        {'id_curso': 1, 'id_grupo': 1, 'fecha': 1, 'registros.id_estudiante': 1}
+    ).sort([('actualizado_en', -1), ('_id', -1)])
+
+    for doc in cursor:
+        id_grupo = doc.get('id_grupo')
+        if id_grupo is None:
+            id_curso = doc['id_curso']
+            if id_curso not in grupos_por_curso:
+                grupos_por_curso[id_curso] = asignaciones.distinct('id_grupo', {'id_curso': id_curso})
+            id_grupo = grupo_de_registro(doc, grupos_por_curso[id_curso])
+            if id_grupo is None:
+                sin_grupo.append(doc['_id'])
+                continue
+            asignar[doc['_id']] = id_grupo
+        por_clave.setdefault((doc['id_curso'], id_grupo, doc['fecha']), []).append(doc['_id'])
+
+    repetidos = [ids for ids in por_clave.values() if len(ids) > 1]
+    return asignar, sin_grupo, repetidos
+
+
+def combinar_repetidos(repetidos, aplicar):
+    """
+    Combina cada conjunto repetido en su registro más reciente. Devuelve
+    (registros eliminados, estudiantes agregados, cursos afectados)
+    """
+    asistencia = get_asistencia_collection()
+    eliminados = 0
+    agregados = 0
+    cursos = set()
+
+    for ids in repetidos:
+        documentos = {doc['_id']: doc for doc in asistencia.find({'_id': {'$in': ids}})}
+        conservar = documentos[ids[0]]
+        registros = list(conservar.get('registros', []))
+        presentes = {item['id_estudiante'] for item in registros}
+        # Del más reciente al más antiguo: cada estudiante conserva su último estado
+        for id_doc in ids[1:]:
+            for item in documentos[id_doc].get('registros', []):
+                if item['id_estudiante'] not in presentes:
+                    presentes.add(item['id_estudiante'])
+                    registros.append(item)
+
+        extra = len(registros) - len(conservar.get('registros', []))
+        agregados += extra
+        eliminados += len(ids) - 1
+        cursos.add(conservar['id_curso'])
+
+        if aplicar:
+            if extra:
+                asistencia.update_one({'_id': conservar['_id']}, {'$set': {'registros': registros}})
+            asistencia.delete_many({'_id': {'$in': ids[1:]}})
+
+    return eliminados, agregados, cursos
+
+
+if __name__ == '__main__':
+    try:
+        aplicar = '--aplicar' in sys.argv[1:]
+
+        # Los índices se crean al final, con los datos ya depurados
+        DatabaseConfig.ENSURE_INDEXES = False
+
+        print("🔄 Analizando registros de asistencia...")
+        asignar, sin_grupo, repetidos = planear()
+        eliminados, agregados, cursos = combinar_repetidos(repetidos, aplicar=False)
+
+        print(f"📊 Registros sin id_grupo a los que se asigna grupo: {len(asignar)}")
+        print(f"📊 Días repetidos por curso y grupo: {len(repetidos)}")
+        print(f"📊 Registros que se eliminarían al combinar: {eliminados} "
+              f"(estudiantes agregados al registro conservado: {agregados}, cursos afectados: {len(cursos)})")
+        if sin_grupo:
+            print(f"⚠️ Registros sin grupo identificable (se dejan sin cambios): {len(sin_grupo)}")
+            for id_doc in sin_grupo[:20]:
+                print(f"   - {id_doc}")
+
+        if not aplicar:
+            print("ℹ️ Simulación: no se modificó nada. Ejecute con --aplicar para migrar")
+        else:
+            asistencia = get_asistencia_collection()
+            if asignar:
+                asistencia.bulk_write(
+                    [UpdateOne({'_id': id_doc}, {'$set': {'id_grupo': id_grupo}})
+                     for id_doc, id_grupo in asignar.items()],
+                    ordered=False
+                )
+                print(f"✅ Grupo asignado a {len(asignar)} registros")
+
+            eliminados, agregados, cursos = combinar_repetidos(repetidos, aplicar=True)
+            print(f"✅ Registros repetidos combinados: {eliminados} eliminados, {agregados} estudiantes agregados")
+
+            if INDICE_ANTERIOR in asistencia.index_information():
+                asistencia.drop_index(INDICE_ANTERIOR)
+                print(f"✅ Índice anterior eliminado: asistencia.{INDICE_ANTERIOR}")
+
+            for id_curso in cursos:
+                recalcular_contadores(id_curso)
+            if cursos:
+                print(f"✅ Contadores recalculados para {len(cursos)} cursos")
+
+            print("🔄 Creando el índice único de asistencia...")
+            DatabaseConfig.asegurar_indices(recrear=True)
+            print("✅ Migración completada")
+
+    except Exception as e:
+        print(f"❌ Error en la migración de asistencia: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,145 @@
+"""
+Historial de calificaciones (colección notas_ledger, solo inserción).
+
+Cada cambio sobre matriculas.calificaciones[].notas[] se registra como un
+evento con la matrícula, la asignación, el periodo y la fecha (`ts`):
+
+    agregar          nota nueva al final del bloque          (nota)
+    modificar        cambia campos de una nota               (id_nota, indice, cambios)
+    reemplazar       sustituye una nota completa             (id_nota, indice, nota)
+    eliminar         quita una nota                          (id_nota, indice)
+    eliminar_bloque  quita el bloque completo
+
+Los arreglos embebidos en las matrículas son una proyección de estos eventos:
+reproducirlos en orden (`ts`, `_id`) da el estado del bloque en cualquier
+fecha. Las notas se localizan por `id_nota` y, si no lo tienen (notas
+anteriores al historial), por su posición en el momento del evento.
+"""
+
+from datetime import datetime
+
+from bson import ObjectId
+
+from .db_config import get_notas_ledger_collection
+
+EVENTOS = ('agregar', 'modificar', 'reemplazar', 'eliminar', 'eliminar_bloque')
+
+
+def evento_nota(evento, id_matricula, id_asignacion, periodo, id_usuario=None, **datos):
+    """Documento de un evento del historial; `datos` son los campos propios del evento"""
+    if evento not in EVENTOS:
+        raise ValueError(f'Evento de calificación desconocido: {evento}')
+    documento = {
+        'id_matricula': id_matricula,
+        'id_asignacion': id_asignacion,
+        'periodo': periodo,
+        'ts': datetime.utcnow(),
+        'evento': evento,
+        'id_usuario': id_usuario
+    }
+    documento.update(datos)
+    return documento
+
+
+def registrar_eventos(eventos):
+    """Inserta los eventos en orden. Devuelve cuántos se registraron"""
+    eventos = list(eventos)
+    if eventos:
+        get_notas_ledger_collection().insert_many(eventos, ordered=True)
+    return len(eventos)
+
+
+def registrar_evento(evento, id_matricula, id_asignacion, periodo, id_usuario=None, **datos):
+    """Registra un único evento (ver `evento_nota`)"""
+    registrar_eventos([evento_nota(evento, id_matricula, id_asignacion, periodo, id_usuario, **datos)])
+
+
+def consultar_eventos(id_matricula, id_asignacion=None, periodo=None, hasta=None):
+    """
+    Eventos de la matrícula (opcionalmente de una asignación y periodo) con
+    `ts` <= `hasta`, en el orden en que deben reproducirse.
+    """
+    filtro = {'id_matricula': id_matricula}
+    if id_asignacion is not None:
+        filtro['id_asignacion'] = id_asignacion
+        if periodo is not None:
+            filtro['periodo'] = periodo
+    if hasta is not None:
+        filtro['ts'] = {'$lte': hasta}
+    return get_notas_ledger_collection().find(filtro, {'_id': 0}).sort([('ts', 1), ('_id', 1)])
+
+
+def _posicion(notas, evento):
+    id_nota = evento.get('id_nota')
+    if id_nota is not None:
+        for posicion, nota in enumerate(notas):
+            if nota.get('id_nota') == id_nota:
+                return posicion
+    indice = evento.get('indice')
+    if indice is not None and 0 <= indice < len(notas):
+        return indice
+    return None
+
+
+def aplicar_evento(bloques, evento):
+    """Aplica un evento a `bloques` ({(id_asignacion, periodo): [notas]})"""
+    clave = (evento['id_asignacion'], evento.get('periodo'))
+    tipo = evento['evento']
+
+    if tipo == 'eliminar_bloque':
+        bloques.pop(clave, None)
+        return
+    if tipo == 'agregar':
+        bloques.setdefault(clave, []).append(dict(evento['nota']))
+        return
+
+    notas = bloques.get(clave)
+    posicion = _posicion(notas, evento) if notas else None
+    if posicion is None:
+        return
+    if tipo == 'modificar':
+        notas[posicion] = {**notas[posicion], **evento.get('cambios', {})}
+    elif tipo == 'reemplazar':
+        notas[posicion] = dict(evento['nota'])
+    elif tipo == 'eliminar':
+        notas.pop(posicion)
+        # Igual que en la escritura: un bloque sin notas desaparece
+        if not notas:
+            bloques.pop(clave)
+
+
+def reproducir(eventos):
+    """Estado de los bloques tras aplicar `eventos` en orden (en orden de creación)"""
+    bloques = {}
+    for evento in eventos:
+        aplicar_evento(bloques, evento)
+    return bloques
+
+
+def eventos_iniciales(matricula, id_usuario=None):
+    """
+    Eventos `agregar` que reproducen las notas actuales de una matrícula que
+    aún no tiene historial. Las notas sin `id_nota` reciben uno nuevo, que
+    debe guardarse también en la proyección.
+    """
+    ahora = datetime.utcnow()
+    eventos = []
+    for bloque in matricula.get('calificaciones') or []:
+        if 'id_asignacion' not in bloque or not isinstance(bloque.get('notas'), list):
+            continue
+        anterior = None
+        for nota in bloque['notas']:
+            nota = dict(nota)
+            nota.setdefault('id_nota', ObjectId())
+            fecha = nota.get('fecha_eval')
+            evento = evento_nota(
+                'agregar', matricula['_id'], bloque['id_asignacion'], bloque.get('periodo'),
+                id_usuario, nota=nota, origen='migracion'
+            )
+            # La fecha de la evaluación aproxima cuándo se registró la nota; nunca
+            # antes que la nota anterior, para conservar el orden del bloque
+            if isinstance(fecha, datetime) and fecha < ahora:
+                evento['ts'] = max(fecha, anterior) if anterior else fecha
+            anterior = evento['ts']
+            eventos.append(evento)
+    return eventos
@@ -10,6 +10,10 @@ from bson.timestamp import Timestamp
 # Agregar el path del backend para importar db_config
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from database.db_config import (
+    DatabaseConfig,
+    estadisticas_auditoria,
+    en_lotes,
+    get_loader,
     get_cursos_collection,
     get_usuarios_collection,
     get_matriculas_collection,
@@ -18,8 +22,26 @@ from database.db_config import (
     string_to_objectid,
     registrar_auditoria
 )
+from database.json_provider import BSONJSONProvider
+from database.keycloak_auth import ClaimsVerificados, obtener_proveedor_claves, roles_del_token
+from database.calificaciones import (
+    NOTA_MAXIMA,
+    TAMANO_LOTE_CALIFICACIONES,
+    LoteCalificaciones,
+    filtro_nota,
+    notas_a_la_fecha,
+    nueva_nota,
+    pipeline_agregar_notas,
+    pipeline_eliminar_nota,
+    pipeline_modificar_nota,
+    promedio_bloque
+)
+from database.notas_ledger import registrar_evento
+from database.grade_engine import NOTA_APROBACION, bloque_visible, calcular_planilla, periodo_bloque
+from database.audit_store import leer_fecha
 
 app = Flask(__name__)
+app.json = BSONJSONProvider(app)
 app.secret_key = "PlataformaColegios"
 
 # 🔧 CORS CONFIGURACIÓN
@@ -55,15 +77,19 @@ try:
 except Exception:
     keycloak_openid = None
 
+# Claves de firma del realm en caché (verificación de tokens sin red)
+proveedor_claves = obtener_proveedor_claves(KEYCLOAK_SERVER, KEYCLOAK_REALM)
+
 def tiene_rol(token_info, cliente_id, rol_requerido):
     try:
-        realm_roles = token_info.get("realm_access", {}).get("roles", [])
-        if rol_requerido in realm_roles:
-            return True
-        resource_roles = token_info.get("resource_access", {}).get(cliente_id, {}).get("roles", [])
-        if rol_requerido in resource_roles:
-            return True
-        return False
+        # Solo roles del realm y del cliente de este servicio
+        if isinstance(token_info, ClaimsVerificados):
+            roles = token_info.roles_cliente(cliente_id)
+        else:
+            roles = roles_del_token(token_info, cliente_id)
+        if isinstance(rol_requerido, str):
+            return rol_requerido in roles
+        return not roles.isdisjoint(rol_requerido)
     except Exception:
         return False
 
@@ -82,18 +108,9 @@ def token_required(rol_requerido):
                 
                 # Intentar decodificar con Keycloak
                 try:
-                    public_key_pem = f"-----BEGIN PUBLIC KEY-----\n{keycloak_openid.public_key()}\n-----END PUBLIC KEY-----"
-                    
-                    userinfo = keycloak_openid.decode_token(
-                        token,
-                        key=public_key_pem,
-                        options={
-                            "verify_signature": True,
-                            "verify_aud": False,
-                            "verify_exp": True
-                        }
-                    )
-                    print(f"✅ Token decodificado con Keycloak")
+                    # Verificación local con las claves JWKS en caché (sin ir a Keycloak)
+                    userinfo = proveedor_claves.verificar(token)
+                    print(f"✅ Token verificado con JWKS en caché")
                     
                 except Exception as decode_error:
                     print(f"⚠️ Error con Keycloak: {decode_error}")
@@ -131,13 +148,14 @@ def home():
             'update_grade': 'PUT /grades/<enrollment_id>',
             'delete_grade': 'DELETE /grades/<enrollment_id>/<grade_index>',
             'calculate_average': 'GET /grades/average/<enrollment_id>',
+            'grades_as_of': 'GET /grades/history/<enrollment_id>?as_of=AAAA-MM-DD',
             'bulk_upload': 'POST /grades/bulk'
         }
     })
 
 @app.route('/health')
 def health():
-    return jsonify({'status': 'healthy', 'service': 'grades', 'database': 'MongoDB'})
+    return jsonify({'status': 'healthy', 'service': 'grades', 'database': 'MongoDB', 'auth_keys': proveedor_claves.stats(), 'db_pool': DatabaseConfig.estadisticas_pool(), 'audit': estadisticas_auditoria()})
 
 @app.route('/grades/course/<course_id>', methods=['GET'])
 def get_course_grades(course_id):
@@ -175,25 +193,25 @@ def get_course_grades(course_id):
             'estado': 'activa'
         }))
         
+        # Planilla del curso: por estudiante, los bloques de su asignación (todos los periodos)
+        periodo = request.args.get('periodo')
+        filas = []
+        for enrollment in enrollments:
+            asig = asignacion_por_grupo.get(enrollment.get('id_grupo'))
+            filas.append((enrollment, [
+                item for item in enrollment.get('calificaciones', [])
+                if asig and item.get('id_asignacion') == asig['_id']
+            ]))
+        
         # Formatear datos
         grades_data = []
-        for enrollment in enrollments:
+        for (enrollment, bloques), resultado in zip(filas, calcular_planilla(filas).resultados()):
             student_info = enrollment.get('estudiante_info', {})
             asig = asignacion_por_grupo.get(enrollment.get('id_grupo'))
-            notas = []
-
-            if asig:
-                for item in enrollment.get('calificaciones', []):
-                    if item.get('id_asignacion') == asig['_id']:
-                        notas = item.get('notas', [])
-                        break
-            
-            # Calcular promedio
-            promedio = 0
-            if notas:
-                total = sum(n.get('nota', 0) * n.get('peso', 0) for n in notas)
-                total_peso = sum(n.get('peso', 0) for n in notas)
-                promedio = round(total / total_peso, 2) if total_peso > 0 else 0
+            # Notas del periodo pedido (o del primer bloque) y su promedio
+            bloque = bloque_visible(bloques, periodo)
+            notas = bloque.get('notas', []) if bloque else []
+            promedio = resultado['periodos'].get(periodo_bloque(bloque), 0) if bloque else 0
             
             grades_data.append({
                 'enrollment_id': str(enrollment['_id']),
@@ -202,6 +220,8 @@ def get_course_grades(course_id):
                 'student_code': student_info.get('codigo_est', ''),
                 'grades': serialize_doc(notas),
                 'average': promedio,
+                'period_averages': resultado['periodos'],
+                'final_average': resultado['final'],
                 'assignment_id': str(asig['_id']) if asig else None,
                 'group_id': str(enrollment.get('id_grupo')) if enrollment.get('id_grupo') else None
             })
@@ -221,7 +241,6 @@ def get_student_grades(student_id):
     """Obtener todas las calificaciones de un estudiante"""
     try:
         matriculas = get_matriculas_collection()
-        asignaciones = get_asignaciones_collection()
         
         # Convertir ID a ObjectId
         estudiante_obj_id = string_to_objectid(student_id)
@@ -252,8 +271,12 @@ def get_student_grades(student_id):
         total_average = 0
         count_courses = 0
         
-        # Cache simple para evitar varias lecturas de la misma asignacion
-        asignacion_cache = {}
+        # Cargar todas las asignaciones referenciadas en una sola consulta
+        asignaciones = get_loader('asignaciones_docentes').agregar(
+            cal.get('id_asignacion')
+            for enrollment in enrollments
+            for cal in enrollment.get('calificaciones', [])
+        )
 
         for enrollment in enrollments:
             for cal_asignacion in enrollment.get('calificaciones', []):
@@ -262,10 +285,7 @@ def get_student_grades(student_id):
                     continue
 
                 asig_key = str(id_asignacion)
-                if asig_key not in asignacion_cache:
-                    asignacion_cache[asig_key] = asignaciones.find_one({'_id': id_asignacion})
-
-                asig = asignacion_cache.get(asig_key)
+                asig = asignaciones.obtener(id_asignacion)
                 if not asig:
                     continue
 
@@ -278,9 +298,7 @@ def get_student_grades(student_id):
                 notas = cal_asignacion.get('notas', [])
                 promedio_curso = 0
                 if notas:
-                    total = sum(n.get('nota', 0) * n.get('peso', 0) for n in notas)
-                    total_peso = sum(n.get('peso', 0) for n in notas)
-                    promedio_curso = round(total / total_peso, 2) if total_peso > 0 else 0
+                    promedio_curso = round(promedio_bloque(cal_asignacion), 2)
                     total_average += promedio_curso
                     count_courses += 1
 
@@ -331,7 +349,7 @@ def add_grade():
         
         # Validar nota
         nota = float(data['nota'])
-        nota_maxima = float(data.get('nota_maxima', 5.0))
+        nota_maxima = float(data.get('nota_maxima', NOTA_MAXIMA))
         peso = float(data['peso'])
         
         if nota < 0 or nota > nota_maxima:
@@ -361,41 +379,19 @@ def add_grade():
             return jsonify({'success': False, 'error': 'Matrícula no encontrada'}), 404
         
         # Crear objeto de calificación (para insertar en notas[])
-        nueva_calificacion = {
-            'tipo': data['tipo'],
-            'nota': nota,
-            'nota_maxima': nota_maxima,
-            'peso': peso,
-            'fecha_eval': datetime.utcnow(),
-            'comentarios': data.get('comentarios', '')
-        }
+        nueva_calificacion = nueva_nota(
+            data['tipo'], nota, peso, data.get('comentarios', ''), nota_maxima
+        )
         
         periodo_eval = data.get('periodo', '1')
         
-        # Intentar actualizar calificación existente para esta asignación/periodo
-        resultado = matriculas.update_one(
-            {
-                '_id': enrollment_obj_id,
-                'calificaciones.id_asignacion': assignment_obj_id,
-                'calificaciones.periodo': periodo_eval
-            },
-            {'$push': {'calificaciones.$.notas': nueva_calificacion}}
+        # Agregar la nota al bloque de la asignación/periodo (lo crea si no existe)
+        # y recalcular su promedio en la misma operación
+        matriculas.update_one(
+            {'_id': enrollment_obj_id},
+            pipeline_agregar_notas(assignment_obj_id, periodo_eval, [nueva_calificacion])
         )
-        
-        # Si no modificó nada, crear nueva entrada de calificación
-        if resultado.modified_count == 0:
-            matriculas.update_one(
-                {'_id': enrollment_obj_id},
-                {
-                    '$push': {
-                        'calificaciones': {
-                            'id_asignacion': assignment_obj_id,
-                            'periodo': periodo_eval,
-                            'notas': [nueva_calificacion]
-                        }
-                    }
-                }
-            )
+        registrar_evento('agregar', enrollment_obj_id, assignment_obj_id, periodo_eval, nota=nueva_calificacion)
         
         # Registrar auditoría
         registrar_auditoria(
@@ -458,47 +454,61 @@ def update_grade(enrollment_id, assignment_id, note_index):
             return jsonify({'success': False, 'error': 'Índice de nota inválido'}), 400
         
         # Construir actualización
-        update_fields = {}
+        cambios = {}
         
         if 'nota' in data:
             nota = float(data['nota'])
-            nota_maxima = notas[note_index].get('nota_maxima', 5.0)
+            nota_maxima = notas[note_index].get('nota_maxima', NOTA_MAXIMA)
             if nota < 0 or nota > nota_maxima:
                 return jsonify({
                     'success': False,
                     'error': f'La nota debe estar entre 0 y {nota_maxima}'
                 }), 400
-            update_fields[f'calificaciones.$.notas.{note_index}.nota'] = nota
+            cambios['nota'] = nota
         
         if 'peso' in data:
             peso = float(data['peso'])
             if peso < 0 or peso > 1:
                 return jsonify({'success': False, 'error': 'El peso debe estar entre 0 y 1'}), 400
-            update_fields[f'calificaciones.$.notas.{note_index}.peso'] = peso
+            cambios['peso'] = peso
         
         if 'comentarios' in data:
-            update_fields[f'calificaciones.$.notas.{note_index}.comentarios'] = data['comentarios']
+            cambios['comentarios'] = data['comentarios']
         
         if 'tipo' in data:
-            update_fields[f'calificaciones.$.notas.{note_index}.tipo'] = data['tipo']
+            cambios['tipo'] = data['tipo']
         
-        # Actualizar con filtro de asignación
-        if update_fields:
+        # Actualizar la nota y el promedio del bloque en una sola operación,
+        # solo si la nota leída sigue en el bloque
+        periodo = cal_asignacion.get('periodo')
+        nota_actual = notas[note_index]
+        if cambios:
             resultado = matriculas.update_one(
-                {
-                    '_id': enrollment_obj_id,
-                    'calificaciones.id_asignacion': assignment_obj_id
-                },
-                {'$set': update_fields}
+                filtro_nota(enrollment_obj_id, assignment_obj_id, periodo, note_index, nota_actual),
+                pipeline_modificar_nota(
+                    assignment_obj_id, periodo, note_index, cambios, id_nota=nota_actual.get('id_nota')
+                )
             )
+            if resultado.matched_count == 0:
+                return jsonify({
+                    'success': False,
+                    'error': 'La nota cambió mientras se actualizaba, vuelva a consultarla'
+                }), 409
             
-            registrar_auditoria(
-                id_usuario=None,
-                accion='actualizar_calificacion',
-                entidad_afectada='matriculas',
-                id_entidad=enrollment_id,
-                detalles=f"Nota actualizada en índice {note_index} de asignación {assignment_id}"
-            )
+            # Sin cambios efectivos (mismos valores) no hay evento ni auditoría
+            if resultado.modified_count:
+                registrar_evento(
+                    'modificar', enrollment_obj_id, assignment_obj_id, periodo,
+                    id_nota=nota_actual.get('id_nota'), indice=note_index, cambios=cambios
+                )
+                
+                registrar_auditoria(
+                    id_usuario=None,
+                    accion='actualizar_calificacion',
+                    entidad_afectada='matriculas',
+                    id_entidad=enrollment_id,
+                    detalles=f"Nota actualizada en índice {note_index} de asignación {assignment_id}"
+                )
         
         matricula_actualizada = matriculas.find_one({'_id': enrollment_obj_id})
         
@@ -533,11 +543,9 @@ def delete_grade(enrollment_id, assignment_id, note_index):
         
         # Buscar la calificación (con asignación)
         cal_asignacion = None
-        cal_index = None
-        for idx, cal in enumerate(matricula.get('calificaciones', [])):
+        for cal in matricula.get('calificaciones', []):
             if cal.get('id_asignacion') == assignment_obj_id:
                 cal_asignacion = cal
-                cal_index = idx
                 break
         
         if not cal_asignacion:
@@ -547,26 +555,24 @@ def delete_grade(enrollment_id, assignment_id, note_index):
         if note_index < 0 or note_index >= len(notas):
             return jsonify({'success': False, 'error': 'Índice de nota inválido'}), 400
         
-        # Eliminar nota del array anidado
-        notas.pop(note_index)
-        
-        # Si no hay más notas, eliminar la calificación completa
-        if len(notas) == 0:
-            calificaciones = matricula.get('calificaciones', [])
-            calificaciones.pop(cal_index)
-            matriculas.update_one(
-                {'_id': enrollment_obj_id},
-                {'$set': {'calificaciones': calificaciones}}
-            )
-        else:
-            # Actualizar solo el array de notas
-            matriculas.update_one(
-                {
-                    '_id': enrollment_obj_id,
-                    'calificaciones.id_asignacion': assignment_obj_id
-                },
-                {'$set': {'calificaciones.$.notas': notas}}
-            )
+        # Eliminar la nota y recalcular el promedio del bloque; si no quedan
+        # notas, se elimina la calificación completa. Solo si la nota leída
+        # sigue en el bloque
+        periodo = cal_asignacion.get('periodo')
+        nota_actual = notas[note_index]
+        resultado = matriculas.update_one(
+            filtro_nota(enrollment_obj_id, assignment_obj_id, periodo, note_index, nota_actual),
+            pipeline_eliminar_nota(assignment_obj_id, periodo, note_index, id_nota=nota_actual.get('id_nota'))
+        )
+        if resultado.modified_count == 0:
+            return jsonify({
+                'success': False,
+                'error': 'La nota cambió mientras se eliminaba, vuelva a consultarla'
+            }), 409
+        registrar_evento(
+            'eliminar', enrollment_obj_id, assignment_obj_id, periodo,
+            id_nota=nota_actual.get('id_nota'), indice=note_index
+        )
         
         registrar_auditoria(
             id_usuario=None,
@@ -631,12 +637,9 @@ def calculate_average(enrollment_id, assignment_id):
                 'period': cal_asignacion.get('periodo', '1')
             }), 200
         
-        # Calcular promedio ponderado de las notas anidadas
-        total = sum(n.get('nota', 0) * n.get('peso', 0) for n in notas)
-        total_peso = sum(n.get('peso', 0) for n in notas)
-        
-        promedio = round(total / total_peso, 2) if total_peso > 0 else 0
-        estado = 'aprobado' if promedio >= 3.0 else 'reprobado'
+        # Promedio ponderado mantenido en el bloque
+        promedio = round(promedio_bloque(cal_asignacion), 2)
+        estado = 'aprobado' if promedio >= NOTA_APROBACION else 'reprobado'
         
         return jsonify({
             'success': True,
@@ -652,6 +655,52 @@ def calculate_average(enrollment_id, assignment_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
     
+@app.route('/grades/history/<enrollment_id>', methods=['GET'])
+def get_grades_as_of(enrollment_id):
+    """
+    Calificaciones de una matrícula tal como estaban en una fecha, reconstruidas
+    desde el historial. Parámetros: as_of (AAAA-MM-DD o ISO 8601, por defecto
+    ahora), assignment_id y periodo opcionales.
+    """
+    try:
+        enrollment_obj_id = string_to_objectid(enrollment_id)
+        if not enrollment_obj_id:
+            return jsonify({'success': False, 'error': 'ID de matrícula inválido'}), 400
+        
+        assignment_obj_id = None
+        if request.args.get('assignment_id'):
+            assignment_obj_id = string_to_objectid(request.args['assignment_id'])
+            if not assignment_obj_id:
+                return jsonify({'success': False, 'error': 'ID de asignación inválido'}), 400
+        
+        # Una fecha sin hora incluye todo ese día
+        fecha = leer_fecha(request.args.get('as_of'), fin_de_dia=True) or datetime.utcnow()
+        
+        bloques = notas_a_la_fecha(
+            enrollment_obj_id,
+            fecha,
+            assignment_obj_id,
+            request.args.get('periodo') if assignment_obj_id else None
+        )
+        
+        return jsonify({
+            'success': True,
+            'enrollment_id': enrollment_id,
+            'as_of': fecha.isoformat(),
+            'grades': [{
+                'assignment_id': str(bloque['id_asignacion']),
+                'period': bloque['periodo'],
+                'average': round(bloque['promedio'], 2),
+                'total_grades': bloque['n_notas'],
+                'grades': serialize_doc(bloque['notas'])
+            } for bloque in bloques]
+        }), 200
+        
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/grades/bulk', methods=['POST'])
 def bulk_upload_grades():
     """Carga masiva de calificaciones para un curso"""
@@ -685,84 +734,82 @@ def bulk_upload_grades():
 
         asignacion_por_grupo = {asig['id_grupo']: asig for asig in asignaciones_curso}
         grupos_asignados = list(asignacion_por_grupo.keys())
+        proyeccion = {'id_estudiante': 1, 'id_grupo': 1}
         
         successful = 0
         failed = 0
         errors = []
         
-        # Procesar cada calificación
-        for grade_entry in data['grades']:
-            try:
-                student_id = grade_entry.get('student_id')
-                nota = float(grade_entry.get('nota', 0))
-                comentarios = grade_entry.get('comentarios', '')
-                
-                if not student_id:
+        # Procesar por lotes: una consulta y un bulk_write por lote
+        for lote_entradas in en_lotes(enumerate(data['grades']), TAMANO_LOTE_CALIFICACIONES):
+            validas = []
+            for indice, grade_entry in lote_entradas:
+                try:
+                    student_id = grade_entry.get('student_id')
+                    nota = float(grade_entry.get('nota', 0))
+                    
+                    if not student_id:
+                        failed += 1
+                        errors.append({'index': indice, 'error': 'student_id requerido', 'entry': grade_entry})
+                        continue
+                    
+                    student_obj_id = string_to_objectid(student_id)
+                    if not student_obj_id:
+                        failed += 1
+                        errors.append({'index': indice, 'error': 'ID de estudiante inválido', 'student_id': student_id})
+                        continue
+                    
+                    validas.append((indice, grade_entry, student_obj_id, nota))
+                    
+                except Exception as e:
                     failed += 1
-                    errors.append({'error': 'student_id requerido', 'entry': grade_entry})
-                    continue
-                
-                student_obj_id = string_to_objectid(student_id)
-                
-                # Buscar matrícula activa del estudiante en uno de los grupos del curso
-                matricula = matriculas.find_one({
-                    'id_estudiante': student_obj_id,
-                    'id_grupo': {'$in': grupos_asignados},
-                    'estado': 'activa'
-                })
+                    errors.append({'index': indice, 'error': str(e), 'entry': grade_entry})
+            
+            if not validas:
+                continue
+            
+            # Matrículas activas de los estudiantes del lote en los grupos del curso
+            matricula_por_estudiante = {}
+            for matricula in matriculas.find({
+                'id_estudiante': {'$in': list({v[2] for v in validas})},
+                'id_grupo': {'$in': grupos_asignados},
+                'estado': 'activa'
+            }, proyeccion).sort('_id', 1):
+                matricula_por_estudiante.setdefault(matricula['id_estudiante'], matricula)
+            
+            lote = LoteCalificaciones(matriculas)
+            for indice, grade_entry, student_obj_id, nota in validas:
+                student_id = grade_entry.get('student_id')
+                matricula = matricula_por_estudiante.get(student_obj_id)
                 
                 if not matricula:
                     failed += 1
-                    errors.append({'error': 'Matrícula no encontrada', 'student_id': student_id})
+                    errors.append({'index': indice, 'error': 'Matrícula no encontrada', 'student_id': student_id})
                     continue
-
+                
                 asignacion = asignacion_por_grupo.get(matricula.get('id_grupo'))
                 if not asignacion:
                     failed += 1
-                    errors.append({'error': 'Asignación no encontrada para el grupo del estudiante', 'student_id': student_id})
+                    errors.append({'index': indice, 'error': 'Asignación no encontrada para el grupo del estudiante', 'student_id': student_id})
                     continue
-
-                periodo_eval = periodo or asignacion.get('periodo', '1')
                 
-                # Agregar calificación
-                nueva_calificacion = {
-                    'tipo': tipo_evaluacion,
-                    'nota': nota,
-                    'nota_maxima': 5.0,
-                    'peso': peso,
-                    'fecha_eval': datetime.utcnow(),
-                    'comentarios': comentarios
-                }
+                periodo_eval = periodo or asignacion.get('periodo', '1')
                 
                 # Guardar en la estructura anidada por asignación/periodo
-                resultado = matriculas.update_one(
-                    {
-                        '_id': matricula['_id'],
-                        'calificaciones.id_asignacion': asignacion['_id'],
-                        'calificaciones.periodo': periodo_eval
-                    },
-                    {'$push': {'calificaciones.$.notas': nueva_calificacion}}
+                lote.agregar(
+                    matricula['_id'],
+                    asignacion['_id'],
+                    periodo_eval,
+                    nueva_nota(tipo_evaluacion, nota, peso, grade_entry.get('comentarios', '')),
+                    (indice, student_id)
                 )
-
-                if resultado.modified_count == 0:
-                    matriculas.update_one(
-                        {'_id': matricula['_id']},
-                        {
-                            '$push': {
-                                'calificaciones': {
-                                    'id_asignacion': asignacion['_id'],
-                                    'periodo': periodo_eval,
-                                    'notas': [nueva_calificacion]
-                                }
-                            }
-                        }
-                    )
-                
-                successful += 1
-                
-            except Exception as e:
-                failed += 1
-                errors.append({'error': str(e), 'entry': grade_entry})
+            
+            enviadas = lote.entradas
+            fallos = lote.ejecutar()
+            successful += enviadas - len(fallos)
+            failed += len(fallos)
+            for (indice, student_id), mensaje in fallos:
+                errors.append({'index': indice, 'error': mensaje, 'student_id': student_id})
         
         # Registrar auditoría
         registrar_auditoria(
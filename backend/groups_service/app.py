@@ -7,9 +7,14 @@ from functools import wraps
 import jwt as pyjwt
 import sys
 import os
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from database.db_config import (
+    DatabaseConfig,
+    estadisticas_auditoria,
+    get_loader,
     get_usuarios_collection,
     get_cursos_collection,
     get_matriculas_collection,
@@ -19,8 +24,14 @@ from database.db_config import (
     get_groups_collection,
     get_horarios_collection
 )
+from database.api_utils import paginar, leer_proyeccion
+from database.json_provider import BSONJSONProvider
+from database.keycloak_auth import obtener_proveedor_claves, roles_del_token
+from database.identity_resolver import invalidar_usuario
+from database.grupos import reservar_cupos, liberar_cupos
 
 app = Flask(__name__)
+app.json = BSONJSONProvider(app)
 app.secret_key = "GruposService"
 
 CORS(app, resources={
@@ -55,35 +66,28 @@ if KeycloakOpenID is not None:
     except Exception:
         keycloak_openid = None
 
+# Claves de firma del realm en caché (verificación de tokens sin red)
+proveedor_claves = obtener_proveedor_claves(KEYCLOAK_SERVER, KEYCLOAK_REALM)
+
 def tiene_rol(token_info, cliente_id, rol_requerido):
     """Comprueba si los claims del token contienen el rol requerido.
 
-    Busca tanto en realm_access como en resource_access[cliente_id].
+    Usa el conjunto de roles (realm_access + todos los resource_access)
+    precalculado al verificar el token; `rol_requerido` puede ser str o lista.
     """
     try:
-        # 1. Buscar en realm_access (roles globales del realm)
-        realm_roles = token_info.get('realm_access', {}).get('roles', [])
-        if rol_requerido in realm_roles:
-            print(f"✓ Rol '{rol_requerido}' encontrado en realm_access")
-            return True
-        
-        # 2. Buscar en resource_access para el cliente específico
-        if cliente_id and cliente_id in token_info.get('resource_access', {}):
-            client_roles = token_info.get('resource_access', {}).get(cliente_id, {}).get('roles', [])
-            if rol_requerido in client_roles:
-                print(f"✓ Rol '{rol_requerido}' encontrado en resource_access[{cliente_id}]")
-                return True
-        
-        # 3. Buscar en TODOS los clientes (fallback)
-        resource_access = token_info.get('resource_access', {})
-        for client_id, client_data in resource_access.items():
-            client_roles = client_data.get('roles', [])
-            if rol_requerido in client_roles:
-                print(f"✓ Rol '{rol_requerido}' encontrado en resource_access[{client_id}]")
-                return True
-        
-        print(f"✗ Rol '{rol_requerido}' NO encontrado. Realm roles: {realm_roles}, Resource access: {list(resource_access.keys())}")
-        return False
+        roles = getattr(token_info, 'roles_set', None)
+        if roles is None:
+            roles = roles_del_token(token_info)
+
+        if isinstance(rol_requerido, str):
+            encontrado = rol_requerido in roles
+        else:
+            encontrado = not roles.isdisjoint(rol_requerido)
+
+        if not encontrado:
+            print(f"✗ Rol '{rol_requerido}' NO encontrado. Roles del token: {sorted(roles)}")
+        return encontrado
         
     except Exception as e:
         print(f"Error al verificar rol: {e}")
@@ -120,18 +124,9 @@ def token_required(roles_permitidos=None):
                 
                 # Intentar decodificar con Keycloak (modo producción)
                 try:
-                    public_key_pem = f"-----BEGIN PUBLIC KEY-----\n{keycloak_openid.public_key()}\n-----END PUBLIC KEY-----"
-                    
-                    userinfo = keycloak_openid.decode_token(
-                        token,
-                        key=public_key_pem,
-                        options={
-                            "verify_signature": True,
-                            "verify_aud": False,
-                            "verify_exp": True
-                        }
-                    )
-                    print(f"✅ Token decodificado con Keycloak")
+                    # Verificación local con las claves JWKS en caché (sin ir a Keycloak)
+                    userinfo = proveedor_claves.verificar(token)
+                    print(f"✅ Token verificado con JWKS en caché")
                     print(f"   Usuario: {userinfo.get('preferred_username', 'N/A')}")
                     print(f"   Email: {userinfo.get('email', 'N/A')}")
                     
@@ -208,13 +203,16 @@ def get_all_groups():
         if activo is not None:
             query['activo'] = activo.lower() == 'true'
         
-        lista_grupos = list(grupos.find(query))
+        lista_grupos, paginacion = paginar(
+            grupos, query, request.args,
+            projection=leer_proyeccion(request.args)
+        )
         
-        # Agregar información de docente director
-        usuarios = get_usuarios_collection()
+        # Agregar información de docente director (una sola consulta para todos)
+        usuarios = get_loader('usuarios').agregar(grupo.get('director_grupo') for grupo in lista_grupos)
         for grupo in lista_grupos:
             if grupo.get('director_grupo'):
-                docente = usuarios.find_one({'_id': grupo['director_grupo']})
+                docente = usuarios.obtener(grupo['director_grupo'])
                 if docente:
                     grupo['director_info'] = {
                         'nombres': docente.get('nombres'),
@@ -224,10 +222,13 @@ def get_all_groups():
         
         return jsonify({
             'success': True,
-            'data': serialize_doc(lista_grupos),
-            'count': len(lista_grupos)
+            'data': lista_grupos,
+            'count': len(lista_grupos),
+            **paginacion
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         print(f"❌ Error en get_all_groups: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -411,7 +412,7 @@ def get_group_schedule(group_id):
 def update_group_schedule(group_id):
     """Actualizar horario de un grupo"""
     try:
-        from database.db_config import get_horarios_collection, get_asignaciones_collection
+        from database.db_config import get_horarios_collection
         
         data = request.get_json()
         
@@ -433,6 +434,11 @@ def update_group_schedule(group_id):
         bloques = data['bloques']
         bloques_procesados = []
         
+        # Cargar todas las asignaciones de los bloques en una sola consulta
+        asignaciones = get_loader('asignaciones_docentes').agregar(
+            string_to_objectid(b['id_asignacion']) for b in bloques if b.get('id_asignacion')
+        )
+        
         for bloque in bloques:
             bloque_procesado = {
                 'dia': bloque['dia'],
@@ -446,8 +452,7 @@ def update_group_schedule(group_id):
             if bloque.get('id_asignacion'):
                 assignment_obj_id = string_to_objectid(bloque['id_asignacion'])
                 if assignment_obj_id:
-                    asignaciones = get_asignaciones_collection()
-                    asignacion = asignaciones.find_one({'_id': assignment_obj_id})
+                    asignacion = asignaciones.obtener(assignment_obj_id)
                     
                     if asignacion:
                         bloque_procesado['id_asignacion'] = assignment_obj_id
@@ -603,53 +608,62 @@ def assign_student_to_group(group_id):
                     'error': f"Estudiante ya asignado al grupo {grupo_actual['nombre_grupo']}"
                 }), 400
         
-        # Verificar capacidad del grupo
-        estudiantes_actuales = usuarios.count_documents({
-            'id_grupo': grupo_obj_id,  # ✅ Usar ObjectId
-            'activo': True
-        })
-        
-        if estudiantes_actuales >= grupo.get('capacidad_max', 40):
+        # Reservar el cupo (atómico frente a otras asignaciones al mismo grupo)
+        if not reservar_cupos(grupos, grupo_obj_id, 1):
             return jsonify({
                 'success': False,
                 'error': 'El grupo ha alcanzado su capacidad máxima'
             }), 400
         
-        # ✅ Asignar grupo al estudiante (usando ObjectId)
-        usuarios.update_one(
-            {'_id': student_obj_id},
-            {'$set': {'id_grupo': grupo_obj_id}}  # ✅ Usar ObjectId
-        )
-        
-        # ✅ Crear matrícula del estudiante en el grupo
-        nueva_matricula = {
-            'id_estudiante': student_obj_id,
-            'id_grupo': grupo_obj_id,
-            'anio_lectivo': '2025',
-            'fecha_matricula': Timestamp(int(datetime.utcnow().timestamp()), 0),
-            'estado': 'activa',
-            'estudiante_info': {
-                'nombres': estudiante.get('nombres'),
-                'apellidos': estudiante.get('apellidos'),
-                'codigo_est': estudiante.get('codigo_est'),
-                'documento': estudiante.get('documento')
-            },
-            'grupo_info': {
-                'nombre_grupo': grupo['nombre_grupo'],
-                'grado': grupo['grado'],
-                'jornada': grupo.get('jornada', 'mañana')
-            },
-            'observaciones': 'Asignación manual desde panel administrativo',
-            'creado_en': Timestamp(int(datetime.utcnow().timestamp()), 0)
-        }
-        
-        matriculas.insert_one(nueva_matricula)
-        
-        # Actualizar contador de estudiantes en el grupo
-        grupos.update_one(
-            {'_id': grupo_obj_id},
-            {'$inc': {'estudiantes_actuales': 1}}
-        )
+        # Si algo falla antes de crear la matrícula se deshace la asignación y se libera el cupo
+        matriculado = False
+        asignado = False
+        try:
+            # ✅ Asignar grupo al estudiante (solo si no cambió de grupo desde la lectura)
+            asignado = usuarios.update_one(
+                {'_id': student_obj_id, 'id_grupo': estudiante.get('id_grupo')},
+                {'$set': {'id_grupo': grupo_obj_id}}  # ✅ Usar ObjectId
+            ).modified_count > 0
+            invalidar_usuario(student_obj_id)
+            if not asignado:
+                return jsonify({
+                    'success': False,
+                    'error': 'El estudiante fue asignado a otro grupo'
+                }), 409
+            
+            # ✅ Crear matrícula del estudiante en el grupo
+            nueva_matricula = {
+                'id_estudiante': student_obj_id,
+                'id_grupo': grupo_obj_id,
+                'anio_lectivo': '2025',
+                'fecha_matricula': Timestamp(int(datetime.utcnow().timestamp()), 0),
+                'estado': 'activa',
+                'estudiante_info': {
+                    'nombres': estudiante.get('nombres'),
+                    'apellidos': estudiante.get('apellidos'),
+                    'codigo_est': estudiante.get('codigo_est'),
+                    'documento': estudiante.get('documento')
+                },
+                'grupo_info': {
+                    'nombre_grupo': grupo['nombre_grupo'],
+                    'grado': grupo['grado'],
+                    'jornada': grupo.get('jornada', 'mañana')
+                },
+                'observaciones': 'Asignación manual desde panel administrativo',
+                'creado_en': Timestamp(int(datetime.utcnow().timestamp()), 0)
+            }
+            
+            matriculas.insert_one(nueva_matricula)
+            matriculado = True
+        finally:
+            if not matriculado:
+                liberar_cupos(grupos, grupo_obj_id, 1)
+                if asignado:
+                    usuarios.update_one(
+                        {'_id': student_obj_id, 'id_grupo': grupo_obj_id},
+                        {'$set': {'id_grupo': estudiante.get('id_grupo')}}
+                    )
+                    invalidar_usuario(student_obj_id)
         
         registrar_auditoria(
             id_usuario=g.userinfo.get('sub'),
@@ -671,6 +685,181 @@ def assign_student_to_group(group_id):
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
     
+@app.route('/groups/<group_id>/assign-students', methods=['POST'])
+@token_required('administrador')
+def assign_students_to_group(group_id):
+    """
+    Asignar varios estudiantes a un grupo y matricularlos.
+
+    Los cupos se reservan de una vez con un $inc condicionado a la capacidad
+    del grupo; los estudiantes y matrículas se escriben con operaciones
+    masivas y los cupos de los que fallen se devuelven al grupo.
+    """
+    try:
+        data = request.get_json()
+        
+        if not data or not isinstance(data.get('student_ids'), list) or not data['student_ids']:
+            return jsonify({'success': False, 'error': 'student_ids requerido'}), 400
+        
+        grupos = get_groups_collection()
+        usuarios = get_usuarios_collection()
+        matriculas = get_matriculas_collection()
+        
+        grupo_obj_id = string_to_objectid(group_id)
+        if not grupo_obj_id:
+            return jsonify({'success': False, 'error': 'ID de grupo inválido'}), 400
+        
+        grupo = grupos.find_one({'_id': grupo_obj_id})
+        if not grupo:
+            return jsonify({'success': False, 'error': 'Grupo no encontrado'}), 404
+        
+        resultados = {}
+        pendientes = []
+        for student_id in data['student_ids']:
+            student_obj_id = string_to_objectid(student_id)
+            if not student_obj_id:
+                resultados[student_id] = 'ID de estudiante inválido'
+            elif student_obj_id not in pendientes:
+                pendientes.append(student_obj_id)
+        
+        # Estudiantes y grupos actuales: dos consultas para todo el lote
+        estudiantes = {
+            est['_id']: est for est in usuarios.find(
+                {'_id': {'$in': pendientes}, 'rol': 'estudiante'},
+                {'nombres': 1, 'apellidos': 1, 'codigo_est': 1, 'documento': 1, 'id_grupo': 1}
+            )
+        }
+        grupos_actuales = {
+            gr['_id']: gr for gr in grupos.find(
+                {'_id': {'$in': list({e['id_grupo'] for e in estudiantes.values() if e.get('id_grupo')})}},
+                {'nombre_grupo': 1}
+            )
+        }
+        
+        candidatos = []
+        for student_obj_id in pendientes:
+            estudiante = estudiantes.get(student_obj_id)
+            if not estudiante:
+                resultados[str(student_obj_id)] = 'Estudiante no encontrado'
+            elif estudiante.get('id_grupo') in grupos_actuales:
+                resultados[str(student_obj_id)] = \
+                    f"Estudiante ya asignado al grupo {grupos_actuales[estudiante['id_grupo']]['nombre_grupo']}"
+            else:
+                candidatos.append(estudiante)
+        
+        # Reservar los cupos de una vez; los que no quepan quedan por fuera
+        reservados = reservar_cupos(grupos, grupo_obj_id, len(candidatos))
+        for estudiante in candidatos[reservados:]:
+            resultados[str(estudiante['_id'])] = 'El grupo ha alcanzado su capacidad máxima'
+        candidatos = candidatos[:reservados]
+        
+        # Estudiantes ya apuntando a este grupo y, de ellos, los que quedaron
+        # matriculados; el finally deshace el resto aunque algo falle a mitad
+        asignados = []
+        matriculados = []
+        try:
+            if candidatos:
+                # Solo se asigna si el estudiante no cambió de grupo desde la lectura
+                try:
+                    usuarios.bulk_write([
+                        UpdateOne(
+                            {'_id': est['_id'], 'id_grupo': est.get('id_grupo')},
+                            {'$set': {'id_grupo': grupo_obj_id}}
+                        ) for est in candidatos
+                    ], ordered=False)
+                except BulkWriteError:
+                    pass
+                confirmados = {
+                    est['_id'] for est in usuarios.find(
+                        {'_id': {'$in': [est['_id'] for est in candidatos]}, 'id_grupo': grupo_obj_id},
+                        {'_id': 1}
+                    )
+                }
+                for estudiante in candidatos:
+                    invalidar_usuario(estudiante['_id'])
+                    if estudiante['_id'] in confirmados:
+                        asignados.append(estudiante)
+                    else:
+                        resultados[str(estudiante['_id'])] = 'El estudiante fue asignado a otro grupo'
+        
+            if asignados:
+                ahora = Timestamp(int(datetime.utcnow().timestamp()), 0)
+                fallidos = {}
+                try:
+                    matriculas.insert_many([{
+                        'id_estudiante': estudiante['_id'],
+                        'id_grupo': grupo_obj_id,
+                        'anio_lectivo': '2025',
+                        'fecha_matricula': ahora,
+                        'estado': 'activa',
+                        'estudiante_info': {
+                            'nombres': estudiante.get('nombres'),
+                            'apellidos': estudiante.get('apellidos'),
+                            'codigo_est': estudiante.get('codigo_est'),
+                            'documento': estudiante.get('documento')
+                        },
+                        'grupo_info': {
+                            'nombre_grupo': grupo['nombre_grupo'],
+                            'grado': grupo['grado'],
+                            'jornada': grupo.get('jornada', 'mañana')
+                        },
+                        'observaciones': 'Asignación masiva desde panel administrativo',
+                        'creado_en': ahora
+                    } for estudiante in asignados], ordered=False)
+                except BulkWriteError as e:
+                    fallidos = {err['index']: err.get('errmsg', 'Error de escritura') for err in e.details.get('writeErrors', [])}
+            
+                for indice, estudiante in enumerate(asignados):
+                    if indice in fallidos:
+                        resultados[str(estudiante['_id'])] = f"No se pudo crear la matrícula: {fallidos[indice]}"
+                    else:
+                        resultados[str(estudiante['_id'])] = None
+                        matriculados.append(estudiante)
+        finally:
+            # Deshacer la asignación de los estudiantes sin matrícula
+            revertir = [est for est in asignados if est not in matriculados]
+            if revertir:
+                usuarios.bulk_write([
+                    UpdateOne(
+                        {'_id': est['_id'], 'id_grupo': grupo_obj_id},
+                        {'$set': {'id_grupo': est.get('id_grupo')}}
+                    ) for est in revertir
+                ], ordered=False)
+                for est in revertir:
+                    invalidar_usuario(est['_id'])
+            # Devolver al grupo los cupos reservados que no se usaron
+            liberar_cupos(grupos, grupo_obj_id, reservados - len(matriculados))
+        asignados = matriculados
+        
+        fallidos = [
+            {'student_id': student_id, 'error': error}
+            for student_id, error in resultados.items() if error
+        ]
+        
+        if asignados:
+            registrar_auditoria(
+                id_usuario=g.userinfo.get('sub'),
+                accion='asignar_estudiantes_grupo',
+                entidad_afectada='usuarios',
+                id_entidad=group_id,
+                detalles=f"{len(asignados)} estudiantes asignados al grupo {grupo['nombre_grupo']}"
+            )
+        
+        return jsonify({
+            'success': True,
+            'message': f'{len(asignados)} estudiantes asignados al grupo {grupo["nombre_grupo"]}',
+            'assigned': [str(est['_id']) for est in asignados],
+            'matriculas_creadas': len(asignados),
+            'failed': len(fallidos),
+            'errors': fallidos if fallidos else None
+        }), 200 if not fallidos else 207
+        
+    except Exception as e:
+        print(f"❌ Error en assign_students_to_group: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # ==========================================
 #   ENDPOINTS DE HORARIOS
 # ==========================================
@@ -681,7 +870,7 @@ def assign_student_to_group(group_id):
 
 @app.route('/health')
 def health():
-    return jsonify({'status': 'healthy', 'service': 'groups'})
+    return jsonify({'status': 'healthy', 'service': 'groups', 'auth_keys': proveedor_claves.stats(), 'db_pool': DatabaseConfig.estadisticas_pool(), 'audit': estadisticas_auditoria()})
 
 
 if __name__ == '__main__':
@@ -18,14 +18,30 @@ from io import BytesIO
 # Agregar el path del backend para importar db_config
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from database.db_config import (
+    DatabaseConfig,
+    estadisticas_auditoria,
+    get_loader,
     get_usuarios_collection,
     get_matriculas_collection,
     serialize_doc,
     string_to_objectid,
     registrar_auditoria
 )
+from database.api_utils import (
+    paginar,
+    leer_proyeccion,
+    leer_formato_stream,
+    cursor_listado,
+    responder_stream
+)
+from database.json_provider import BSONJSONProvider
+from database.keycloak_auth import obtener_proveedor_claves, roles_del_token
+from database.identity_resolver import resolver_usuario, invalidar_usuario
+from database.calificaciones import promedio_bloque
+from database.grade_engine import NOTA_APROBACION, calcular_planilla, periodo_bloque
 
 app = Flask(__name__)
+app.json = BSONJSONProvider(app)
 app.secret_key = "PlataformaColegios"
 
 # 🔧 CORS CONFIGURACIÓN COMPLETA
@@ -61,36 +77,29 @@ if KeycloakOpenID is not None:
     except Exception:
         keycloak_openid = None
 
+# Claves de firma del realm en caché (verificación de tokens sin red)
+proveedor_claves = obtener_proveedor_claves(KEYCLOAK_SERVER, KEYCLOAK_REALM)
+
 
 def tiene_rol(token_info, cliente_id, rol_requerido):
     """Comprueba si los claims del token contienen el rol requerido.
 
-    Busca tanto en realm_access como en resource_access[cliente_id].
+    Usa el conjunto de roles (realm_access + todos los resource_access)
+    precalculado al verificar el token; `rol_requerido` puede ser str o lista.
     """
     try:
-        # 1. Buscar en realm_access (roles globales del realm)
-        realm_roles = token_info.get('realm_access', {}).get('roles', [])
-        if rol_requerido in realm_roles:
-            print(f"✓ Rol '{rol_requerido}' encontrado en realm_access")
-            return True
-        
-        # 2. Buscar en resource_access para el cliente específico
-        if cliente_id and cliente_id in token_info.get('resource_access', {}):
-            client_roles = token_info.get('resource_access', {}).get(cliente_id, {}).get('roles', [])
-            if rol_requerido in client_roles:
-                print(f"✓ Rol '{rol_requerido}' encontrado en resource_access[{cliente_id}]")
-                return True
-        
-        # 3. Buscar en TODOS los clientes (fallback)
-        resource_access = token_info.get('resource_access', {})
-        for client_id, client_data in resource_access.items():
-            client_roles = client_data.get('roles', [])
-            if rol_requerido in client_roles:
-                print(f"✓ Rol '{rol_requerido}' encontrado en resource_access[{client_id}]")
-                return True
-        
-        print(f"✗ Rol '{rol_requerido}' NO encontrado. Realm roles: {realm_roles}, Resource access: {list(resource_access.keys())}")
-        return False
+        roles = getattr(token_info, 'roles_set', None)
+        if roles is None:
+            roles = roles_del_token(token_info)
+
+        if isinstance(rol_requerido, str):
+            encontrado = rol_requerido in roles
+        else:
+            encontrado = not roles.isdisjoint(rol_requerido)
+
+        if not encontrado:
+            print(f"✗ Rol '{rol_requerido}' NO encontrado. Roles del token: {sorted(roles)}")
+        return encontrado
         
     except Exception as e:
         print(f"Error al verificar rol: {e}")
@@ -123,18 +132,9 @@ def token_required(rol_requerido):
                 
                 # Intentar decodificar con Keycloak (modo producción)
                 try:
-                    public_key_pem = f"-----BEGIN PUBLIC KEY-----\n{keycloak_openid.public_key()}\n-----END PUBLIC KEY-----"
-                    
-                    userinfo = keycloak_openid.decode_token(
-                        token,
-                        key=public_key_pem,
-                        options={
-                            "verify_signature": True,
-                            "verify_aud": False,
-                            "verify_exp": True
-                        }
-                    )
-                    print(f"✅ Token decodificado con Keycloak")
+                    # Verificación local con las claves JWKS en caché (sin ir a Keycloak)
+                    userinfo = proveedor_claves.verificar(token)
+                    print(f"✅ Token verificado con JWKS en caché")
                     print(f"   Usuario: {userinfo.get('preferred_username', 'N/A')}")
                     print(f"   Email: {userinfo.get('email', 'N/A')}")
                     
@@ -185,7 +185,91 @@ def home():
 
 @app.route('/health')
 def health():
-    return jsonify({'status': 'healthy', 'service': 'students', 'database': 'MongoDB'})
+    return jsonify({'status': 'healthy', 'service': 'students', 'database': 'MongoDB', 'auth_keys': proveedor_claves.stats(), 'db_pool': DatabaseConfig.estadisticas_pool(), 'audit': estadisticas_auditoria()})
+
+DIAS_SEMANA = {
+    'monday': 'lunes',
+    'tuesday': 'martes',
+    'wednesday': 'miércoles',
+    'thursday': 'jueves',
+    'friday': 'viernes'
+}
+
+
+def _dia_hoy():
+    """Nombre del día actual en español (lunes si es fin de semana)"""
+    return DIAS_SEMANA.get(datetime.now().strftime('%A').lower(), 'lunes')
+
+
+def _eventos_del_dia(horario_grupo, dia):
+    """Bloques del horario del grupo para el día, con el formato del dashboard"""
+    eventos = []
+    for bloque in (horario_grupo or {}).get('horario', []):
+        if bloque.get('dia') == dia:
+            curso_info = bloque.get('curso_info', {})
+            eventos.append({
+                'time': f"{bloque.get('hora_inicio')} - {bloque.get('hora_fin')}",
+                'subject': curso_info.get('nombre_curso', 'N/A'),
+                'teacher': curso_info.get('docente_nombres', 'N/A'),
+                'room': curso_info.get('salon', 'N/A')
+            })
+    return eventos
+
+
+def _calificaciones_recientes(student_matriculas, obtener_asignacion, cantidad=5):
+    """Promedio simple de todas las notas y las `cantidad` más recientes"""
+    all_grades = []
+    for matricula in student_matriculas:
+        for cal_asignacion in matricula.get('calificaciones', []):
+            asignacion = obtener_asignacion(cal_asignacion.get('id_asignacion'))
+            nombre_curso = "N/A"
+            if asignacion:
+                nombre_curso = asignacion.get('curso_info', {}).get('nombre_curso', 'N/A')
+            
+            for nota in cal_asignacion.get('notas', []):
+                all_grades.append({
+                    'subject': nombre_curso,
+                    'grade': nota.get('nota', 0),
+                    'date': nota.get('fecha_eval', '').strftime('%Y-%m-%d') if nota.get('fecha_eval') else ''
+                })
+    
+    # Ordenar por fecha más reciente
+    all_grades.sort(key=lambda x: x['date'], reverse=True)
+    
+    promedio = round(sum(g['grade'] for g in all_grades) / len(all_grades), 2) if all_grades else 0.0
+    return promedio, all_grades[:cantidad]
+
+
+def _cursos_de_matriculas(student_matriculas, obtener_asignacion):
+    """Una entrada por asignación y periodo con el promedio ponderado de sus notas"""
+    cursos = []
+    for matricula in student_matriculas:
+        for cal_asignacion in matricula.get('calificaciones', []):
+            id_asignacion = cal_asignacion.get('id_asignacion')
+            notas = cal_asignacion.get('notas', [])
+            
+            asignacion = obtener_asignacion(id_asignacion)
+            if not asignacion:
+                continue
+            
+            curso_info = asignacion.get('curso_info', {})
+            docente_info = asignacion.get('docente_info', {})
+            
+            # Promedio mantenido en el bloque
+            promedio = round(promedio_bloque(cal_asignacion), 2) if notas else 0
+            
+            cursos.append({
+                'curso_id': str(id_asignacion),
+                'nombre_curso': curso_info.get('nombre_curso', 'N/A'),
+                'codigo_curso': curso_info.get('codigo_curso', 'N/A'),
+                'grado': curso_info.get('grado', 'N/A'),
+                'periodo': cal_asignacion.get('periodo', '1'),
+                'docente': f"{docente_info.get('nombres', '')} {docente_info.get('apellidos', '')}",
+                'promedio': promedio,
+                'calificaciones': serialize_doc(notas)
+            })
+    return cursos
+
 
 @app.route('/student/grades', methods=['GET', 'OPTIONS'])
 @token_required('estudiante')
@@ -200,14 +284,9 @@ def get_student_grades_dashboard():
         if not student_email:
             return jsonify({'success': False, 'error': 'Email no encontrado'}), 400
         
-        usuarios = get_usuarios_collection()
         matriculas = get_matriculas_collection()
         
-        estudiante = usuarios.find_one({
-            'correo': student_email,
-            'rol': 'estudiante',
-            'activo': True
-        })
+        estudiante = resolver_usuario(g.userinfo, 'estudiante')
         
         if not estudiante:
             return jsonify({'success': False, 'error': 'Estudiante no encontrado'}), 404
@@ -224,44 +303,18 @@ def get_student_grades_dashboard():
                 'recent': []
             }), 200
         
-        # Calcular promedio y obtener calificaciones recientes
-        all_grades = []
+        # Cargar todas las asignaciones referenciadas en una sola consulta
+        asignaciones = get_loader('asignaciones_docentes').agregar(
+            cal.get('id_asignacion')
+            for matricula in student_matriculas
+            for cal in matricula.get('calificaciones', [])
+        )
         
-        for matricula in student_matriculas:
-            calificaciones_raw = matricula.get('calificaciones', [])
-            
-            for cal_asignacion in calificaciones_raw:
-                notas = cal_asignacion.get('notas', [])
-                id_asignacion = cal_asignacion.get('id_asignacion')
-                
-                # Obtener nombre del curso
-                from database.db_config import get_asignaciones_collection
-                asignaciones = get_asignaciones_collection()
-                asignacion = asignaciones.find_one({'_id': id_asignacion})
-                
-                nombre_curso = "N/A"
-                if asignacion:
-                    nombre_curso = asignacion.get('curso_info', {}).get('nombre_curso', 'N/A')
-                
-                for nota in notas:
-                    all_grades.append({
-                        'subject': nombre_curso,
-                        'grade': nota.get('nota', 0),
-                        'date': nota.get('fecha_eval', '').strftime('%Y-%m-%d') if nota.get('fecha_eval') else ''
-                    })
-        
-        # Ordenar por fecha más reciente
-        all_grades.sort(key=lambda x: x['date'], reverse=True)
-        
-        # Calcular promedio general
-        if all_grades:
-            promedio = round(sum(g['grade'] for g in all_grades) / len(all_grades), 2)
-        else:
-            promedio = 0.0
+        promedio, recientes = _calificaciones_recientes(student_matriculas, asignaciones.obtener)
         
         return jsonify({
             'average': promedio,
-            'recent': all_grades[:5]  # Últimas 5 calificaciones
+            'recent': recientes  # Últimas 5 calificaciones
         }), 200
         
     except Exception as e:
@@ -322,14 +375,8 @@ def get_student_schedule_dashboard():
         if not student_email:
             return jsonify({'success': False, 'error': 'Email no encontrado'}), 400
         
-        usuarios = get_usuarios_collection()
-        
         # Buscar estudiante
-        estudiante = usuarios.find_one({
-            'correo': student_email,
-            'rol': 'estudiante',
-            'activo': True
-        })
+        estudiante = resolver_usuario(g.userinfo, 'estudiante')
         
         if not estudiante:
             return jsonify({'success': False, 'error': 'Estudiante no encontrado'}), 404
@@ -388,26 +435,7 @@ def get_student_schedule_dashboard():
         print(f"✅ Horario encontrado para {nombre_grupo}")
         
         # ✅ Formatear horario para el dashboard (eventos de hoy)
-        day_of_week = datetime.now().strftime('%A').lower()
-        day_map = {
-            'monday': 'lunes',
-            'tuesday': 'martes',
-            'wednesday': 'miércoles',
-            'thursday': 'jueves',
-            'friday': 'viernes'
-        }
-        dia_hoy = day_map.get(day_of_week, 'lunes')
-        
-        eventos_hoy = []
-        for bloque in horario_grupo.get('horario', []):
-            if bloque.get('dia') == dia_hoy:
-                curso_info = bloque.get('curso_info', {})
-                eventos_hoy.append({
-                    'time': f"{bloque.get('hora_inicio')} - {bloque.get('hora_fin')}",
-                    'subject': curso_info.get('nombre_curso', 'N/A'),
-                    'teacher': curso_info.get('docente_nombres', 'N/A'),
-                    'room': curso_info.get('salon', 'N/A')
-                })
+        eventos_hoy = _eventos_del_dia(horario_grupo, _dia_hoy())
         
         return jsonify({
             'success': True,
@@ -434,7 +462,7 @@ def get_student_profile():
         usuarios = get_usuarios_collection()
         
         # Buscar estudiante
-        estudiante = usuarios.find_one({'correo': student_email, 'rol': 'estudiante'})
+        estudiante = resolver_usuario(g.userinfo, 'estudiante', solo_activos=False)
         
         # ✅ Si no existe, crearlo automáticamente desde Keycloak
         if not estudiante:
@@ -474,14 +502,9 @@ def get_student_courses():
         if not student_email:
             return jsonify({'success': False, 'error': 'Email no encontrado'}), 400
         
-        usuarios = get_usuarios_collection()
         matriculas = get_matriculas_collection()
         
-        estudiante = usuarios.find_one({
-            'correo': student_email,
-            'rol': 'estudiante',
-            'activo': True
-        })
+        estudiante = resolver_usuario(g.userinfo, 'estudiante')
         
         if not estudiante:
             return jsonify({'success': False, 'error': 'Estudiante no encontrado'}), 404
@@ -503,50 +526,14 @@ def get_student_courses():
                 'count': 0
             }), 200
         
-        cursos = []
-        for matricula in student_matriculas:
-            grupo_info = matricula.get('grupo_info', {})
-            calificaciones_raw = matricula.get('calificaciones', [])
-            
-            print(f"📊 Procesando matrícula - Grupo: {grupo_info.get('nombre_grupo')}")
-            print(f"   Calificaciones raw: {len(calificaciones_raw)}")
-            
-            # Procesar cada asignación (asignatura)
-            for cal_asignacion in calificaciones_raw:
-                id_asignacion = cal_asignacion.get('id_asignacion')
-                periodo = cal_asignacion.get('periodo', '1')
-                notas = cal_asignacion.get('notas', [])
-                
-                # Obtener info de la asignación
-                from database.db_config import get_asignaciones_collection
-                asignaciones = get_asignaciones_collection()
-                
-                asignacion = asignaciones.find_one({'_id': id_asignacion})
-                
-                if not asignacion:
-                    continue
-                
-                curso_info = asignacion.get('curso_info', {})
-                docente_info = asignacion.get('docente_info', {})
-                
-                # Calcular promedio de las notas
-                if notas:
-                    total = sum(n.get('nota', 0) * n.get('peso', 0) for n in notas)
-                    total_peso = sum(n.get('peso', 0) for n in notas)
-                    promedio = round(total / total_peso, 2) if total_peso > 0 else 0
-                else:
-                    promedio = 0
-                
-                cursos.append({
-                    'curso_id': str(id_asignacion),
-                    'nombre_curso': curso_info.get('nombre_curso', 'N/A'),
-                    'codigo_curso': curso_info.get('codigo_curso', 'N/A'),
-                    'grado': curso_info.get('grado', 'N/A'),
-                    'periodo': periodo,
-                    'docente': f"{docente_info.get('nombres', '')} {docente_info.get('apellidos', '')}",
-                    'promedio': promedio,
-                    'calificaciones': serialize_doc(notas)
-                })
+        # Cargar todas las asignaciones referenciadas en una sola consulta
+        asignaciones = get_loader('asignaciones_docentes').agregar(
+            cal.get('id_asignacion')
+            for matricula in student_matriculas
+            for cal in matricula.get('calificaciones', [])
+        )
+        
+        cursos = _cursos_de_matriculas(student_matriculas, asignaciones.obtener)
         
         print(f"✅ Total cursos procesados: {len(cursos)}")
         
@@ -562,6 +549,88 @@ def get_student_courses():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
             
+@app.route('/student/dashboard', methods=['GET'])
+@token_required('estudiante')
+def get_student_dashboard():
+    """
+    Vista de inicio del estudiante en una sola respuesta: perfil, promedio y
+    notas recientes, horario de hoy y cursos.
+
+    El estudiante se resuelve una vez y sus matrículas activas se leen con una
+    sola agregación que trae las asignaciones ($lookup) y el horario del grupo.
+    """
+    try:
+        estudiante = resolver_usuario(g.userinfo, 'estudiante')
+        
+        if not estudiante:
+            return jsonify({'success': False, 'error': 'Estudiante no encontrado'}), 404
+        
+        student_matriculas = list(get_matriculas_collection().aggregate([
+            {'$match': {
+                'id_estudiante': estudiante['_id'],
+                'estado': 'activa'
+            }},
+            {'$lookup': {
+                'from': 'asignaciones_docentes',
+                'localField': 'calificaciones.id_asignacion',
+                'foreignField': '_id',
+                'pipeline': [{'$project': {'curso_info': 1, 'docente_info': 1}}],
+                'as': 'asignaciones'
+            }},
+            {'$lookup': {
+                'from': 'horarios',
+                'localField': 'grupo_info.nombre_grupo',
+                'foreignField': 'grupo',
+                'pipeline': [
+                    {'$match': {'año_lectivo': '2025'}},
+                    {'$project': {'horario': 1}},
+                    {'$limit': 1}
+                ],
+                'as': 'horario_grupo'
+            }}
+        ]))
+        
+        asignaciones = {
+            asignacion['_id']: asignacion
+            for matricula in student_matriculas
+            for asignacion in matricula.pop('asignaciones', [])
+        }
+        
+        promedio, recientes = _calificaciones_recientes(student_matriculas, asignaciones.get)
+        cursos = _cursos_de_matriculas(student_matriculas, asignaciones.get)
+        
+        # Horario del grupo actual del estudiante (o de su primera matrícula activa)
+        matricula_grupo = next(
+            (m for m in student_matriculas if m.get('id_grupo') == estudiante.get('id_grupo')),
+            student_matriculas[0] if student_matriculas else None
+        )
+        grupo_info = (matricula_grupo or {}).get('grupo_info', {})
+        horario_grupo = next(iter((matricula_grupo or {}).get('horario_grupo', [])), None)
+        
+        return jsonify({
+            'success': True,
+            'profile': serialize_doc(estudiante),
+            'grades': {
+                'average': promedio,
+                'recent': recientes
+            },
+            'schedule': {
+                'grupo': grupo_info.get('nombre_grupo', 'Sin grupo'),
+                'grado': grupo_info.get('grado', 'N/A'),
+                'date': datetime.now().strftime('%Y-%m-%d'),
+                'events': _eventos_del_dia(horario_grupo, _dia_hoy()),
+                'año_lectivo': '2025'
+            },
+            'courses': cursos,
+            'count': len(cursos)
+        }), 200
+        
+    except Exception as e:
+        print(f"❌ Error en get_student_dashboard: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/student/certificado/<tipo>', methods=['GET'])
 @token_required('estudiante')
 def download_certificado(tipo):
@@ -573,14 +642,8 @@ def download_certificado(tipo):
         if not student_email:
             return jsonify({'success': False, 'error': 'Email no encontrado en el token'}), 400
         
-        usuarios = get_usuarios_collection()
-        
-        # ✅ Buscar SOLO por email
-        estudiante = usuarios.find_one({
-            'correo': student_email,
-            'rol': 'estudiante',
-            'activo': True
-        })
+        # Buscar estudiante (email o sub del token)
+        estudiante = resolver_usuario(g.userinfo, 'estudiante')
         
         if not estudiante:
             return jsonify({'success': False, 'error': 'Estudiante no encontrado'}), 404
@@ -660,14 +723,8 @@ def download_boletin():
         if not student_email:
             return jsonify({'success': False, 'error': 'Email no encontrado en el token'}), 400
         
-        usuarios = get_usuarios_collection()
-        
-        # Buscar estudiante por email
-        estudiante = usuarios.find_one({
-            'correo': student_email,
-            'rol': 'estudiante',
-            'activo': True
-        })
+        # Buscar estudiante
+        estudiante = resolver_usuario(g.userinfo, 'estudiante')
         
         if not estudiante:
             return jsonify({'success': False, 'error': 'Estudiante no encontrado'}), 404
@@ -739,24 +796,20 @@ def download_boletin():
         total_promedio = 0
         count_materias = 0
         
-        from database.db_config import get_asignaciones_collection
-        asignaciones = get_asignaciones_collection()
+        # ✅ FILTRAR POR PERIODO A NIVEL DE ASIGNACIÓN: una fila por materia con notas
+        filas = [
+            (cal_asignacion, [cal_asignacion]) for cal_asignacion in calificaciones_raw
+            if periodo_bloque(cal_asignacion) == periodo and cal_asignacion.get('notas')
+        ]
         
-        for cal_asignacion in calificaciones_raw:
-            # ✅ FILTRAR POR PERIODO A NIVEL DE ASIGNACIÓN
-            periodo_asignacion = cal_asignacion.get('periodo', '1')
-            
-            if periodo_asignacion != periodo:
-                continue  # Saltar si no es el periodo seleccionado
-            
-            id_asignacion = cal_asignacion.get('id_asignacion')
-            notas = cal_asignacion.get('notas', [])
-            
-            if not notas:
-                continue  # Saltar si no hay notas
-            
+        # Cargar las asignaciones del periodo en una sola consulta
+        asignaciones = get_loader('asignaciones_docentes').agregar(
+            cal.get('id_asignacion') for cal, _ in filas
+        )
+        
+        for (cal_asignacion, _), resultado in zip(filas, calcular_planilla(filas, periodo).resultados()):
             # Obtener información de la asignación (curso)
-            asignacion = asignaciones.find_one({'_id': id_asignacion})
+            asignacion = asignaciones.obtener(cal_asignacion.get('id_asignacion'))
             
             if not asignacion:
                 continue
@@ -764,12 +817,9 @@ def download_boletin():
             curso_info = asignacion.get('curso_info', {})
             nombre_curso = curso_info.get('nombre_curso', 'N/A')
             
-            # Calcular promedio ponderado de las notas
-            total = sum(n.get('nota', 0) * n.get('peso', 0) for n in notas)
-            total_peso = sum(n.get('peso', 0) for n in notas)
-            promedio = round(total / total_peso, 2) if total_peso > 0 else 0
+            promedio = resultado['promedio']
             
-            estado = 'Aprobado' if promedio >= 3.0 else 'Reprobado'
+            estado = 'Aprobado' if resultado['aprobado'] else 'Reprobado'
             
             # Verificar si hay espacio suficiente en la página
             if y_position < 2 * inch:
@@ -782,7 +832,7 @@ def download_boletin():
             p.drawString(3.5 * inch, y_position, f"{promedio:.2f}")
             
             # Color del estado
-            if promedio >= 3.0:
+            if resultado['aprobado']:
                 p.setFillColorRGB(0, 0.5, 0)  # Verde
             else:
                 p.setFillColorRGB(0.8, 0, 0)  # Rojo
@@ -810,8 +860,8 @@ def download_boletin():
             p.drawString(3.5 * inch, y_position, f"{promedio_general:.2f}")
             
             # Estado general
-            estado_general = 'APROBADO' if promedio_general >= 3.0 else 'REPROBADO'
-            if promedio_general >= 3.0:
+            estado_general = 'APROBADO' if promedio_general >= NOTA_APROBACION else 'REPROBADO'
+            if promedio_general >= NOTA_APROBACION:
                 p.setFillColorRGB(0, 0.5, 0)
             else:
                 p.setFillColorRGB(0.8, 0, 0)
@@ -874,17 +924,24 @@ def get_students():
             query['activo'] = (status.lower() == 'active')
         
         # Buscar estudiantes
-        estudiantes = list(usuarios.find(query))
+        proyeccion = leer_proyeccion(request.args)
+        formato = leer_formato_stream(request.args)
+        if formato:
+            cursor = cursor_listado(usuarios, query, projection=proyeccion)
+            return responder_stream(cursor, formato, clave='data')
         
-        # Serializar documentos
-        estudiantes_serializados = serialize_doc(estudiantes)
+        estudiantes, paginacion = paginar(usuarios, query, request.args, projection=proyeccion)
         
+        # Los tipos BSON los codifica el proveedor JSON de la app
         return jsonify({
             'success': True,
-            'data': estudiantes_serializados,
-            'count': len(estudiantes_serializados)
+            'data': estudiantes,
+            'count': len(estudiantes),
+            **paginacion
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -900,7 +957,7 @@ def get_student(student_id):
             return jsonify({'success': False, 'error': 'ID inválido'}), 400
         
         # Buscar estudiante
-        estudiante = usuarios.find_one({'_id': obj_id, 'rol': 'estudiante'})
+        estudiante = usuarios.find_one({'_id': obj_id, 'rol': 'estudiante'}, leer_proyeccion(request.args))
         
         if not estudiante:
             return jsonify({'success': False, 'error': 'Estudiante no encontrado'}), 404
@@ -910,6 +967,8 @@ def get_student(student_id):
             'data': serialize_doc(estudiante)
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -1024,6 +1083,7 @@ def update_student(student_id):
             {'_id': obj_id},
             {'$set': datos_actualizacion}
         )
+        invalidar_usuario(obj_id)
         
         if resultado.modified_count > 0:
             # Registrar en auditoría
@@ -1074,6 +1134,7 @@ def delete_student(student_id):
             {'_id': obj_id},
             {'$set': {'activo': False}}
         )
+        invalidar_usuario(obj_id)
         
         # Registrar en auditoría
         registrar_auditoria(
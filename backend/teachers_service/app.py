@@ -6,11 +6,18 @@ from functools import wraps
 import jwt as pyjwt
 import sys
 import os
+import re
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from bson.timestamp import Timestamp
 
 # Agregar el path del backend para importar db_config
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from database.db_config import (
+    DatabaseConfig,
+    estadisticas_auditoria,
+    en_lotes,
     get_usuarios_collection,
     get_cursos_collection,
     get_groups_collection,
@@ -22,8 +29,45 @@ from database.db_config import (
     string_to_objectid,
     registrar_auditoria
 )
+from database.api_utils import (
+    paginar,
+    leer_proyeccion,
+    leer_formato_stream,
+    cursor_listado,
+    responder_stream
+)
+from database.json_provider import BSONJSONProvider
+from database.keycloak_auth import obtener_proveedor_claves, roles_del_token
+from database.identity_resolver import resolver_usuario, invalidar_usuario
+from database.calificaciones import (
+    NOTA_MAXIMA,
+    TAMANO_LOTE_CALIFICACIONES,
+    LoteCalificaciones,
+    buscar_bloque,
+    filtro_nota,
+    nueva_nota,
+    pipeline_agregar_notas,
+    pipeline_modificar_nota,
+    proyeccion_bloque
+)
+from database.grade_engine import (
+    NOTA_APROBACION,
+    bloque_visible,
+    calcular_planilla,
+    periodo_bloque
+)
+from database.notas_ledger import registrar_evento
+from database.importacion import abrir_tabla, normalizar_encabezado
+from database.asistencia import (
+    PROYECCION_REGISTRO,
+    actualizar_contadores,
+    estadisticas_por_estudiante,
+    hay_contadores_pendientes,
+    marcar_contadores_pendientes
+)
 
 app = Flask(__name__)
+app.json = BSONJSONProvider(app)
 app.secret_key = "PlataformaColegios"
 
 # 🔧 CORS CONFIGURACIÓN COMPLETA
@@ -59,36 +103,29 @@ if KeycloakOpenID is not None:
     except Exception:
         keycloak_openid = None
 
+# Claves de firma del realm en caché (verificación de tokens sin red)
+proveedor_claves = obtener_proveedor_claves(KEYCLOAK_SERVER, KEYCLOAK_REALM)
+
 
 def tiene_rol(token_info, cliente_id, rol_requerido):
     """Comprueba si los claims del token contienen el rol requerido.
 
-    Busca tanto en realm_access como en resource_access[cliente_id].
+    Usa el conjunto de roles (realm_access + todos los resource_access)
+    precalculado al verificar el token; `rol_requerido` puede ser str o lista.
     """
     try:
-        # 1. Buscar en realm_access (roles globales del realm)
-        realm_roles = token_info.get('realm_access', {}).get('roles', [])
-        if rol_requerido in realm_roles:
-            print(f"✓ Rol '{rol_requerido}' encontrado en realm_access")
-            return True
-        
-        # 2. Buscar en resource_access para el cliente específico
-        if cliente_id and cliente_id in token_info.get('resource_access', {}):
-            client_roles = token_info.get('resource_access', {}).get(cliente_id, {}).get('roles', [])
-            if rol_requerido in client_roles:
-                print(f"✓ Rol '{rol_requerido}' encontrado en resource_access[{cliente_id}]")
-                return True
-        
-        # 3. Buscar en TODOS los clientes (fallback)
-        resource_access = token_info.get('resource_access', {})
-        for client_id, client_data in resource_access.items():
-            client_roles = client_data.get('roles', [])
-            if rol_requerido in client_roles:
-                print(f"✓ Rol '{rol_requerido}' encontrado en resource_access[{client_id}]")
-                return True
-        
-        print(f"✗ Rol '{rol_requerido}' NO encontrado. Realm roles: {realm_roles}, Resource access: {list(resource_access.keys())}")
-        return False
+        roles = getattr(token_info, 'roles_set', None)
+        if roles is None:
+            roles = roles_del_token(token_info)
+
+        if isinstance(rol_requerido, str):
+            encontrado = rol_requerido in roles
+        else:
+            encontrado = not roles.isdisjoint(rol_requerido)
+
+        if not encontrado:
+            print(f"✗ Rol '{rol_requerido}' NO encontrado. Roles del token: {sorted(roles)}")
+        return encontrado
         
     except Exception as e:
         print(f"Error al verificar rol: {e}")
@@ -121,18 +158,9 @@ def token_required(rol_requerido):
                 
                 # Intentar decodificar con Keycloak (modo producción)
                 try:
-                    public_key_pem = f"-----BEGIN PUBLIC KEY-----\n{keycloak_openid.public_key()}\n-----END PUBLIC KEY-----"
-                    
-                    userinfo = keycloak_openid.decode_token(
-                        token,
-                        key=public_key_pem,
-                        options={
-                            "verify_signature": True,
-                            "verify_aud": False,
-                            "verify_exp": True
-                        }
-                    )
-                    print(f"✅ Token decodificado con Keycloak")
+                    # Verificación local con las claves JWKS en caché (sin ir a Keycloak)
+                    userinfo = proveedor_claves.verificar(token)
+                    print(f"✅ Token verificado con JWKS en caché")
                     print(f"   Usuario: {userinfo.get('preferred_username', 'N/A')}")
                     print(f"   Email: {userinfo.get('email', 'N/A')}")
                     
@@ -182,7 +210,7 @@ def home():
 
 @app.route('/health')
 def health():
-    return jsonify({'status': 'healthy', 'service': 'teachers', 'database': 'MongoDB'})
+    return jsonify({'status': 'healthy', 'service': 'teachers', 'database': 'MongoDB', 'auth_keys': proveedor_claves.stats(), 'db_pool': DatabaseConfig.estadisticas_pool(), 'audit': estadisticas_auditoria()})
 
 @app.route('/teachers', methods=['GET'])
 def get_teachers():
@@ -204,17 +232,24 @@ def get_teachers():
             query['especialidad'] = {'$regex': especialidad, '$options': 'i'}
         
         # Buscar docentes
-        docentes = list(usuarios.find(query))
+        proyeccion = leer_proyeccion(request.args)
+        formato = leer_formato_stream(request.args)
+        if formato:
+            cursor = cursor_listado(usuarios, query, projection=proyeccion)
+            return responder_stream(cursor, formato, clave='data')
         
-        # Serializar documentos
-        docentes_serializados = serialize_doc(docentes)
+        docentes, paginacion = paginar(usuarios, query, request.args, projection=proyeccion)
         
+        # Los tipos BSON los codifica el proveedor JSON de la app
         return jsonify({
             'success': True,
-            'data': docentes_serializados,
-            'count': len(docentes_serializados)
+            'data': docentes,
+            'count': len(docentes),
+            **paginacion
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -230,7 +265,7 @@ def get_teacher(teacher_id):
             return jsonify({'success': False, 'error': 'ID inválido'}), 400
         
         # Buscar docente
-        docente = usuarios.find_one({'_id': obj_id, 'rol': 'docente'})
+        docente = usuarios.find_one({'_id': obj_id, 'rol': 'docente'}, leer_proyeccion(request.args))
         
         if not docente:
             return jsonify({'success': False, 'error': 'Docente no encontrado'}), 404
@@ -240,6 +275,8 @@ def get_teacher(teacher_id):
             'data': serialize_doc(docente)
         }), 200
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -350,6 +387,7 @@ def update_teacher(teacher_id):
             {'_id': obj_id},
             {'$set': datos_actualizacion}
         )
+        invalidar_usuario(obj_id)
         
         if resultado.modified_count > 0:
             # Registrar en auditoría
@@ -400,6 +438,7 @@ def delete_teacher(teacher_id):
             {'_id': obj_id},
             {'$set': {'activo': False}}
         )
+        invalidar_usuario(obj_id)
         
         # Registrar en auditoría
         registrar_auditoria(
@@ -443,23 +482,8 @@ def teacher_groups():
         return '', 204
     
     try:
-        teacher_email = g.userinfo.get('email')
-        if not teacher_email:
-            teacher_email = g.userinfo.get('preferred_username')
-        if teacher_email and '@' not in teacher_email:
-            teacher_email = f"{teacher_email}@colegio.edu.co"
-        
-        teacher_sub = g.userinfo.get('sub')
-        
-        print(f"🔍 Buscando docente con email: {teacher_email}")
-        
-        usuarios = get_usuarios_collection()
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
-        
+        docente = resolver_usuario(g.userinfo, 'docente')
+
         if not docente:
             print(f"❌ Docente no encontrado en MongoDB")
             return jsonify({
@@ -469,52 +493,13 @@ def teacher_groups():
         
         print(f"✅ Docente encontrado: {docente.get('nombres')} {docente.get('apellidos')}")
         
-        # ✅ CAMBIO: Buscar en asignaciones_docentes en lugar de cursos
-        from database.db_config import get_asignaciones_collection
-        
-        asignaciones = get_asignaciones_collection()
-        matriculas = get_matriculas_collection()
-        
-        # Buscar asignaciones del docente
-        asignaciones_list = list(asignaciones.find({
-            'id_docente': docente['_id'],
-            'activo': True,
-            'anio_lectivo': '2025'
-        }))
+        asignaciones_list = asignaciones_activas_docente(docente)
         
         print(f"📚 Encontradas {len(asignaciones_list)} asignaciones para el docente")
         
-        # Agrupar por grupo (un grupo puede tener múltiples asignaturas)
-        grupos_dict = {}
-        
-        for asig in asignaciones_list:
-            grupo_id = str(asig['id_grupo'])
-            
-            if grupo_id not in grupos_dict:
-                # Contar estudiantes matriculados ACTIVOS en el grupo
-                num_estudiantes = matriculas.count_documents({
-                    'id_grupo': asig['id_grupo'],
-                    'estado': 'activa'
-                })
-                
-                grupos_dict[grupo_id] = {
-                    '_id': grupo_id,
-                    'name': f"{asig['grupo_info'].get('nombre_grupo', 'Grupo')} - Periodo {asig.get('periodo', '1')}",
-                    'students': num_estudiantes,
-                    'progress_pct': 0,  # TODO: calcular progreso real
-                    'codigo': asig['grupo_info'].get('nombre_grupo', ''),
-                    'periodo': asig.get('periodo', '1'),
-                    'asignaturas': []
-                }
-            
-            # Agregar asignatura al grupo
-            grupos_dict[grupo_id]['asignaturas'].append({
-                'nombre': asig['curso_info'].get('nombre_curso', ''),
-                'codigo': asig['curso_info'].get('codigo_curso', ''),
-                'area': asig['curso_info'].get('area', '')
-            })
-        
-        grupos_formateados = list(grupos_dict.values())
+        # Estudiantes activos de todos los grupos en una sola agregación
+        estudiantes_por_grupo, _ = conteos_calificaciones_docente(asignaciones_list)
+        grupos_formateados = grupos_docente(asignaciones_list, estudiantes_por_grupo)
         
         print(f"✅ {len(grupos_formateados)} grupos únicos encontrados")
         for grupo in grupos_formateados:
@@ -535,36 +520,139 @@ def teacher_groups():
             'error': str(e)
         }), 500
     
+def conteos_calificaciones_docente(asignaciones_docente):
+    """
+    Estudiantes activos por grupo y estudiantes con al menos una nota por
+    asignación, para todas las asignaciones del docente en una sola agregación.
+
+    Devuelve (estudiantes_por_grupo, con_notas_por_asignacion), ambos
+    diccionarios indexados por ObjectId.
+    """
+    if not asignaciones_docente:
+        return {}, {}
+
+    grupo_de_asignacion = {asig['_id']: asig['id_grupo'] for asig in asignaciones_docente}
+    resultado = next(get_matriculas_collection().aggregate([
+        {'$match': {
+            'id_grupo': {'$in': list(set(grupo_de_asignacion.values()))},
+            'estado': 'activa'
+        }},
+        # Asignaciones del docente en las que el estudiante ya tiene notas (sin repetir periodos)
+        {'$project': {
+            'id_grupo': 1,
+            'con_notas': {'$setUnion': [{'$map': {
+                'input': {'$filter': {
+                    'input': {'$ifNull': ['$calificaciones', []]},
+                    'cond': {'$and': [
+                        {'$in': ['$$this.id_asignacion', list(grupo_de_asignacion)]},
+                        {'$gt': [{'$size': {'$ifNull': ['$$this.notas', []]}}, 0]}
+                    ]}
+                }},
+                'in': '$$this.id_asignacion'
+            }}]}
+        }},
+        {'$facet': {
+            'por_grupo': [
+                {'$group': {'_id': '$id_grupo', 'total': {'$sum': 1}}}
+            ],
+            'por_asignacion': [
+                {'$unwind': '$con_notas'},
+                {'$group': {'_id': {'grupo': '$id_grupo', 'asignacion': '$con_notas'}, 'total': {'$sum': 1}}}
+            ]
+        }}
+    ]), {'por_grupo': [], 'por_asignacion': []})
+
+    estudiantes_por_grupo = {fila['_id']: fila['total'] for fila in resultado['por_grupo']}
+    con_notas_por_asignacion = {
+        fila['_id']['asignacion']: fila['total']
+        for fila in resultado['por_asignacion']
+        # Solo cuentan los estudiantes matriculados en el grupo de la asignación
+        if grupo_de_asignacion.get(fila['_id']['asignacion']) == fila['_id']['grupo']
+    }
+    return estudiantes_por_grupo, con_notas_por_asignacion
+
+
+def asignaciones_activas_docente(docente):
+    """Asignaciones activas del docente en el año lectivo actual"""
+    return list(get_asignaciones_collection().find({
+        'id_docente': docente['_id'],
+        'activo': True,
+        'anio_lectivo': '2025'
+    }))
+
+
+def grupos_docente(asignaciones_docente, estudiantes_por_grupo):
+    """Grupos del docente (un grupo puede tener varias asignaturas) con sus estudiantes activos"""
+    grupos_dict = {}
+    for asig in asignaciones_docente:
+        grupo_info = asig.get('grupo_info', {})
+        curso_info = asig.get('curso_info', {})
+        grupo_id = str(asig['id_grupo'])
+        
+        if grupo_id not in grupos_dict:
+            grupos_dict[grupo_id] = {
+                '_id': grupo_id,
+                'name': f"{grupo_info.get('nombre_grupo', 'Grupo')} - Periodo {asig.get('periodo', '1')}",
+                'students': estudiantes_por_grupo.get(asig['id_grupo'], 0),
+                'progress_pct': 0,  # TODO: calcular progreso real
+                'codigo': grupo_info.get('nombre_grupo', ''),
+                'periodo': asig.get('periodo', '1'),
+                'asignaturas': []
+            }
+        
+        # Agregar asignatura al grupo
+        grupos_dict[grupo_id]['asignaturas'].append({
+            'nombre': curso_info.get('nombre_curso', ''),
+            'codigo': curso_info.get('codigo_curso', ''),
+            'area': curso_info.get('area', '')
+        })
+    return list(grupos_dict.values())
+
+
+def pendientes_docente(asignaciones_docente, estudiantes_por_grupo, con_notas_por_asignacion):
+    """Asignaciones con estudiantes sin ninguna nota, con cuántos faltan"""
+    pending_list = []
+    for asig in asignaciones_docente:
+        total_estudiantes = estudiantes_por_grupo.get(asig['id_grupo'], 0)
+        estudiantes_con_notas = con_notas_por_asignacion.get(asig['_id'], 0)
+
+        pending_count = max(total_estudiantes - estudiantes_con_notas, 0)
+
+        if pending_count > 0:
+            curso_info = asig.get('curso_info', {})
+            grupo_info = asig.get('grupo_info', {})
+
+            pending_list.append({
+                'course': f"{curso_info.get('nombre_curso', '')} - {grupo_info.get('nombre_grupo', '')}",
+                'pending': pending_count,
+                'total': total_estudiantes,
+                'course_id': str(asig.get('id_curso', '')),
+                'assignment_id': str(asig.get('_id', ''))
+            })
+    return pending_list
+
+
+def resumen_docente(docente, asignaciones_docente, estudiantes_por_grupo, pending_list):
+    """Resumen de la vista de inicio del docente"""
+    return {
+        'teacher_name': f"{docente.get('nombres', '')} {docente.get('apellidos', '')}".strip(),
+        'especialidad': docente.get('especialidad', 'N/A'),
+        'groups_count': len({asig['id_grupo'] for asig in asignaciones_docente}),
+        'total_students': sum(estudiantes_por_grupo.values()),
+        'pending_grades': sum(p['pending'] for p in pending_list),
+        'next_event': 'No hay eventos programados'
+    }
+
+
 @app.route('/teacher/pending-grades', methods=['GET'])
 @token_required('docente')
 def teacher_pending_grades():
     """Calificaciones pendientes del docente autenticado"""
     try:
-        # 🔧 Obtener email del token (preferiblemente) o sub como fallback
-        teacher_email = g.userinfo.get('email') or g.userinfo.get('preferred_username')
-        teacher_sub = g.userinfo.get('sub')
-        
-        print(f"🔍 Buscando docente con email: {teacher_email}, sub: {teacher_sub}")
-        
-        usuarios = get_usuarios_collection()
-        
-        # Buscar por email primero
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
-        
-        # Si no se encuentra por email, intentar por sub (si está guardado en la BD)
-        if not docente:
-            docente = usuarios.find_one({
-                'keycloak_id': teacher_sub,  # Asumiendo que guardas el UUID aquí
-                'rol': 'docente',
-                'activo': True
-            })
-        
+        docente = resolver_usuario(g.userinfo, 'docente')
+
         if not docente:
-            print(f"❌ Docente no encontrado. Email buscado: {teacher_email}")
+            print(f"❌ Docente no encontrado en MongoDB")
             return jsonify({
                 'success': False,
                 'error': 'Docente no encontrado en la base de datos'
@@ -572,50 +660,9 @@ def teacher_pending_grades():
         
         print(f"✅ Docente encontrado: {docente.get('nombres')} {docente.get('apellidos')}")
      
-        matriculas = get_matriculas_collection()
-        asignaciones = get_asignaciones_collection()
-
-        # Obtener asignaciones del docente (modelo actual)
-        asignaciones_docente = list(asignaciones.find({
-            'id_docente': docente['_id'],
-            'activo': True,
-            'anio_lectivo': '2025'
-        }))
-
-        pending_list = []
-
-        for asig in asignaciones_docente:
-            # Total de estudiantes activos del grupo asignado
-            total_estudiantes = matriculas.count_documents({
-                'id_grupo': asig['id_grupo'],
-                'estado': 'activa'
-            })
-
-            # Estudiantes que ya tienen notas para ESTA asignacion
-            estudiantes_con_notas = matriculas.count_documents({
-                'id_grupo': asig['id_grupo'],
-                'estado': 'activa',
-                'calificaciones': {
-                    '$elemMatch': {
-                        'id_asignacion': asig['_id'],
-                        'notas.0': {'$exists': True}
-                    }
-                }
-            })
-
-            pending_count = max(total_estudiantes - estudiantes_con_notas, 0)
-
-            if pending_count > 0:
-                curso_info = asig.get('curso_info', {})
-                grupo_info = asig.get('grupo_info', {})
-
-                pending_list.append({
-                    'course': f"{curso_info.get('nombre_curso', '')} - {grupo_info.get('nombre_grupo', '')}",
-                    'pending': pending_count,
-                    'total': total_estudiantes,
-                    'course_id': str(asig.get('id_curso', '')),
-                    'assignment_id': str(asig.get('_id', ''))
-                })
+        asignaciones_docente = asignaciones_activas_docente(docente)
+        estudiantes_por_grupo, con_notas_por_asignacion = conteos_calificaciones_docente(asignaciones_docente)
+        pending_list = pendientes_docente(asignaciones_docente, estudiantes_por_grupo, con_notas_por_asignacion)
         
         return jsonify({
             'success': True,
@@ -634,21 +681,8 @@ def teacher_pending_grades():
 def teacher_overview():
     """Resumen general del docente autenticado"""
     try:
-        teacher_email = g.userinfo.get('email')
-        if not teacher_email:
-            teacher_email = g.userinfo.get('preferred_username')
-        if teacher_email and '@' not in teacher_email:
-            teacher_email = f"{teacher_email}@colegio.edu.co"
-        
-        print(f"🔍 Buscando docente: {teacher_email}")
-        
-        usuarios = get_usuarios_collection()
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
-        
+        docente = resolver_usuario(g.userinfo, 'docente')
+
         if not docente:
             return jsonify({
                 'success': False,
@@ -657,57 +691,71 @@ def teacher_overview():
         
         print(f"✅ Docente encontrado: {docente.get('nombres')} {docente.get('apellidos')}")
         
-        # ✅ CAMBIO: Usar asignaciones_docentes
-        from database.db_config import get_asignaciones_collection
+        asignaciones_list = asignaciones_activas_docente(docente)
         
-        asignaciones = get_asignaciones_collection()
-        matriculas = get_matriculas_collection()
+        # Estudiantes y calificaciones pendientes de todos los grupos en una sola agregación
+        estudiantes_por_grupo, con_notas_por_asignacion = conteos_calificaciones_docente(asignaciones_list)
+        pending_list = pendientes_docente(asignaciones_list, estudiantes_por_grupo, con_notas_por_asignacion)
+        resumen = resumen_docente(docente, asignaciones_list, estudiantes_por_grupo, pending_list)
         
-        # Contar asignaciones (cursos únicos)
-        asignaciones_list = list(asignaciones.find({
-            'id_docente': docente['_id'],
-            'activo': True,
-            'anio_lectivo': '2025'
-        }))
+        print(f"📊 Overview: {resumen['groups_count']} grupos, {resumen['total_students']} estudiantes, {len(asignaciones_list)} asignaturas")
         
-        # Contar grupos únicos
-        grupos_unicos = set(str(asig['id_grupo']) for asig in asignaciones_list)
-        groups_count = len(grupos_unicos)
-        
-        # Contar estudiantes totales en todos los grupos del docente
-        total_students = 0
-        for grupo_id_str in grupos_unicos:
-            from bson import ObjectId
-            grupo_id = ObjectId(grupo_id_str)
-            num = matriculas.count_documents({
-                'id_grupo': grupo_id,
-                'estado': 'activa'
-            })
-            total_students += num
+        return jsonify({'success': True, **resumen}), 200
+        
+    except Exception as e:
+        print(f"❌ Error en /teacher/overview: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/teacher/dashboard', methods=['GET'])
+@token_required('docente')
+def teacher_dashboard():
+    """
+    Todo lo que necesita la vista de inicio del docente en una sola respuesta:
+    resumen, grupos, calificaciones pendientes y asignaturas.
+
+    Usa los mismos conteos y formatos que /teacher/overview, /teacher/groups y
+    /teacher/pending-grades: una consulta de asignaciones y una agregación
+    sobre matriculas para todo el docente.
+    """
+    try:
+        docente = resolver_usuario(g.userinfo, 'docente')
+        if not docente:
+            return jsonify({'success': False, 'error': 'Docente no encontrado'}), 404
+        
+        asignaciones_list = asignaciones_activas_docente(docente)
+        estudiantes_por_grupo, con_notas_por_asignacion = conteos_calificaciones_docente(asignaciones_list)
         
-        # TODO: Implementar calificaciones pendientes
-        pending_grades = 0
+        grupos_formateados = grupos_docente(asignaciones_list, estudiantes_por_grupo)
+        pending_list = pendientes_docente(asignaciones_list, estudiantes_por_grupo, con_notas_por_asignacion)
         
-        print(f"📊 Overview: {groups_count} grupos, {total_students} estudiantes, {len(asignaciones_list)} asignaturas")
+        asignaturas = {}
+        for asig in asignaciones_list:
+            curso_info = asig.get('curso_info', {})
+            asignaturas.setdefault(str(asig.get('id_curso', '')), {
+                'nombre': curso_info.get('nombre_curso', ''),
+                'codigo': curso_info.get('codigo_curso', ''),
+                'area': curso_info.get('area', '')
+            })
         
         return jsonify({
             'success': True,
-            'teacher_name': f"{docente.get('nombres', '')} {docente.get('apellidos', '')}".strip(),
-            'especialidad': docente.get('especialidad', 'N/A'),
-            'groups_count': groups_count,
-            'total_students': total_students,
-            'pending_grades': pending_grades,
-            'next_event': 'No hay eventos programados'
+            'overview': resumen_docente(docente, asignaciones_list, estudiantes_por_grupo, pending_list),
+            'groups': grupos_formateados,
+            'pending': pending_list,
+            'total_pending': sum(p['pending'] for p in pending_list),
+            'subjects': list(asignaturas.values())
         }), 200
         
     except Exception as e:
-        print(f"❌ Error en /teacher/overview: {e}")
+        print(f"❌ Error en /teacher/dashboard: {e}")
         import traceback
         traceback.print_exc()
-        return jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500
+        return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/teacher/courses/<course_id>/grades', methods=['GET'])
 @token_required('docente')
@@ -727,36 +775,12 @@ def get_course_grades(course_id):
         if not curso:
             return jsonify({'success': False, 'error': 'Curso no encontrado'}), 404
         
-        # 🔧 ACTUALIZACIÓN: Extraer email del token correctamente
-        teacher_email = g.userinfo.get('email') or g.userinfo.get('preferred_username')
-        teacher_sub = g.userinfo.get('sub')
-        
-        print(f"🔍 Verificando permisos del docente:")
-        print(f"   Email del token: {teacher_email}")
-        print(f"   Sub del token: {teacher_sub}")
-        print(f"   ID del curso: {course_id}")
-        
-        usuarios = get_usuarios_collection()
-        
-        # Buscar por email primero
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
-        
-        # Si no se encuentra por email, intentar por keycloak_id
-        if not docente:
-            docente = usuarios.find_one({
-                'keycloak_id': teacher_sub,
-                'rol': 'docente',
-                'activo': True
-            })
+        print(f"🔍 Verificando permisos del docente sobre el curso {course_id}")
         
+        docente = resolver_usuario(g.userinfo, 'docente')
+
         if not docente:
             print(f"❌ Docente no encontrado en la base de datos")
-            print(f"   Email buscado: {teacher_email}")
-            print(f"   Sub buscado: {teacher_sub}")
             return jsonify({
                 'success': False,
                 'error': 'Docente no encontrado en la base de datos'
@@ -783,23 +807,25 @@ def get_course_grades(course_id):
             'estado': 'activa'
         }))
 
-        students_data = []
+        # Planilla del curso: por estudiante, los bloques de su asignación (todos los periodos)
+        periodo = request.args.get('periodo')
+        filas = []
         for enrollment in enrollments:
             asig = asignacion_por_grupo.get(enrollment.get('id_grupo'))
             if not asig:
                 continue
+            filas.append((enrollment, [
+                cal for cal in enrollment.get('calificaciones', [])
+                if cal.get('id_asignacion') == asig['_id']
+            ]))
 
-            notas = []
-            for cal in enrollment.get('calificaciones', []):
-                if cal.get('id_asignacion') == asig['_id']:
-                    notas = cal.get('notas', [])
-                    break
-
-            promedio = 0
-            if notas:
-                total = sum(n.get('nota', 0) * n.get('peso', 0) for n in notas)
-                total_peso = sum(n.get('peso', 0) for n in notas)
-                promedio = round(total / total_peso, 2) if total_peso > 0 else 0
+        students_data = []
+        for (enrollment, bloques), resultado in zip(filas, calcular_planilla(filas).resultados()):
+            asig = asignacion_por_grupo[enrollment['id_grupo']]
+            # Notas del periodo pedido (o del primer bloque) y su promedio
+            bloque = bloque_visible(bloques, periodo)
+            notas = bloque.get('notas', []) if bloque else []
+            promedio = resultado['periodos'].get(periodo_bloque(bloque), 0) if bloque else 0
 
             student_info = enrollment.get('estudiante_info', {})
             students_data.append({
@@ -809,7 +835,9 @@ def get_course_grades(course_id):
                 'student_code': student_info.get('codigo_est', ''),
                 'grades': serialize_doc(notas),
                 'average': promedio,
-                'estado': 'Aprobado' if promedio >= 3.0 else 'Reprobado',
+                'estado': 'Aprobado' if promedio >= NOTA_APROBACION else 'Reprobado',
+                'period_averages': resultado['periodos'],
+                'final_average': resultado['final'],
                 'group_id': str(enrollment.get('id_grupo')) if enrollment.get('id_grupo') else None,
                 'assignment_id': str(asig['_id'])
             })
@@ -840,20 +868,8 @@ def get_group_grades(group_id):
         if not grupo_obj_id:
             return jsonify({'success': False, 'error': 'ID de grupo inválido'}), 400
         
-        # Obtener email del docente
-        teacher_email = g.userinfo.get('email') or g.userinfo.get('preferred_username')
-        if teacher_email and '@' not in teacher_email:
-            teacher_email = f"{teacher_email}@colegio.edu.co"
-        
-        teacher_sub = g.userinfo.get('sub')
-        
-        usuarios = get_usuarios_collection()
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
-        
+        docente = resolver_usuario(g.userinfo, 'docente')
+
         if not docente:
             return jsonify({'success': False, 'error': 'Docente no encontrado'}), 404
         
@@ -887,24 +903,21 @@ def get_group_grades(group_id):
         
         print(f"👥 Encontrados {len(estudiantes_matriculados)} estudiantes en el grupo")
         
+        # Planilla del grupo: por estudiante, los bloques de las asignaturas del docente
+        ids_asignaciones_docente = {a['_id'] for a in asignaciones_grupo}
+        filas = [
+            (matricula, [
+                item for item in matricula.get('calificaciones', [])
+                if item.get('id_asignacion') in ids_asignaciones_docente
+            ])
+            for matricula in estudiantes_matriculados
+        ]
+        
         # Formatear datos de estudiantes
         students_data = []
-        ids_asignaciones_docente = {a['_id'] for a in asignaciones_grupo}
-        for matricula in estudiantes_matriculados:
+        for (matricula, bloques), resultado in zip(filas, calcular_planilla(filas).resultados()):
             student_info = matricula.get('estudiante_info', {})
-            calificaciones = matricula.get('calificaciones', [])
-            notas_docente = []
-
-            for item in calificaciones:
-                if item.get('id_asignacion') in ids_asignaciones_docente:
-                    notas_docente.extend(item.get('notas', []))
-            
-            # Calcular promedio
-            promedio = 0
-            if notas_docente:
-                total = sum(c.get('nota', 0) * c.get('peso', 0) for c in notas_docente)
-                total_peso = sum(c.get('peso', 0) for c in notas_docente)
-                promedio = round(total / total_peso, 2) if total_peso > 0 else 0
+            notas_docente = [nota for bloque in bloques for nota in bloque.get('notas', [])]
             
             students_data.append({
                 'enrollment_id': str(matricula['_id']),
@@ -912,8 +925,10 @@ def get_group_grades(group_id):
                 'student_name': f"{student_info.get('nombres', '')} {student_info.get('apellidos', '')}",
                 'student_code': student_info.get('codigo_est', ''),
                 'grades': serialize_doc(notas_docente),
-                'average': promedio,
-                'estado': 'Aprobado' if promedio >= 3.0 else 'Reprobado'
+                'average': resultado['promedio'],
+                'estado': 'Aprobado' if resultado['aprobado'] else 'Reprobado',
+                'period_averages': resultado['periodos'],
+                'final_average': resultado['final']
             })
         
         # Información del grupo
@@ -960,7 +975,7 @@ def add_grade():
         
         # Validar nota
         nota = float(data['nota'])
-        nota_maxima = float(data.get('nota_maxima', 5.0))
+        nota_maxima = float(data.get('nota_maxima', NOTA_MAXIMA))
         peso = float(data['peso'])
         
         if nota < 0 or nota > nota_maxima:
@@ -990,41 +1005,22 @@ def add_grade():
             return jsonify({'success': False, 'error': 'Matrícula no encontrada'}), 404
         
         # Crear objeto de calificación (para insertar en notas[])
-        nueva_calificacion = {
-            'tipo': data['tipo'],
-            'nota': nota,
-            'nota_maxima': nota_maxima,
-            'peso': peso,
-            'fecha_eval': datetime.utcnow(),
-            'comentarios': data.get('comentarios', '')
-        }
+        nueva_calificacion = nueva_nota(
+            data['tipo'], nota, peso, data.get('comentarios', ''), nota_maxima
+        )
         
         periodo_eval = data.get('periodo', '1')
         
-        # Intentar actualizar calificación existente para esta asignación/periodo
-        resultado = matriculas.update_one(
-            {
-                '_id': enrollment_obj_id,
-                'calificaciones.id_asignacion': assignment_obj_id,
-                'calificaciones.periodo': periodo_eval
-            },
-            {'$push': {'calificaciones.$.notas': nueva_calificacion}}
+        # Agregar la nota al bloque de la asignación/periodo (lo crea si no existe)
+        # y recalcular su promedio en la misma operación
+        matriculas.update_one(
+            {'_id': enrollment_obj_id},
+            pipeline_agregar_notas(assignment_obj_id, periodo_eval, [nueva_calificacion])
+        )
+        registrar_evento(
+            'agregar', enrollment_obj_id, assignment_obj_id, periodo_eval,
+            g.userinfo.get('sub'), nota=nueva_calificacion
         )
-        
-        # Si no modificó nada, crear nueva entrada de calificación
-        if resultado.modified_count == 0:
-            matriculas.update_one(
-                {'_id': enrollment_obj_id},
-                {
-                    '$push': {
-                        'calificaciones': {
-                            'id_asignacion': assignment_obj_id,
-                            'periodo': periodo_eval,
-                            'notas': [nueva_calificacion]
-                        }
-                    }
-                }
-            )
         
         # Registrar auditoría
         registrar_auditoria(
@@ -1052,66 +1048,111 @@ def add_grade():
 @app.route('/teacher/grades/<enrollment_id>', methods=['PUT'])
 @token_required('docente')
 def update_grade(enrollment_id):
-    """Actualizar una calificación específica"""
+    """
+    Actualizar una nota dentro del bloque de una asignación.
+
+    Body: assignment_id, periodo (opcional: primer bloque de la asignación),
+    id_nota o grade_index (posición de la nota en el bloque) y los campos a
+    cambiar (nota, peso, tipo, comentarios).
+    """
     try:
         data = request.get_json()
         
-        if not data or 'grade_index' not in data:
-            return jsonify({'success': False, 'error': 'Se requiere grade_index'}), 400
+        if not data or 'assignment_id' not in data:
+            return jsonify({'success': False, 'error': 'Se requiere assignment_id'}), 400
+        if 'id_nota' not in data and 'grade_index' not in data:
+            return jsonify({'success': False, 'error': 'Se requiere id_nota o grade_index'}), 400
         
-        grade_index = int(data['grade_index'])
         matriculas = get_matriculas_collection()
         
         enrollment_obj_id = string_to_objectid(enrollment_id)
-        if not enrollment_obj_id:
-            return jsonify({'success': False, 'error': 'ID de matrícula inválido'}), 400
+        assignment_obj_id = string_to_objectid(data['assignment_id'])
+        if not enrollment_obj_id or not assignment_obj_id:
+            return jsonify({'success': False, 'error': 'IDs inválidos'}), 400
         
         matricula = matriculas.find_one({'_id': enrollment_obj_id})
         if not matricula:
             return jsonify({'success': False, 'error': 'Matrícula no encontrada'}), 404
         
-        calificaciones = matricula.get('calificaciones', [])
-        if grade_index < 0 or grade_index >= len(calificaciones):
-            return jsonify({'success': False, 'error': 'Índice de calificación inválido'}), 400
+        # Bloque de la asignación en el periodo indicado (o el primero de la asignación)
+        if 'periodo' in data:
+            cal_asignacion = buscar_bloque(matricula, assignment_obj_id, data['periodo'])
+        else:
+            cal_asignacion = next((
+                cal for cal in matricula.get('calificaciones', [])
+                if cal.get('id_asignacion') == assignment_obj_id
+            ), None)
+        if not cal_asignacion:
+            return jsonify({'success': False, 'error': 'Calificación para esta asignación no encontrada'}), 404
+        
+        notas = cal_asignacion.get('notas', [])
+        if 'id_nota' in data:
+            id_nota = string_to_objectid(data['id_nota'])
+            grade_index = next((i for i, n in enumerate(notas) if id_nota and n.get('id_nota') == id_nota), -1)
+            if grade_index < 0:
+                return jsonify({'success': False, 'error': 'Nota no encontrada'}), 404
+        else:
+            grade_index = int(data['grade_index'])
+            if grade_index < 0 or grade_index >= len(notas):
+                return jsonify({'success': False, 'error': 'Índice de calificación inválido'}), 400
         
         # Construir actualización
-        update_fields = {}
+        cambios = {}
         
         if 'nota' in data:
             nota = float(data['nota'])
-            nota_maxima = calificaciones[grade_index].get('nota_maxima', 5.0)
+            nota_maxima = notas[grade_index].get('nota_maxima', NOTA_MAXIMA)
             if nota < 0 or nota > nota_maxima:
                 return jsonify({
                     'success': False,
                     'error': f'La nota debe estar entre 0 y {nota_maxima}'
                 }), 400
-            update_fields[f'calificaciones.{grade_index}.nota'] = nota
+            cambios['nota'] = nota
         
         if 'peso' in data:
             peso = float(data['peso'])
             if peso < 0 or peso > 1:
                 return jsonify({'success': False, 'error': 'El peso debe estar entre 0 y 1'}), 400
-            update_fields[f'calificaciones.{grade_index}.peso'] = peso
+            cambios['peso'] = peso
         
         if 'comentarios' in data:
-            update_fields[f'calificaciones.{grade_index}.comentarios'] = data['comentarios']
+            cambios['comentarios'] = data['comentarios']
         
         if 'tipo' in data:
-            update_fields[f'calificaciones.{grade_index}.tipo'] = data['tipo']
-        
-        if update_fields:
-            matriculas.update_one(
-                {'_id': enrollment_obj_id},
-                {'$set': update_fields}
+            cambios['tipo'] = data['tipo']
+        
+        # Actualizar la nota y el promedio del bloque en una sola operación,
+        # solo si la nota leída sigue en el bloque
+        if cambios:
+            periodo = cal_asignacion.get('periodo')
+            nota_actual = notas[grade_index]
+            resultado = matriculas.update_one(
+                filtro_nota(enrollment_obj_id, assignment_obj_id, periodo, grade_index, nota_actual),
+                pipeline_modificar_nota(
+                    assignment_obj_id, periodo, grade_index, cambios, id_nota=nota_actual.get('id_nota')
+                )
             )
+            if resultado.matched_count == 0:
+                return jsonify({
+                    'success': False,
+                    'error': 'La calificación cambió mientras se actualizaba, vuelva a consultarla'
+                }), 409
             
-            registrar_auditoria(
-                id_usuario=g.userinfo.get('sub'),
-                accion='actualizar_calificacion',
-                entidad_afectada='matriculas',
-                id_entidad=enrollment_id,
-                detalles=f"Calificación actualizada en índice {grade_index}"
-            )
+            # Sin cambios efectivos (mismos valores) no hay evento ni auditoría
+            if resultado.modified_count:
+                registrar_evento(
+                    'modificar', enrollment_obj_id, assignment_obj_id, periodo,
+                    g.userinfo.get('sub'), id_nota=nota_actual.get('id_nota'),
+                    indice=grade_index, cambios=cambios
+                )
+                
+                registrar_auditoria(
+                    id_usuario=g.userinfo.get('sub'),
+                    accion='actualizar_calificacion',
+                    entidad_afectada='matriculas',
+                    id_entidad=enrollment_id,
+                    detalles=f"Nota actualizada en índice {grade_index} de asignación {data['assignment_id']}"
+                )
         
         matricula_actualizada = matriculas.find_one({'_id': enrollment_obj_id})
         
@@ -1141,16 +1182,29 @@ def delete_grade(enrollment_id, grade_index):
         if not matricula:
             return jsonify({'success': False, 'error': 'Matrícula no encontrada'}), 404
         
-        calificaciones = matricula.get('calificaciones', [])
-        if grade_index < 0 or grade_index >= len(calificaciones):
+        leidas = matricula.get('calificaciones', [])
+        if grade_index < 0 or grade_index >= len(leidas):
             return jsonify({'success': False, 'error': 'Índice de calificación inválido'}), 400
         
-        calificaciones.pop(grade_index)
+        calificaciones = list(leidas)
+        eliminada = calificaciones.pop(grade_index)
         
-        matriculas.update_one(
-            {'_id': enrollment_obj_id},
+        # Solo si las calificaciones no cambiaron desde la lectura (si no, la
+        # posición podría corresponder a otro bloque)
+        resultado = matriculas.update_one(
+            {'_id': enrollment_obj_id, 'calificaciones': leidas},
             {'$set': {'calificaciones': calificaciones}}
         )
+        if resultado.modified_count == 0:
+            return jsonify({
+                'success': False,
+                'error': 'Las calificaciones cambiaron mientras se eliminaba, vuelva a consultarlas'
+            }), 409
+        if 'id_asignacion' in eliminada:
+            registrar_evento(
+                'eliminar_bloque', enrollment_obj_id, eliminada['id_asignacion'],
+                eliminada.get('periodo'), g.userinfo.get('sub')
+            )
         
         registrar_auditoria(
             id_usuario=g.userinfo.get('sub'),
@@ -1187,17 +1241,8 @@ def bulk_upload_grades():
             return jsonify({'success': False, 'error': 'Se requiere course_id'}), 400
         
         # Get teacher's assignment for this group
-        teacher_email = g.userinfo.get('email') or g.userinfo.get('preferred_username')
-        if teacher_email and '@' not in teacher_email:
-            teacher_email = f"{teacher_email}@colegio.edu.co"
-        
-        usuarios = get_usuarios_collection()
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
-        
+        docente = resolver_usuario(g.userinfo, 'docente')
+
         if not docente:
             return jsonify({'success': False, 'error': 'Docente no encontrado'}), 404
         
@@ -1219,11 +1264,12 @@ def bulk_upload_grades():
         failed = 0
         errors = []
         
+        # Validar las entradas en memoria antes de consultar la base de datos
+        validas = []
         for grade_entry in data['grades']:
             try:
                 enrollment_id = grade_entry.get('enrollment_id')
                 nota = float(grade_entry.get('nota', 0))
-                comentarios = grade_entry.get('comentarios', '')
                 
                 if not enrollment_id:
                     failed += 1
@@ -1231,57 +1277,65 @@ def bulk_upload_grades():
                     continue
                 
                 enrollment_obj_id = string_to_objectid(enrollment_id)
-                matricula = matriculas.find_one({'_id': enrollment_obj_id})
-                
-                if not matricula:
+                if not enrollment_obj_id:
                     failed += 1
-                    errors.append({'error': 'Matrícula no encontrada', 'enrollment_id': enrollment_id})
+                    errors.append({'error': 'ID de matrícula inválido', 'enrollment_id': enrollment_id})
                     continue
                 
-                nueva_nota = {
-                'tipo': tipo_evaluacion,
-                'nota': nota,
-                'nota_maxima': 5.0,
-                'peso': peso,
-                'fecha_eval': datetime.utcnow(),
-                'comentarios': comentarios
-                }
                 grade_index = grade_entry.get('grade_index')
-                if grade_index is not None and grade_index >= 0:
-                    # UPDATE existing grade at index
-                    matriculas.update_one(
-                        {
-                            '_id': enrollment_obj_id,
-                            'calificaciones.id_asignacion': asignacion_id,
-                            'calificaciones.periodo': periodo
-                        },
-                        {
-                            '$set': {
-                                'calificaciones.$.notas.' + str(grade_index): nueva_nota
-                            }
-                        }
-                    )
-                else:
-                    # CREATE new grade
-                    matriculas.update_one(
-                        {
-                            '_id': enrollment_obj_id,
-                            'calificaciones.id_asignacion': asignacion_id,
-                            'calificaciones.periodo': periodo
-                        },
-                        {
-                            '$push': {
-                                'calificaciones.$.notas': nueva_nota
-                            }
-                        }
-                    )
-                    
-                successful += 1
+                if grade_index is not None:
+                    grade_index = int(grade_index)
+                
+                validas.append((grade_entry, enrollment_obj_id, nota, grade_index))
                 
             except Exception as e:
                 failed += 1
                 errors.append({'error': str(e), 'entry': grade_entry})
         
+        # Una sola consulta para todas las matrículas, solo con el bloque de esta asignación/periodo
+        matriculas_por_id = {
+            m['_id']: m for m in matriculas.find(
+                {
+                    '_id': {'$in': list({e[1] for e in validas})},
+                    'id_grupo': asignacion['id_grupo']
+                },
+                proyeccion_bloque(asignacion_id, periodo)
+            )
+        }
+        
+        lote = LoteCalificaciones(matriculas, g.userinfo.get('sub'))
+        for grade_entry, enrollment_obj_id, nota, grade_index in validas:
+            enrollment_id = grade_entry.get('enrollment_id')
+            matricula = matriculas_por_id.get(enrollment_obj_id)
+            
+            if not matricula:
+                failed += 1
+                errors.append({'error': 'Matrícula no encontrada', 'enrollment_id': enrollment_id})
+                continue
+            
+            bloque = buscar_bloque(matricula, asignacion_id, periodo)
+            nueva = nueva_nota(tipo_evaluacion, nota, peso, grade_entry.get('comentarios', ''))
+            
+            if grade_index is not None and grade_index >= 0:
+                # UPDATE existing grade at index
+                if not bloque or grade_index >= len(bloque.get('notas', [])):
+                    failed += 1
+                    errors.append({'error': 'Índice de calificación inválido', 'enrollment_id': enrollment_id})
+                    continue
+                # La nota reemplazada conserva su identificador en el historial
+                nueva['id_nota'] = bloque['notas'][grade_index].get('id_nota', nueva['id_nota'])
+                lote.reemplazar(enrollment_obj_id, asignacion_id, periodo, grade_index, nueva, grade_entry)
+            else:
+                # CREATE new grade
+                lote.agregar(enrollment_obj_id, asignacion_id, periodo, nueva, grade_entry)
+        
+        enviadas = lote.entradas
+        fallos = lote.ejecutar()
+        successful += enviadas - len(fallos)
+        failed += len(fallos)
+        for grade_entry, mensaje in fallos:
+            errors.append({'error': mensaje, 'enrollment_id': grade_entry.get('enrollment_id')})
+        
         registrar_auditoria(
             id_usuario=g.userinfo.get('sub'),
             accion='carga_masiva_calificaciones',
@@ -1301,6 +1355,198 @@ def bulk_upload_grades():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+COLUMNAS_CODIGO = ('codigo_est', 'codigo', 'codigo_estudiante')
+COLUMNAS_DOCUMENTO = ('documento', 'numero_documento', 'identificacion')
+COLUMNAS_IGNORADAS = ('nombres', 'apellidos', 'nombre', 'nombre_completo', 'estudiante', 'correo')
+_PESO_EN_ENCABEZADO = re.compile(r'^(.*?)\s*[\(\[]\s*(\d+(?:[.,]\d+)?)\s*(%?)\s*[\)\]]\s*$')
+
+
+def _leer_nota_celda(valor, nota_maxima=NOTA_MAXIMA):
+    """
+    Convierte el texto de una celda ('4,5' o '4.5') en nota de la escala
+    0 - nota_maxima; lanza ValueError si es inválida
+    """
+    try:
+        nota = float(valor.replace(',', '.'))
+    except ValueError:
+        raise ValueError(f"Nota inválida: {valor}")
+    if nota < 0 or nota > nota_maxima:
+        raise ValueError(f"Nota fuera de rango (0 - {nota_maxima:g}): {valor}")
+    return nota
+
+
+def _columnas_evaluacion(encabezados, peso_por_defecto=None):
+    """
+    Identifica la columna del estudiante y las columnas de evaluación de la hoja.
+
+    Devuelve (indice_id, campo_id, evaluaciones) donde `evaluaciones` es una
+    lista de (indice, tipo, peso). El peso puede venir en el encabezado como
+    'Parcial 1 (30%)' o 'Taller [0.2]'; si no, se usa `peso_por_defecto` o se
+    reparte por igual entre las evaluaciones.
+    """
+    indice_id = campo_id = None
+    evaluaciones = []
+    for indice, encabezado in enumerate(encabezados):
+        nombre = normalizar_encabezado(encabezado)
+        if not nombre or nombre in COLUMNAS_IGNORADAS:
+            continue
+        if nombre in COLUMNAS_CODIGO and indice_id is None:
+            indice_id, campo_id = indice, 'codigo_est'
+            continue
+        if nombre in COLUMNAS_DOCUMENTO and indice_id is None:
+            indice_id, campo_id = indice, 'documento'
+            continue
+
+        tipo, peso = encabezado, None
+        m = _PESO_EN_ENCABEZADO.match(encabezado)
+        if m:
+            tipo = m.group(1)
+            peso = float(m.group(2).replace(',', '.'))
+            if m.group(3):
+                peso /= 100
+        evaluaciones.append([indice, tipo, peso])
+
+    if indice_id is None:
+        raise ValueError('El archivo debe tener una columna codigo_est o documento')
+    if not evaluaciones:
+        raise ValueError('El archivo no tiene columnas de evaluación')
+
+    for evaluacion in evaluaciones:
+        if evaluacion[2] is None:
+            evaluacion[2] = peso_por_defecto if peso_por_defecto is not None \
+                else round(1 / len(evaluaciones), 4)
+    return indice_id, campo_id, [tuple(e) for e in evaluaciones]
+
+
+@app.route('/teacher/grades/import', methods=['POST'])
+@token_required('docente')
+def import_grades():
+    """
+    Importar calificaciones desde una hoja CSV o XLSX (multipart: file,
+    course_id, periodo, peso, nota_maxima).
+
+    Cada fila es un estudiante (columna codigo_est o documento) y cada columna
+    restante una evaluación. El archivo se recorre fila a fila y cada lote de
+    filas se guarda con un solo bulk_write; los errores se reportan por fila.
+    """
+    try:
+        archivo = request.files.get('file')
+        if not archivo or not archivo.filename:
+            return jsonify({'success': False, 'error': 'No se proporcionó el archivo'}), 400
+        
+        course_id = request.form.get('course_id')
+        periodo = request.form.get('periodo', '1')
+        peso = request.form.get('peso')
+        nota_maxima = float(request.form.get('nota_maxima', NOTA_MAXIMA))
+        
+        if not course_id:
+            return jsonify({'success': False, 'error': 'Se requiere course_id'}), 400
+        
+        grupo_obj_id = string_to_objectid(course_id)
+        if not grupo_obj_id:
+            return jsonify({'success': False, 'error': 'ID de grupo inválido'}), 400
+        
+        docente = resolver_usuario(g.userinfo, 'docente')
+        if not docente:
+            return jsonify({'success': False, 'error': 'Docente no encontrado'}), 404
+        
+        asignacion = get_asignaciones_collection().find_one({
+            'id_docente': docente['_id'],
+            'id_grupo': grupo_obj_id,
+            'activo': True
+        })
+        if not asignacion:
+            return jsonify({'success': False, 'error': 'No tienes asignación para este grupo'}), 403
+        
+        asignacion_id = asignacion['_id']
+        encabezados, filas = abrir_tabla(archivo)
+        indice_id, campo_id, evaluaciones = _columnas_evaluacion(
+            encabezados, float(peso) if peso else None
+        )
+        
+        # Lista del grupo: matrículas activas y el código/documento de cada estudiante
+        matriculas = get_matriculas_collection()
+        roster = list(matriculas.find(
+            {'id_grupo': grupo_obj_id, 'estado': 'activa'},
+            {'id_estudiante': 1}
+        ))
+        matricula_por_estudiante = {m['id_estudiante']: m for m in roster}
+        matricula_por_clave = {}
+        for estudiante in get_usuarios_collection().find(
+            {'_id': {'$in': list(matricula_por_estudiante)}},
+            {campo_id: 1}
+        ):
+            if estudiante.get(campo_id):
+                matricula_por_clave[str(estudiante[campo_id]).strip()] = \
+                    matricula_por_estudiante[estudiante['_id']]
+        
+        filas_leidas = 0
+        successful = 0
+        failed = 0
+        errors = []
+        
+        for lote_filas in en_lotes(filas, TAMANO_LOTE_CALIFICACIONES):
+            lote = LoteCalificaciones(matriculas, g.userinfo.get('sub'))
+            for numero_fila, valores in lote_filas:
+                filas_leidas += 1
+                clave = valores[indice_id] if indice_id < len(valores) else ''
+                matricula = matricula_por_clave.get(clave)
+                if not matricula:
+                    failed += 1
+                    errors.append({
+                        'fila': numero_fila,
+                        'error': f"Estudiante no encontrado en el grupo: {clave or '(vacío)'}"
+                    })
+                    continue
+                
+                for indice, tipo, peso_eval in evaluaciones:
+                    valor = valores[indice] if indice < len(valores) else ''
+                    if not valor:
+                        continue
+                    try:
+                        nota = _leer_nota_celda(valor, nota_maxima)
+                    except ValueError as e:
+                        failed += 1
+                        errors.append({'fila': numero_fila, 'columna': encabezados[indice], 'error': str(e)})
+                        continue
+                    lote.agregar(
+                        matricula['_id'],
+                        asignacion_id,
+                        periodo,
+                        nueva_nota(tipo, nota, peso_eval, nota_maxima=nota_maxima),
+                        (numero_fila, indice)
+                    )
+            
+            enviadas = lote.entradas
+            fallos = lote.ejecutar()
+            successful += enviadas - len(fallos)
+            failed += len(fallos)
+            for (numero_fila, indice), mensaje in fallos:
+                errors.append({'fila': numero_fila, 'columna': encabezados[indice], 'error': mensaje})
+        
+        registrar_auditoria(
+            id_usuario=g.userinfo.get('sub'),
+            accion='importar_calificaciones',
+            entidad_afectada='matriculas',
+            id_entidad=course_id,
+            detalles=f"Importación {archivo.filename}: {filas_leidas} filas, {successful} notas, {failed} errores"
+        )
+        
+        return jsonify({
+            'success': True,
+            'message': 'Importación completada',
+            'rows': filas_leidas,
+            'evaluations': [tipo for _, tipo, _ in evaluaciones],
+            'successful': successful,
+            'failed': failed,
+            'errors': errors if errors else None
+        }), 200 if failed == 0 else 207
+        
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/teacher/attendance', methods=['GET'])
 @token_required('docente')
 def get_attendance_by_course():
@@ -1326,13 +1572,7 @@ def get_attendance_by_course():
             return jsonify({'success': False, 'error': 'Formato de fecha inválido'}), 400
 
         # Get teacher's assignment for this group
-        teacher_email = g.userinfo.get('email') or g.userinfo.get('preferred_username')
-        usuarios = get_usuarios_collection()
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
+        docente = resolver_usuario(g.userinfo, 'docente')
 
         if not docente:
             return jsonify({'success': False, 'error': 'Docente no encontrado'}), 404
@@ -1351,9 +1591,10 @@ def get_attendance_by_course():
         curso_obj_id = asignacion['id_curso']
         asistencia = get_asistencia_collection()
 
-        # Buscar registro de asistencia
+        # Buscar registro de asistencia del grupo
         registro = asistencia.find_one({
             'id_curso': curso_obj_id,
+            'id_grupo': grupo_obj_id,
             'fecha': fecha_obj
         })
         
@@ -1376,6 +1617,25 @@ def get_attendance_by_course():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def guardar_asistencia(asistencia, curso_obj_id, grupo_obj_id, fecha_obj, documento, nuevo_id, ahora):
+    """
+    Crea o reemplaza el registro de asistencia del curso y grupo en la fecha
+    con un solo upsert. Un mismo curso se dicta en varios grupos y cada uno
+    tiene su propio registro del día. Devuelve el documento anterior (None si
+    se creó) con los campos que necesitan los contadores de asistencia.
+    """
+    return asistencia.find_one_and_update(
+        {'id_curso': curso_obj_id, 'id_grupo': grupo_obj_id, 'fecha': fecha_obj},
+        {
+            '$set': documento,
+            '$setOnInsert': {'_id': nuevo_id, 'creado_en': ahora}
+        },
+        projection=PROYECCION_REGISTRO,
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+
+
 @app.route('/teacher/attendance', methods=['POST'])
 @token_required('docente')
 def save_attendance():
@@ -1395,48 +1655,10 @@ def save_attendance():
                     'error': f'El campo {field} es requerido'
                 }), 400
         
-        # 🔧 CORRECCIÓN: Obtener email del token correctamente
-        teacher_email = g.userinfo.get('email') or g.userinfo.get('preferred_username')
-        teacher_sub = g.userinfo.get('sub')
-        
-        print(f"🔍 Datos del token:")
-        print(f"   Email: {teacher_email}")
-        print(f"   Sub: {teacher_sub}")
-        print(f"   UserInfo completo: {g.userinfo}")
-        
-        usuarios = get_usuarios_collection()
-        
-        # Buscar docente por email primero
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
-        
-        # Si no se encuentra por email, intentar por keycloak_id
-        if not docente:
-            print(f"⚠️ No se encontró por email, intentando por keycloak_id...")
-            docente = usuarios.find_one({
-                'keycloak_id': teacher_sub,
-                'rol': 'docente',
-                'activo': True
-            })
-        
-        # Si aún no se encuentra, intentar por _id (si el sub es un ObjectId válido)
-        if not docente:
-            print(f"⚠️ No se encontró por keycloak_id, intentando por _id...")
-            teacher_obj_id = string_to_objectid(teacher_sub)
-            if teacher_obj_id:
-                docente = usuarios.find_one({
-                    '_id': teacher_obj_id,
-                    'rol': 'docente',
-                    'activo': True
-                })
-        
+        docente = resolver_usuario(g.userinfo, 'docente')
+
         if not docente:
             print(f"❌ Docente no encontrado en la base de datos")
-            print(f"   Email buscado: {teacher_email}")
-            print(f"   Sub buscado: {teacher_sub}")
             return jsonify({
                 'success': False,
                 'error': 'Docente no encontrado en la base de datos'
@@ -1474,37 +1696,43 @@ def save_attendance():
         except ValueError:
             return jsonify({'success': False, 'error': 'Formato de fecha inválido'}), 400
         
-        # Preparar registros de asistencia con información de estudiantes
-        registros_procesados = []
+        # Lista del grupo en una sola consulta, indexada por estudiante
+        ids_estudiantes = [
+            est_id for est_id in (string_to_objectid(r['id_estudiante']) for r in data['registros'])
+            if est_id
+        ]
         matriculas = get_matriculas_collection()
+        info_por_estudiante = {
+            m['id_estudiante']: m.get('estudiante_info', {})
+            for m in matriculas.find(
+                {
+                    'id_grupo': asignacion['id_grupo'],
+                    'estado': 'activa',
+                    'id_estudiante': {'$in': ids_estudiantes}
+                },
+                {'id_estudiante': 1, 'estudiante_info': 1}
+            )
+        }
         
+        registros_procesados = []
         for registro in data['registros']:
             estudiante_id = string_to_objectid(registro['id_estudiante'])
-            if not estudiante_id:
+            if estudiante_id not in info_por_estudiante:
                 continue
-            
-            # Buscar información del estudiante desde la matrícula
-            matricula = matriculas.find_one({
-            'id_estudiante': estudiante_id,
-            'id_grupo': asignacion['id_grupo'],
-            'estado': 'activa'
+            registros_procesados.append({
+                'id_estudiante': estudiante_id,
+                'estudiante_info': info_por_estudiante[estudiante_id],
+                'estado': registro.get('estado', 'presente'),
+                'observaciones': registro.get('observaciones', '')
             })
-            
-            if matricula:
-                registros_procesados.append({
-                    'id_estudiante': estudiante_id,
-                    'estudiante_info': matricula.get('estudiante_info', {}),
-                    'estado': registro.get('estado', 'presente'),
-                    'observaciones': registro.get('observaciones', '')
-                })
         
         # Crear documento de asistencia
         asistencia = get_asistencia_collection()
+        ahora = Timestamp(int(datetime.utcnow().timestamp()), 0)
         
         documento_asistencia = {
-            'id_curso': curso_obj_id,
+            'id_grupo': grupo_obj_id,
             'id_docente': docente['_id'],
-            'fecha': fecha_obj,
             'periodo': data.get('periodo', curso.get('periodo', '1')),
             'registros': registros_procesados,
             'curso_info': {
@@ -1512,30 +1740,34 @@ def save_attendance():
                 'codigo_curso': curso.get('codigo_curso', ''),
                 'grado': curso.get('grado', '')
             },
-            'actualizado_en': Timestamp(int(datetime.utcnow().timestamp()), 0)
+            'actualizado_en': ahora
         }
         
-        # Verificar si ya existe registro para esa fecha
-        registro_existente = asistencia.find_one({
-            'id_curso': curso_obj_id,
-            'fecha': fecha_obj
-        })
+        # Un solo upsert sobre (id_curso, id_grupo, fecha), respaldado por el índice único
+        nuevo_id = ObjectId()
+        try:
+            anterior = guardar_asistencia(asistencia, curso_obj_id, grupo_obj_id, fecha_obj, documento_asistencia, nuevo_id, ahora)
+        except DuplicateKeyError:
+            # Otro docente creó el registro del día al mismo tiempo: ahora existe y se actualiza
+            anterior = guardar_asistencia(asistencia, curso_obj_id, grupo_obj_id, fecha_obj, documento_asistencia, nuevo_id, ahora)
         
-        if registro_existente:
-            # Actualizar registro existente
-            resultado = asistencia.update_one(
-                {'_id': registro_existente['_id']},
-                {'$set': documento_asistencia}
-            )
-            
+        id_registro = anterior['_id'] if anterior else nuevo_id
+        
+        # Aplicar a los contadores por estudiante solo la diferencia con lo que había ese día
+        contadores_actualizados = True
+        try:
+            actualizar_contadores(curso_obj_id, anterior, documento_asistencia)
+        except Exception as e:
+            # El día queda marcado para reconciliar los contadores del curso
+            print(f"⚠️ No se pudieron actualizar los contadores de asistencia: {e}")
+            marcar_contadores_pendientes(id_registro, e)
+            contadores_actualizados = False
+        
+        if anterior:
             mensaje = 'Asistencia actualizada exitosamente'
-            registro_id = str(registro_existente['_id'])
         else:
-            # Crear nuevo registro
-            documento_asistencia['creado_en'] = Timestamp(int(datetime.utcnow().timestamp()), 0)
-            resultado = asistencia.insert_one(documento_asistencia)
             mensaje = 'Asistencia registrada exitosamente'
-            registro_id = str(resultado.inserted_id)
+        registro_id = str(id_registro)
         
         # Registrar auditoría
         registrar_auditoria(
@@ -1549,7 +1781,8 @@ def save_attendance():
         return jsonify({
             'success': True,
             'message': mensaje,
-            'attendance_id': registro_id
+            'attendance_id': registro_id,
+            'counters_updated': contadores_actualizados
         }), 201
         
     except Exception as e:
@@ -1573,64 +1806,28 @@ def get_attendance_statistics():
         if not curso_obj_id:
             return jsonify({'success': False, 'error': 'ID de curso inválido'}), 400
         
-        asistencia = get_asistencia_collection()
-        
-        # Construir query
+        # Días registrados del curso (conteo sobre el índice, sin leer los documentos)
         query = {'id_curso': curso_obj_id}
         if periodo:
             query['periodo'] = periodo
+        total_registros = get_asistencia_collection().count_documents(query)
         
-        # Obtener todos los registros de asistencia del curso
-        registros = list(asistencia.find(query).sort('fecha', -1))
-        
-        # Calcular estadísticas
-        total_registros = len(registros)
-        total_estudiantes = 0
+        # Totales por estudiante desde los contadores
+        estudiantes_stats = []
         total_presentes = 0
         total_ausentes = 0
         total_tardes = 0
         
-        # Estadísticas por estudiante
-        estadisticas_estudiantes = {}
-        
-        for registro in registros:
-            for item in registro.get('registros', []):
-                estudiante_id = str(item['id_estudiante'])
-                estado = item.get('estado', 'presente')
-                
-                if estudiante_id not in estadisticas_estudiantes:
-                    estadisticas_estudiantes[estudiante_id] = {
-                        'estudiante_info': item.get('estudiante_info', {}),
-                        'total_clases': 0,
-                        'presentes': 0,
-                        'ausentes': 0,
-                        'tardes': 0,
-                        'excusas': 0
-                    }
-                
-                estadisticas_estudiantes[estudiante_id]['total_clases'] += 1
-                
-                if estado == 'presente':
-                    estadisticas_estudiantes[estudiante_id]['presentes'] += 1
-                    total_presentes += 1
-                elif estado == 'ausente':
-                    estadisticas_estudiantes[estudiante_id]['ausentes'] += 1
-                    total_ausentes += 1
-                elif estado == 'tarde':
-                    estadisticas_estudiantes[estudiante_id]['tardes'] += 1
-                    total_tardes += 1
-                elif estado == 'excusa':
-                    estadisticas_estudiantes[estudiante_id]['excusas'] += 1
-        
-        # Calcular porcentajes por estudiante
-        estudiantes_stats = []
-        for est_id, stats in estadisticas_estudiantes.items():
+        for stats in estadisticas_por_estudiante(curso_obj_id, periodo):
             total_clases = stats['total_clases']
             porcentaje_asistencia = round((stats['presentes'] / total_clases * 100), 2) if total_clases > 0 else 0
+            total_presentes += stats['presentes']
+            total_ausentes += stats['ausentes']
+            total_tardes += stats['tardes']
             
             estudiantes_stats.append({
-                'estudiante_id': est_id,
-                'estudiante_info': stats['estudiante_info'],
+                'estudiante_id': str(stats['id_estudiante']),
+                'estudiante_info': stats.get('estudiante_info') or {},
                 'total_clases': total_clases,
                 'presentes': stats['presentes'],
                 'ausentes': stats['ausentes'],
@@ -1649,7 +1846,9 @@ def get_attendance_statistics():
                 'total_presentes': total_presentes,
                 'total_ausentes': total_ausentes,
                 'total_tardes': total_tardes,
-                'estudiantes': estudiantes_stats
+                'estudiantes': estudiantes_stats,
+                # Días cuyo cambio aún no está en los contadores (pendientes de reconciliar)
+                'contadores_pendientes': hay_contadores_pendientes(curso_obj_id)
             }
         }), 200
         
@@ -1670,28 +1869,9 @@ def get_teacher_observations():
         categoria = request.args.get('categoria')
         estudiante_id = request.args.get('student_id')
         
-        # Obtener ID del docente desde el token
-        teacher_email = g.userinfo.get('email') or g.userinfo.get('preferred_username')
-        teacher_sub = g.userinfo.get('sub')
-        
-        usuarios = get_usuarios_collection()
-        
-        # Buscar docente
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
-        
-        if not docente:
-            teacher_obj_id = string_to_objectid(teacher_sub)
-            if teacher_obj_id:
-                docente = usuarios.find_one({
-                    '_id': teacher_obj_id,
-                    'rol': 'docente',
-                    'activo': True
-                })
-        
+        # Obtener el docente desde el token
+        docente = resolver_usuario(g.userinfo, 'docente')
+
         if not docente:
             return jsonify({'success': False, 'error': 'Docente no encontrado'}), 404
         
@@ -1762,28 +1942,10 @@ def create_observation():
                     'error': f'El campo {field} es requerido'
                 }), 400
         
-        # Obtener ID del docente desde el token
-        teacher_email = g.userinfo.get('email') or g.userinfo.get('preferred_username')
-        teacher_sub = g.userinfo.get('sub')
-        
+        # Obtener el docente desde el token
         usuarios = get_usuarios_collection()
-        
-        # Buscar docente
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
-        
-        if not docente:
-            teacher_obj_id = string_to_objectid(teacher_sub)
-            if teacher_obj_id:
-                docente = usuarios.find_one({
-                    '_id': teacher_obj_id,
-                    'rol': 'docente',
-                    'activo': True
-                })
-        
+        docente = resolver_usuario(g.userinfo, 'docente')
+
         if not docente:
             return jsonify({'success': False, 'error': 'Docente no encontrado'}), 404
         
@@ -1910,28 +2072,9 @@ def update_observation(observation_id):
         if not obs_obj_id:
             return jsonify({'success': False, 'error': 'ID de observación inválido'}), 400
         
-        # Obtener ID del docente desde el token
-        teacher_email = g.userinfo.get('email') or g.userinfo.get('preferred_username')
-        teacher_sub = g.userinfo.get('sub')
-        
-        usuarios = get_usuarios_collection()
-        
-        # Buscar docente
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
-        
-        if not docente:
-            teacher_obj_id = string_to_objectid(teacher_sub)
-            if teacher_obj_id:
-                docente = usuarios.find_one({
-                    '_id': teacher_obj_id,
-                    'rol': 'docente',
-                    'activo': True
-                })
-        
+        # Obtener el docente desde el token
+        docente = resolver_usuario(g.userinfo, 'docente')
+
         if not docente:
             return jsonify({'success': False, 'error': 'Docente no encontrado'}), 404
         
@@ -2007,28 +2150,9 @@ def delete_observation(observation_id):
         if not obs_obj_id:
             return jsonify({'success': False, 'error': 'ID de observación inválido'}), 400
         
-        # Obtener ID del docente desde el token
-        teacher_email = g.userinfo.get('email') or g.userinfo.get('preferred_username')
-        teacher_sub = g.userinfo.get('sub')
-        
-        usuarios = get_usuarios_collection()
-        
-        # Buscar docente
-        docente = usuarios.find_one({
-            'correo': teacher_email,
-            'rol': 'docente',
-            'activo': True
-        })
-        
-        if not docente:
-            teacher_obj_id = string_to_objectid(teacher_sub)
-            if teacher_obj_id:
-                docente = usuarios.find_one({
-                    '_id': teacher_obj_id,
-                    'rol': 'docente',
-                    'activo': True
-                })
-        
+        # Obtener el docente desde el token
+        docente = resolver_usuario(g.userinfo, 'docente')
+
         if not docente:
             return jsonify({'success': False, 'error': 'Docente no encontrado'}), 404
         
@@ -194,6 +194,23 @@ describe('ApiService', () => {
       expect(req.request.method).toBe('GET');
       req.flush(mockOverview);
     });
+
+    it('should update a grade by id_nota within its assignment', () => {
+      service.updateGrade('mat1', 'asig1', 'nota1', { nota: 4.5 }, '2').subscribe();
+
+      const req = httpMock.expectOne(`${environment.api.teachers}/teacher/grades/mat1`);
+      expect(req.request.method).toBe('PUT');
+      expect(req.request.body).toEqual({ nota: 4.5, assignment_id: 'asig1', id_nota: 'nota1', periodo: '2' });
+      req.flush({ success: true });
+    });
+
+    it('should update a grade by its position in the block', () => {
+      service.updateGrade('mat1', 'asig1', 0, { nota: 3 }).subscribe();
+
+      const req = httpMock.expectOne(`${environment.api.teachers}/teacher/grades/mat1`);
+      expect(req.request.body).toEqual({ nota: 3, assignment_id: 'asig1', grade_index: 0 });
+      req.flush({ success: true });
+    });
   });
 
   describe('Admin', () => {
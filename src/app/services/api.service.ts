@@ -74,6 +74,10 @@ export class ApiService {
   getTeacherOverview() {
     return this.http.get(`${environment.api.teachers}/teacher/overview`);
   }
+
+  getTeacherDashboard() {
+    return this.http.get(`${environment.api.teachers}/teacher/dashboard`);
+  }
   getTeacherObservations(filters?: any): Observable<any> {
     console.log('📡 API: Obteniendo observaciones del docente');
 
@@ -112,10 +116,13 @@ export class ApiService {
     return this.http.post(`${environment.api.teachers}/teacher/grades`, data);
   }
 
-  updateGrade(enrollmentId: string, gradeIndex: number, data: any) {
+  // nota: id_nota (string) o posición de la nota en el bloque (number)
+  updateGrade(enrollmentId: string, assignmentId: string, nota: string | number, data: any, periodo?: string) {
     return this.http.put(`${environment.api.teachers}/teacher/grades/${enrollmentId}`, {
       ...data,
-      grade_index: gradeIndex
+      assignment_id: assignmentId,
+      ...(typeof nota === 'string' ? { id_nota: nota } : { grade_index: nota }),
+      ...(periodo ? { periodo } : {})
     });
   }
 
@@ -268,6 +275,10 @@ export class ApiService {
     return this.http.get(`${environment.api.students}/student/courses`);
   }
 
+  getStudentDashboard(): Observable<any> {
+    return this.http.get(`${environment.api.students}/student/dashboard`);
+  }
+
   // ==========================================
   //   ENDPOINTS DE ADMINISTRADOR
   // ==========================================